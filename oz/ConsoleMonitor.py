@@ -0,0 +1,189 @@
+# Copyright (C) 2014  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Monitoring of the serial console of the libvirt domains that Oz runs
+"""
+
+import collections
+import threading
+import logging
+import re
+import libvirt
+
+import oz.DomainMonitor
+
+# the longest line we are willing to buffer; anything longer than this is
+# matched (and logged) in pieces
+MAX_LINE_LENGTH = 4096
+
+# escape sequences that text mode installers use to draw their screens
+_escape_re = re.compile(r'\x1b(?:\[[0-9;?]*[A-Za-z@]|[()][A-Za-z0-9]|[=>78DEHM])')
+
+def console_lines(buf, data):
+    """
+    Function to split the console output in data into lines.  buf is the
+    incomplete line left over from the last call; the function returns a
+    tuple of the list of complete lines and the new left over.  Carriage
+    returns and terminal escape sequences are removed from the lines, and
+    the left over is never longer than MAX_LINE_LENGTH.
+    """
+    lines = (buf + data).split('\n')
+    buf = lines.pop()
+    while len(buf) > MAX_LINE_LENGTH:
+        lines.append(buf[:MAX_LINE_LENGTH])
+        buf = buf[MAX_LINE_LENGTH:]
+
+    out = []
+    for line in lines:
+        line = _escape_re.sub('', line)
+        # a carriage return means that the rest of the line overwrote the
+        # start of it
+        line = line.rstrip('\r').split('\r')[-1].strip()
+        if line:
+            out.append(line)
+
+    return out, buf
+
+class ConsoleMonitor(object):
+    """
+    Class to stream the serial console (port 0) of a domain into a log file,
+    while matching each line against the patterns of the install stages and
+    of the fatal installer errors.  stage_patterns and error_patterns are
+    lists of (regular expression, description) tuples.  The console is read
+    from the libvirt event loop, so no thread is needed per domain.
+    """
+    def __init__(self, libvirt_dom, logpath, stage_patterns, error_patterns):
+        self.log = logging.getLogger('%s.%s' % (__name__,
+                                                self.__class__.__name__))
+        self.libvirt_dom = libvirt_dom
+        self.logpath = logpath
+        self.stage_patterns = [(re.compile(regex), desc) for regex, desc in stage_patterns]
+        self.error_patterns = [(re.compile(regex), desc) for regex, desc in error_patterns]
+        self.stage = None
+        self.error = None
+        self.recent_lines = collections.deque(maxlen=20)
+        self._lock = threading.Lock()
+        self._buf = ''
+        self._logfile = None
+        self._stream = None
+
+    def start(self):
+        """
+        Method to start streaming the console.  Returns True if the console
+        is being streamed, False if it is not available.
+        """
+        if not oz.DomainMonitor.register_event_loop():
+            return False
+
+        self._logfile = open(self.logpath, 'ab')
+        try:
+            self._stream = self.libvirt_dom.connect().newStream(libvirt.VIR_STREAM_NONBLOCK)
+            self.libvirt_dom.openConsole(None, self._stream, 0)
+            self._stream.eventAddCallback(libvirt.VIR_STREAM_EVENT_READABLE | libvirt.VIR_STREAM_EVENT_ERROR | libvirt.VIR_STREAM_EVENT_HANGUP,
+                                          self._stream_event, None)
+        except (AttributeError, libvirt.libvirtError):
+            self.log.debug("Could not open the console of %s",
+                           self.libvirt_dom.name(), exc_info=True)
+            self.close()
+            return False
+
+        return True
+
+    def _stream_event(self, stream, events, opaque):
+        """
+        Internal method called from the libvirt event loop when there is
+        something to read from the console.
+        """
+        done = events & (libvirt.VIR_STREAM_EVENT_ERROR | libvirt.VIR_STREAM_EVENT_HANGUP)
+        if events & libvirt.VIR_STREAM_EVENT_READABLE:
+            while True:
+                try:
+                    data = stream.recv(65536)
+                except libvirt.libvirtError:
+                    done = True
+                    break
+                if data == -2:
+                    # nothing more to read for now
+                    break
+                if not data:
+                    done = True
+                    break
+                self._process(data)
+
+        if done:
+            with self._lock:
+                self._stop_stream()
+
+    def _process(self, data):
+        """
+        Internal method to log a chunk of console output and to match the
+        lines in it.
+        """
+        with self._lock:
+            if self._logfile is None:
+                return
+            self._logfile.write(data)
+            self._logfile.flush()
+
+            lines, self._buf = console_lines(self._buf,
+                                             data.decode('utf-8', 'replace'))
+
+        for line in lines:
+            self.recent_lines.append(line)
+            if self.error is None:
+                for regex, desc in self.error_patterns:
+                    if regex.search(line):
+                        self.log.error("Installer error (%s): %s", desc, line)
+                        self.error = (desc, line)
+                        break
+            for regex, desc in self.stage_patterns:
+                if desc != self.stage and regex.search(line):
+                    self.log.info("Install stage: %s", desc)
+                    self.stage = desc
+                    break
+
+    def failed(self):
+        """
+        Method to find out whether a fatal installer error showed up on the
+        console.
+        """
+        return self.error is not None
+
+    def _stop_stream(self):
+        """
+        Internal method to stop reading the console; the lock must be held.
+        """
+        if self._stream is not None:
+            try:
+                self._stream.eventRemoveCallback()
+            except libvirt.libvirtError:
+                pass
+            try:
+                self._stream.abort()
+            except libvirt.libvirtError:
+                pass
+            self._stream = None
+
+    def close(self):
+        """
+        Method to stop streaming the console and to close the log.
+        """
+        with self._lock:
+            self._stop_stream()
+            if self._logfile is not None:
+                self._logfile.close()
+                self._logfile = None
@@ -63,9 +63,9 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
         if self.debarch == "x86_64":
             self.debarch = "amd64"
 
-        self.kernelfname = os.path.join(self.output_dir,
+        self.kernelfname = os.path.join(self.transient_output_dir,
                                         self.tdl.name + "-kernel")
-        self.initrdfname = os.path.join(self.output_dir,
+        self.initrdfname = os.path.join(self.transient_output_dir,
                                         self.tdl.name + "-ramdisk")
         self.kernelcache = os.path.join(self.data_dir, "kernels",
                                         self.tdl.distro + self.tdl.update + self.tdl.arch + "-kernel")
@@ -77,6 +77,9 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
             extra = "auto=true "
         self.cmdline = "priority=critical " + extra + "locale=en_US"
 
+        self.install_stage_patterns = list(oz.Linux.DI_STAGE_PATTERNS)
+        self.install_error_patterns = list(oz.Linux.DI_ERROR_PATTERNS)
+
         self.reboots = 0
 
     def _copy_preseed(self, outname):
@@ -112,6 +115,8 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
         outdir = os.path.dirname(outname)
         oz.ozutil.mkdir_p(outdir)
         self._copy_preseed(outname)
+        if self.customize_in_install:
+            self._preseed_add_customization(outname, "/cdrom/preseed")
 
         # arch == i386
         installdir = "/install.386"
@@ -124,6 +129,12 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
         if self.tdl.update in ["7", "8"]:
             extra = "auto=true "
 
+        # the console arguments have to go before the "--", since everything
+        # after it is passed to init instead of the kernel
+        console = self._install_console_args()
+        if console:
+            console += " "
+
         with open(isolinuxcfg, 'w') as f:
             f.write("""\
 default customiso
@@ -133,8 +144,8 @@ label customiso
   menu label ^Customiso
   menu default
   kernel %s/vmlinuz
-  append file=/cdrom/preseed/customiso.seed %sdebian-installer/locale=en_US console-setup/layoutcode=us netcfg/choose_interface=auto priority=critical initrd=%s/initrd.gz --
-""" % (installdir, extra, installdir))
+  append file=/cdrom/preseed/customiso.seed %sdebian-installer/locale=en_US console-setup/layoutcode=us netcfg/choose_interface=auto priority=critical %sinitrd=%s/initrd.gz --
+""" % (installdir, extra, console, installdir))
 
     def get_auto_path(self):
         autoname = self.tdl.distro + self.tdl.update + ".auto"
@@ -156,7 +167,8 @@ label customiso
                                            "-cache-inodes", "-boot-info-table",
                                            "-v", "-o", self.output_iso,
                                            self.iso_contents],
-                                          printfn=self.log.debug)
+                                          printfn=self.log.debug,
+                                          max_output=oz.ozutil.MAX_KEPT_OUTPUT)
 
     def install(self, timeout=None, force=False):
         """
@@ -220,6 +232,8 @@ label customiso
         self.log.debug("Removing reportip")
         self._guestfs_remove_if_exists(g_handle, '/root/reportip')
 
+        self._image_ssh_teardown_announce_service(g_handle)
+
         # reset the service link
         self.log.debug("Resetting cron service")
         if self.cron_startuplink:
@@ -266,16 +280,8 @@ label customiso
         self._guestfs_path_backup(g_handle, self.ssh_startuplink)
         g_handle.ln_sf('/etc/init.d/ssh', self.ssh_startuplink)
 
-        sshd_config_file = os.path.join(self.icicle_tmp, "sshd_config")
-        f = open(sshd_config_file, 'w')
-        f.write(self.sshd_config)
-        f.close()
-
-        try:
-            self._guestfs_path_backup(g_handle, '/etc/ssh/sshd_config')
-            g_handle.upload(sshd_config_file, '/etc/ssh/sshd_config')
-        finally:
-            os.unlink(sshd_config_file)
+        self._guestfs_path_backup(g_handle, '/etc/ssh/sshd_config')
+        g_handle.write('/etc/ssh/sshd_config', self.sshd_config)
 
     def _image_ssh_setup_step_3(self, g_handle):
         """
@@ -287,30 +293,21 @@ label customiso
         if not g_handle.exists('/usr/sbin/cron'):
             raise oz.OzException.OzException("cron not installed on the image, cannot continue")
 
-        scriptfile = os.path.join(self.icicle_tmp, "script")
-        f = open(scriptfile, 'w')
-        f.write("#!/bin/bash\n")
-        f.write("/bin/sleep 20\n")
-        f.write("DEV=$(/usr/bin/awk '{if ($2 == 0) print $1}' /proc/net/route) &&\n")
-        f.write('[ -z "$DEV" ] && exit 0\n')
-        f.write("ADDR=$(/sbin/ip -4 -o addr show dev $DEV | /usr/bin/awk '{print $4}' | /usr/bin/cut -d/ -f1) &&\n")
-        f.write('[ -z "$ADDR" ] && exit 0\n')
-        f.write('echo -n "!$ADDR,%s!" > /dev/ttyS1\n' % (self.uuid))
-        f.close()
-        try:
-            g_handle.upload(scriptfile, '/root/reportip')
-            g_handle.chmod(0o755, '/root/reportip')
-        finally:
-            os.unlink(scriptfile)
+        g_handle.write('/root/reportip', """\
+#!/bin/bash
+/bin/sleep 20
+DEV=$(/usr/bin/awk '{if ($2 == 0) print $1}' /proc/net/route) &&
+[ -z "$DEV" ] && exit 0
+ADDR=$(/sbin/ip -4 -o addr show dev $DEV | /usr/bin/awk '{print $4}' | /usr/bin/cut -d/ -f1) &&
+[ -z "$ADDR" ] && exit 0
+echo -n "!$ADDR,%s!" > /dev/ttyS1
+""" % (self.announce_token))
+        g_handle.chmod(0o755, '/root/reportip')
 
-        announcefile = os.path.join(self.icicle_tmp, "announce")
-        f = open(announcefile, 'w')
-        f.write('*/1 * * * * root /bin/bash -c "/root/reportip"\n')
-        f.close()
-        try:
-            g_handle.upload(announcefile, '/etc/cron.d/announce')
-        finally:
-            os.unlink(announcefile)
+        g_handle.write('/etc/cron.d/announce',
+                       '*/1 * * * * root /bin/bash -c "/root/reportip"\n')
+
+        self._image_ssh_setup_announce_service(g_handle)
 
         self.cron_startuplink = self._get_service_runlevel_link(g_handle,
                                                                 'cron')
@@ -330,26 +327,23 @@ label customiso
         # 2)  Make sure sshd is running on boot
         # 3)  Make the guest announce itself to the host
 
+        # the steps only record their changes, which are all made at once at
+        # the end, so a step that fails leaves the disk image untouched
         try:
-            try:
-                self._image_ssh_setup_step_1(g_handle)
-
-                try:
-                    self._image_ssh_setup_step_2(g_handle)
+            batch = self._guestfs_batch(g_handle)
+            self._image_ssh_setup_step_1(batch)
+            self._image_ssh_setup_step_2(batch)
+            self._image_ssh_setup_step_3(batch)
 
-                    try:
-                        self._image_ssh_setup_step_3(g_handle)
-
-                    except:
-                        self._image_ssh_teardown_step_3(g_handle)
-                        raise
-                except:
-                    self._image_ssh_teardown_step_2(g_handle)
-                    raise
+            try:
+                batch.apply()
             except:
-                self._image_ssh_teardown_step_1(g_handle)
+                undo = batch.undo_batch()
+                self._image_ssh_teardown_step_1(undo)
+                self._image_ssh_teardown_step_2(undo)
+                self._image_ssh_teardown_step_3(undo)
+                undo.apply()
                 raise
-
         finally:
             self._guestfs_handle_cleanup(g_handle)
 
@@ -362,13 +356,12 @@ label customiso
         g_handle = self._guestfs_handle_setup(libvirt_xml)
 
         try:
-            self._image_ssh_teardown_step_1(g_handle)
-
-            self._image_ssh_teardown_step_2(g_handle)
-
-            self._image_ssh_teardown_step_3(g_handle)
-
-            self._image_ssh_teardown_step_4(g_handle)
+            batch = self._guestfs_batch(g_handle)
+            self._image_ssh_teardown_step_1(batch)
+            self._image_ssh_teardown_step_2(batch)
+            self._image_ssh_teardown_step_3(batch)
+            self._image_ssh_teardown_step_4(batch)
+            batch.apply()
         finally:
             self._guestfs_handle_cleanup(g_handle)
             shutil.rmtree(self.icicle_tmp)
@@ -404,6 +397,20 @@ label customiso
                 self.log.debug("Asked to gen_and_mod but no mods are present - changing action to gen_only")
                 action = "gen_only"
 
+        # whatever happens below, the disk image is not a plain copy of the
+        # JEOS anymore
+        jeos_copy = self.diskimage_is_jeos
+        self.guest_sshkey = self.sshprivkey
+        self.diskimage_is_jeos = False
+
+        if action == "mod_only" and self._can_customize_offline():
+            # nothing needs a running guest, so don't boot it
+            self._offline_customize(libvirt_xml)
+            return
+
+        if jeos_copy and self.customize_layers and action != "gen_only" and os.access(self.jeos_filename, os.F_OK):
+            return self._layered_customize(libvirt_xml, action)
+
         # when doing an oz-install with -g, this isn't necessary as it will
         # just replace the port with the same port.  However, it is very
         # necessary when doing an oz-customize since the serial port might
@@ -421,16 +428,43 @@ label customiso
                                               image_filename=cow_diskimage)
             modified_xml = self._modify_libvirt_xml_diskimage(modified_xml, cow_diskimage, 'qcow2')
 
-        self._collect_setup(modified_xml)
+        # a guest whose disk image is a copy of the JEOS can be restored from
+        # (or saved to) the memory state of a booted JEOS, which already had
+        # _collect_setup done to it
+        warm = jeos_copy and self.warm_restore and not (action == "gen_only" and self.safe_icicle_gen) and os.access(self.jeos_filename, os.F_OK)
+        warm_state = None
+        libvirt_dom = None
+        if warm:
+            warm_state = self._warm_state_usable()
+        warm_save = warm and warm_state is None
+        if warm_state is not None:
+            try:
+                libvirt_dom = self._warm_restore(modified_xml, warm_state)
+            except oz.OzException.OzException as err:
+                self.log.warning("%s; booting the guest instead", err)
+                warm_state = None
+
+        if libvirt_dom is None:
+            self._collect_setup(modified_xml)
 
         icicle = None
         try:
-            libvirt_dom = self.libvirt_conn.createXML(modified_xml, 0)
+            if libvirt_dom is None:
+                libvirt_dom = self.libvirt_conn.createXML(modified_xml, 0)
 
             try:
                 guestaddr = None
-                guestaddr = self._wait_for_guest_boot(libvirt_dom)
-                self._test_ssh_connection(guestaddr)
+                if warm_state is not None:
+                    guestaddr = self._warm_guest_address(libvirt_dom,
+                                                         warm_state)
+                    self._test_ssh_connection(guestaddr)
+                    self._warm_sync_clock(guestaddr)
+                else:
+                    guestaddr = self._wait_for_guest_boot(libvirt_dom)
+                    self._test_ssh_connection(guestaddr)
+                    if warm_save:
+                        libvirt_dom = self._warm_save(libvirt_dom, guestaddr)
+                self._open_ssh_session(guestaddr)
 
                 if action == "gen_and_mod":
                     self.do_customize(guestaddr)
@@ -449,6 +483,7 @@ label customiso
                     libvirt_dom.destroy()
                 else:
                     self._shutdown_guest(guestaddr, libvirt_dom)
+                self._close_ssh_session()
         finally:
             if action == "gen_only" and self.safe_icicle_gen:
                 # no need to teardown because we simply discard the file
@@ -494,19 +529,47 @@ label customiso
             packstr += package.name + ' '
 
         if packstr != '':
-            self.guest_execute_command(guestaddr,
-                                       'apt-get install -y %s' % (packstr),
-                                       tunnels=None)
+            self._install_packages(guestaddr, packstr)
 
         self._customize_files(guestaddr)
 
         self.log.debug("Running custom commands")
-        for cmd in self.tdl.commands:
-            self.guest_execute_command(guestaddr, cmd.read())
+        self._run_commands(guestaddr, self.tdl.commands, "commands")
 
+        self._finish_customize(guestaddr)
+
+    def _can_customize_in_install(self):
+        """
+        Method to find out whether debian-installer can do the customization
+        in the TDL.
+        """
+        return self._preseed_can_customize()
+
+    def _install_packages(self, guestaddr, packstr):
+        """
+        Method to install packages with apt-get.
+        """
+        self.guest_execute_command(guestaddr,
+                                   'apt-get install -y %s' % (packstr),
+                                   tunnels=None)
+
+    def _finish_customize(self, guestaddr):
+        """
+        Method to do what is left after all of the customization steps.
+        The repositories are kept on Debian.
+        """
         self.log.debug("Syncing")
         self.guest_execute_command(guestaddr, 'sync')
 
+    def _customize_steps(self):
+        """
+        Method to split the customization in the TDL up into steps.  Like
+        do_customize, this leaves out the precommands, which are not
+        supported on Debian.
+        """
+        return [step for step in oz.Linux.LinuxCDGuest._customize_steps(self)
+                if step[0] != 'precommand']
+
     def do_icicle(self, guestaddr):
         """
         Method to collect the package information and generate the ICICLE
@@ -529,14 +592,6 @@ label customiso
 
         return self._output_icicle_xml(packages, self.tdl.description)
 
-    def guest_live_upload(self, guestaddr, file_to_upload, destination,
-                          timeout=10):
-        """
-        Method to copy a file to the live guest.
-        """
-        return oz.ozutil.scp_copy_file(guestaddr, self.sshprivkey,
-                                       file_to_upload, destination, timeout)
-
     def _get_kernel_from_txt_cfg(self, fetchurl):
         """
         Internal method to download and parse the txt.cfg file from a URL.  If
@@ -601,14 +656,17 @@ label customiso
             os.unlink(self.initrdfname)
             raise
 
-    def _create_cpio_initrd(self, preseedpath):
+    def _create_cpio_initrd(self, preseedpath, scriptpath=None):
         """
-        Internal method to create a modified CPIO initrd
+        Internal method to create a modified CPIO initrd, with the
+        customization script at scriptpath if there is one.
         """
         extrafname = os.path.join(self.icicle_tmp, "extra.cpio")
         self.log.debug("Writing cpio to %s" % (extrafname))
         cpiofiledict = {}
         cpiofiledict[preseedpath] = 'preseed.cfg'
+        if scriptpath is not None:
+            cpiofiledict[scriptpath] = 'oz-customize.sh'
         oz.ozutil.write_cpio(cpiofiledict, extrafname)
 
         try:
@@ -658,12 +716,18 @@ label customiso
 
         try:
             preseedpath = os.path.join(self.icicle_tmp, "preseed.cfg")
+            scriptpath = None
             self._copy_preseed(preseedpath)
 
             try:
-                self._create_cpio_initrd(preseedpath)
+                if self.customize_in_install:
+                    scriptpath = self._preseed_add_customization(preseedpath,
+                                                                 "/")
+                self._create_cpio_initrd(preseedpath, scriptpath)
             finally:
                 os.unlink(preseedpath)
+                if scriptpath is not None:
+                    os.unlink(scriptpath)
         except:
             os.unlink(self.kernelfname)
             raise
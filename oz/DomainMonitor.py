@@ -0,0 +1,551 @@
+# Copyright (C) 2014  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Monitoring of the libvirt domains that Oz runs
+"""
+
+import collections
+import threading
+import logging
+import hashlib
+import random
+import time
+import libvirt
+
+_event_loop_lock = threading.Lock()
+_event_loop_thread = None
+
+_monitors_lock = threading.Lock()
+_monitors = {}
+
+_connections_lock = threading.Lock()
+_connections = {}
+
+# consecutive screenshot failures after which the screen of a domain is no
+# longer hashed
+_SCREEN_MAX_FAILURES = 3
+
+def open_connection(uri):
+    """
+    Function to get a libvirt connection to uri.  Connections are shared by
+    all of the guests in a process, so that they can also share a
+    DomainMonitor.  Nothing is shared between processes.  Activity is only
+    sampled while a guest installs, and the oz tools install at most one
+    guest per process, so the batched sampling only pays off for programs
+    that install several guests from one process through the library.
+    """
+    with _connections_lock:
+        conn = _connections.get(uri)
+        if conn is not None:
+            try:
+                if conn.isAlive():
+                    return conn
+            except libvirt.libvirtError:
+                pass
+            _forget_monitor(conn)
+        conn = libvirt.open(uri)
+        _connections[uri] = conn
+        return conn
+
+def register_event_loop():
+    """
+    Function to register the libvirt default event loop implementation and
+    start the thread that runs it.  This has to be called before opening the
+    libvirt connections that lifecycle events are wanted for; calling it more
+    than once is harmless.  Returns True if the event loop is running, False
+    otherwise.
+    """
+    global _event_loop_thread
+
+    with _event_loop_lock:
+        if _event_loop_thread is not None:
+            return True
+
+        try:
+            libvirt.virEventRegisterDefaultImpl()
+        except (AttributeError, libvirt.libvirtError):
+            logging.getLogger(__name__).debug("Could not register the libvirt event loop",
+                                              exc_info=True)
+            return False
+
+        def _run_event_loop():
+            """
+            Function to run the libvirt event loop forever.
+            """
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        _event_loop_thread = threading.Thread(target=_run_event_loop,
+                                              name="oz-libvirt-events")
+        _event_loop_thread.daemon = True
+        _event_loop_thread.start()
+
+        return True
+
+def _activity_from_stats(stats):
+    """
+    Function to compute the total number of disk requests and network bytes
+    from the bulk statistics of a domain.
+    """
+    total_disk_req = 0
+    for i in range(stats.get('block.count', 0)):
+        total_disk_req += stats.get('block.%d.rd.reqs' % (i), 0)
+        total_disk_req += stats.get('block.%d.wr.reqs' % (i), 0)
+
+    total_net_bytes = 0
+    for i in range(stats.get('net.count', 0)):
+        total_net_bytes += stats.get('net.%d.rx.bytes' % (i), 0)
+        total_net_bytes += stats.get('net.%d.tx.bytes' % (i), 0)
+
+    return total_disk_req, total_net_bytes
+
+class DomainWatch(object):
+    """
+    Class representing the interest in the lifecycle of a single domain.  The
+    stopped() method tells whether the domain has gone away, and wait() waits
+    for that to happen (by asking libvirt, if the watch is polling because
+    there are no lifecycle events).  If the watch is sampling, next_sample()
+    hands out the disk and network activity of the domain as it is sampled
+    by the monitor.  If the watch has a screen_interval, the monitor hashes
+    a screenshot of the domain that often, and screen_static_for() tells
+    how long the screen has not changed.
+    """
+    def __init__(self, libvirt_dom, monitor=None):
+        self.libvirt_dom = libvirt_dom
+        self.monitor = monitor
+        self.uuid = libvirt_dom.UUIDString()
+        self.stop_detail = None
+        self.polling = False
+        self.sampling = False
+        self.screen_interval = 0
+        self._stopped_event = threading.Event()
+        self._sample_cond = threading.Condition()
+        self._sample = None
+        self._sample_seq = 0
+        self._consumed_seq = 0
+        # a few of the most recent screens, so that a blinking cursor does
+        # not count as a change
+        self._screen_hashes = collections.deque(maxlen=4)
+        self._screen_changed = None
+        self._screen_failures = 0
+        self._next_screen = 0
+
+    def _mark_stopped(self, detail):
+        """
+        Internal method called when the domain has stopped.
+        """
+        self.stop_detail = detail
+        self._stopped_event.set()
+        with self._sample_cond:
+            self._sample_cond.notify_all()
+
+    def _add_sample(self, sample):
+        """
+        Internal method called by the monitor with a new activity sample; the
+        sample is None if the domain could not be sampled.
+        """
+        with self._sample_cond:
+            self._sample = sample
+            self._sample_seq += 1
+            self._sample_cond.notify_all()
+
+    def _stop_sampling(self):
+        """
+        Internal method called by the monitor if it cannot sample anymore.
+        """
+        with self._sample_cond:
+            self.sampling = False
+            self._sample_cond.notify_all()
+
+    def next_sample(self, timeout):
+        """
+        Method to wait up to timeout seconds for an activity sample newer than
+        the one returned last time.  The samples are taken about once a
+        second, so this also paces the caller.  Returns a tuple of the total
+        number of disk requests and network bytes of the domain, or None if
+        there is no new sample (because the domain stopped, the sampling
+        failed or the timeout expired).
+        """
+        end = time.time() + timeout
+        with self._sample_cond:
+            while self.sampling and not self.stopped() and self._sample_seq == self._consumed_seq:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return None
+                self._sample_cond.wait(remaining)
+
+            if self._sample_seq == self._consumed_seq:
+                return None
+            self._consumed_seq = self._sample_seq
+            return self._sample
+
+    def _add_screen_hash(self, digest, now):
+        """
+        Internal method called by the monitor with the hash of a new
+        screenshot of the domain.
+        """
+        if digest not in self._screen_hashes:
+            self._screen_changed = now
+            self._screen_hashes.append(digest)
+
+    def _stop_screen(self):
+        """
+        Internal method called by the monitor if it cannot take screenshots
+        of the domain anymore.
+        """
+        self.screen_interval = 0
+        self._screen_changed = None
+
+    def screen_static_for(self):
+        """
+        Method to find out for how many seconds the screen of the domain has
+        not changed.  Returns 0 if the screen is not being hashed (yet).
+        """
+        if self._screen_changed is None:
+            return 0
+        return time.time() - self._screen_changed
+
+    def _check_stopped(self):
+        """
+        Internal method to find out whether the domain is still there.
+        """
+        try:
+            if not self.libvirt_dom.isActive():
+                self._mark_stopped(None)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                self._mark_stopped(None)
+
+    def stopped(self):
+        """
+        Method to find out whether the domain has stopped.
+        """
+        return self._stopped_event.is_set()
+
+    def wait(self, timeout):
+        """
+        Method to wait up to timeout seconds for the domain to stop.  Returns
+        True if the domain has stopped, False otherwise.
+        """
+        if self.polling:
+            # there are no lifecycle events; ask libvirt instead
+            if not self.stopped():
+                time.sleep(timeout)
+                self._check_stopped()
+            return self.stopped()
+
+        self._stopped_event.wait(timeout)
+        return self._stopped_event.is_set()
+
+    def close(self):
+        """
+        Method to stop watching the domain.
+        """
+        if self.monitor is not None:
+            self.monitor._unwatch(self)
+
+class PollingDomainWatch(DomainWatch):
+    """
+    Class to watch a domain when lifecycle events are not available; it falls
+    back to asking libvirt about the domain every time it is waited on.
+    """
+    def __init__(self, libvirt_dom, monitor=None):
+        DomainWatch.__init__(self, libvirt_dom, monitor)
+        self.polling = True
+
+class DomainMonitor(object):
+    """
+    Class to watch the lifecycle of the domains on a libvirt connection.  A
+    single lifecycle event callback is registered for the whole connection,
+    and the events are dispatched to the DomainWatch objects of the domains
+    that are being watched, so one monitor serves all of the guests in a
+    process (but only those; see open_connection()).
+    """
+    def __init__(self, libvirt_conn):
+        self.log = logging.getLogger('%s.%s' % (__name__,
+                                                self.__class__.__name__))
+        self.libvirt_conn = libvirt_conn
+        self._lock = threading.Lock()
+        self._watches = {}
+        self._callback_id = libvirt_conn.domainEventRegisterAny(None,
+                                                               libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                                               self._lifecycle_event,
+                                                               None)
+        self._bulk_stats = hasattr(libvirt_conn, 'domainListGetStats')
+        self._sampler_thread = None
+        self._sampler_wakeup = threading.Event()
+        self._closed = False
+
+    def _lifecycle_event(self, conn, dom, event, detail, opaque):
+        """
+        Internal method called from the libvirt event loop whenever the state
+        of a domain on the connection changes.
+        """
+        if event != libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            return
+
+        with self._lock:
+            watches = self._watches.get(dom.UUIDString(), [])[:]
+
+        for watch in watches:
+            self.log.debug("Domain %s stopped (detail %d)", dom.name(), detail)
+            watch._mark_stopped(detail)
+
+    def watch(self, libvirt_dom, sample_activity=False, screen_interval=0):
+        """
+        Method to start watching the lifecycle of libvirt_dom.  If
+        sample_activity is True, the disk and network activity of the domain
+        is sampled as well, together with that of all of the other sampled
+        domains on the connection.  If screen_interval is not 0, a screenshot
+        of the domain is hashed every screen_interval seconds.  Returns a
+        DomainWatch object, which must be closed once the caller is done
+        with it.
+        """
+        watch = DomainWatch(libvirt_dom, self)
+
+        with self._lock:
+            watch.sampling = sample_activity and self._bulk_stats
+            watch.screen_interval = screen_interval
+            # spread the screenshots of the domains over the interval
+            watch._next_screen = time.time() + random.uniform(0, screen_interval)
+            self._watches.setdefault(watch.uuid, []).append(watch)
+            if watch.sampling or watch.screen_interval:
+                if self._sampler_thread is None:
+                    self._sampler_thread = threading.Thread(target=self._sample_activity,
+                                                            name="oz-domain-stats")
+                    self._sampler_thread.daemon = True
+                    self._sampler_thread.start()
+                self._sampler_wakeup.set()
+
+        # the domain might have stopped before we started to watch it, in
+        # which case there will never be an event for it
+        watch._check_stopped()
+
+        return watch
+
+    def _sampled_watches(self):
+        """
+        Internal method to get the lists of watches that want activity
+        samples and screen hashes.
+        """
+        with self._lock:
+            watches = [watch for watches in self._watches.values() for watch in watches]
+        return [watch for watch in watches if watch.sampling], [watch for watch in watches if watch.screen_interval]
+
+    def _sample_activity(self):
+        """
+        Internal method running in the sampler thread.  About once a second,
+        it fetches the block and interface statistics of all sampled domains
+        with a single domainListGetStats() call, and hands them out to the
+        watches; it also hashes the screens of the domains that are due.
+        Other processes talking to the same libvirtd make calls of their
+        own.
+        """
+        while not self._closed:
+            stats_watches, screen_watches = self._sampled_watches()
+            if not stats_watches and not screen_watches:
+                # nothing to do until somebody wants samples again
+                self._sampler_wakeup.wait()
+                self._sampler_wakeup.clear()
+                continue
+
+            start = time.time()
+
+            if stats_watches:
+                self._sample_stats(stats_watches)
+
+            for watch in screen_watches:
+                if watch._next_screen <= start:
+                    self._hash_screen(watch)
+                    watch._next_screen = start + watch.screen_interval
+
+            elapsed = time.time() - start
+            if elapsed < 1:
+                time.sleep(1 - elapsed)
+
+    def _hash_screen(self, watch):
+        """
+        Internal method to take a screenshot of the domain of watch and hand
+        its hash to the watch.  The screenshot is only hashed, never stored.
+        """
+        digest = hashlib.sha1()
+
+        def _sink(stream, buf, opaque):
+            """
+            Function that is called back from the libvirt stream.
+            """
+            opaque.update(buf)
+            return len(buf)
+
+        try:
+            st = self.libvirt_conn.newStream(0)
+            watch.libvirt_dom.screenshot(st, 0, 0)
+            st.recvAll(_sink, digest)
+            st.finish()
+        except libvirt.libvirtError as e:
+            watch._screen_failures += 1
+            if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN or watch._screen_failures >= _SCREEN_MAX_FAILURES:
+                # the domain is gone or has no screen; either way, there is
+                # no point in trying again
+                self.log.debug("Failed to take a screenshot of %s, giving up",
+                               watch.uuid, exc_info=True)
+                watch._stop_screen()
+            else:
+                self.log.debug("Failed to take a screenshot of %s, retrying",
+                               watch.uuid, exc_info=True)
+            return
+
+        watch._screen_failures = 0
+        watch._add_screen_hash(digest.hexdigest(), time.time())
+
+    def _sample_stats(self, watches):
+        """
+        Internal method to fetch the block and interface statistics of the
+        domains of watches in one go, and to hand them out to the watches.
+        """
+        doms = {}
+        for watch in watches:
+            doms[watch.uuid] = watch.libvirt_dom
+
+        try:
+            stats = self.libvirt_conn.domainListGetStats(list(doms.values()),
+                                                         libvirt.VIR_DOMAIN_STATS_BLOCK | libvirt.VIR_DOMAIN_STATS_INTERFACE,
+                                                         0)
+        except (AttributeError, libvirt.libvirtError) as e:
+            if isinstance(e, AttributeError) or e.get_error_code() == libvirt.VIR_ERR_NO_SUPPORT:
+                # this version of libvirt cannot do bulk statistics; make
+                # the watches fall back to sampling on their own
+                self.log.debug("Bulk domain statistics are not available",
+                               exc_info=True)
+                with self._lock:
+                    self._bulk_stats = False
+                for watch in watches:
+                    watch._stop_sampling()
+                return
+            # most likely one of the domains went away in the meantime;
+            # this round, the watches have to sample on their own
+            self.log.debug("Failed to get bulk domain statistics",
+                           exc_info=True)
+            stats = []
+
+        samples = {}
+        for dom, domstats in stats:
+            samples[dom.UUIDString()] = _activity_from_stats(domstats)
+
+        # domains that went away are missing from the statistics; they get
+        # a None sample
+        for watch in watches:
+            watch._add_sample(samples.get(watch.uuid))
+
+    def _unwatch(self, watch):
+        """
+        Internal method to stop watching a domain.
+        """
+        with self._lock:
+            watches = self._watches.get(watch.uuid, [])
+            if watch in watches:
+                watches.remove(watch)
+            if not watches:
+                self._watches.pop(watch.uuid, None)
+
+    def close(self):
+        """
+        Method to stop the monitor, once its connection is gone.  The
+        watches that are still open get no more events or samples, so they
+        are told to stop sampling and to poll instead.
+        """
+        with self._lock:
+            self._closed = True
+            watches = [watch for watches in self._watches.values() for watch in watches]
+        self._sampler_wakeup.set()
+
+        try:
+            self.libvirt_conn.domainEventDeregisterAny(self._callback_id)
+        except libvirt.libvirtError:
+            pass
+
+        for watch in watches:
+            watch.polling = True
+            watch._stop_sampling()
+            watch._stop_screen()
+            watch._check_stopped()
+
+def _forget_monitor(libvirt_conn):
+    """
+    Function to close and forget the DomainMonitor of libvirt_conn (if it
+    has one), once the connection is gone.
+    """
+    with _monitors_lock:
+        monitor = _monitors.pop(libvirt_conn, None)
+    if monitor is not None:
+        monitor.close()
+
+def _connection_closed(libvirt_conn, reason, opaque):
+    """
+    Function called back by libvirt when a connection is closed, for
+    instance because libvirtd went away.  The connection is not handed out
+    again, and its monitor is dropped.
+    """
+    logging.getLogger(__name__).debug("libvirt connection closed (reason %d)",
+                                      reason)
+    with _connections_lock:
+        for uri, conn in list(_connections.items()):
+            if conn is libvirt_conn:
+                del _connections[uri]
+    _forget_monitor(libvirt_conn)
+
+def get_monitor(libvirt_conn):
+    """
+    Function to get the DomainMonitor for libvirt_conn, creating it if
+    necessary.  Returns None if lifecycle events are not available on the
+    connection.
+    """
+    if _event_loop_thread is None:
+        return None
+
+    with _monitors_lock:
+        if libvirt_conn not in _monitors:
+            try:
+                _monitors[libvirt_conn] = DomainMonitor(libvirt_conn)
+            except libvirt.libvirtError:
+                logging.getLogger(__name__).debug("Could not register for domain lifecycle events",
+                                                  exc_info=True)
+                _monitors[libvirt_conn] = None
+            try:
+                libvirt_conn.registerCloseCallback(_connection_closed, None)
+            except (AttributeError, libvirt.libvirtError):
+                # without the callback, the monitor is only dropped when
+                # open_connection() finds the connection dead
+                logging.getLogger(__name__).debug("Could not register a close callback",
+                                                  exc_info=True)
+        return _monitors[libvirt_conn]
+
+def watch_domain(libvirt_conn, libvirt_dom, sample_activity=False,
+                 screen_interval=0):
+    """
+    Function to start watching the lifecycle of libvirt_dom, which lives on
+    libvirt_conn.  If lifecycle events are not available, the returned watch
+    polls libvirt instead (and neither samples activity nor hashes the
+    screen).
+    """
+    monitor = get_monitor(libvirt_conn)
+    if monitor is None:
+        watch = PollingDomainWatch(libvirt_dom)
+        watch._check_stopped()
+        return watch
+
+    return monitor.watch(libvirt_dom, sample_activity, screen_interval)
@@ -45,7 +45,8 @@ class FreeBSD(oz.Guest.CDGuest):
                                            "-b", "boot/cdboot", "-v",
                                            "-o", self.output_iso,
                                            self.iso_contents],
-                                          printfn=self.log.debug)
+                                          printfn=self.log.debug,
+                                          max_output=oz.ozutil.MAX_KEPT_OUTPUT)
 
     def _modify_iso(self):
         """
@@ -34,7 +34,6 @@ import stat
 import lxml.etree
 import logging
 import random
-import guestfs
 import socket
 import struct
 import tempfile
@@ -42,10 +41,37 @@ import M2Crypto
 import base64
 import hashlib
 import errno
-import re
+import multiprocessing
+import collections
+import threading
 
 import oz.ozutil
 import oz.OzException
+import oz.DomainMonitor
+import oz.GuestfsManager
+import oz.GuestfsBatch
+import oz.ConsoleMonitor
+import oz.SocketMonitor
+
+# libvirt storage pools are started and destroyed around the creation of
+# each disk image; guests customized in parallel threads (oz-customize -b)
+# must not destroy a pool another one is still using
+_storage_pool_lock = threading.Lock()
+
+_listen_ports_lock = threading.Lock()
+_listen_ports = set()
+
+def _allocate_listen_port():
+    """
+    Function to pick a random port for the serial port of a guest to listen
+    on, distinct from the ports of all of the other guests in this process.
+    """
+    with _listen_ports_lock:
+        while True:
+            port = random.randrange(1024, 65535)
+            if port not in _listen_ports:
+                _listen_ports.add(port)
+                return port
 
 class Guest(object):
     """
@@ -120,7 +146,12 @@ class Guest(object):
             pass
 
         libvirt.registerErrorHandler(_libvirt_error_handler, 'context')
-        self.libvirt_conn = libvirt.open(self.libvirt_uri)
+        # the event loop has to be in place before the connection is opened
+        # to get domain lifecycle events on it
+        oz.DomainMonitor.register_event_loop()
+        # the connection is shared with the other guests in this process, so
+        # that the activity of all of their domains can be sampled at once
+        self.libvirt_conn = oz.DomainMonitor.open_connection(self.libvirt_uri)
         self._discover_libvirt_bridge()
         self._discover_libvirt_type()
 
@@ -140,6 +171,10 @@ class Guest(object):
         self.log = logging.getLogger('%s.%s' % (__name__,
                                                 self.__class__.__name__))
         self.uuid = uuid.uuid4()
+        # the token the guest announces itself with once it has booted; a
+        # guest started from a saved state announces itself with the token
+        # of the guest that was set up
+        self.announce_token = str(self.uuid)
         self.macaddr = macaddress
         if macaddress is None:
             self.macaddr = oz.ozutil.generate_macaddress()
@@ -159,10 +194,44 @@ class Guest(object):
                                                         'screenshot_dir',
                                                         oz.ozutil.default_screenshot_dir())
 
+        self.console_log_dir = oz.ozutil.config_get_path(config, 'paths',
+                                                         'console_log_dir',
+                                                         oz.ozutil.default_console_log_dir())
+
         self.sshprivkey = oz.ozutil.config_get_path(config, 'paths',
                                                     'sshprivkey',
                                                     oz.ozutil.default_sshprivkey())
 
+        self.guestfs_cache_dir = oz.ozutil.config_get_path(config, 'paths',
+                                                           'guestfs_cache_dir',
+                                                           oz.ozutil.default_guestfs_cache_dir())
+
+        # configuration from 'scratch' section
+        self.scratch_dir = None
+        scratch_budget = int(oz.ozutil.config_get_key(config, 'scratch',
+                                                      'budget', 4096)) * 1024 * 1024
+        scratch_install_disk = oz.ozutil.config_get_boolean_key(config,
+                                                                'scratch',
+                                                                'install_disk',
+                                                                False)
+        if oz.ozutil.config_get_key(config, 'scratch', 'dir', None) is not None:
+            scratch_dir = oz.ozutil.config_get_path(config, 'scratch', 'dir',
+                                                    None)
+            oz.ozutil.mkdir_p(scratch_dir)
+            if oz.ozutil.scratch_space_available(scratch_dir, scratch_budget):
+                self.scratch_dir = scratch_dir
+            else:
+                self.log.warning("Not enough memory for the scratch area at %s, using %s instead", scratch_dir, self.data_dir)
+
+        # transient build artifacts (exploded and generated install media,
+        # the ICICLE temporary directory, and so on) go to the scratch area
+        # if one is available
+        self.transient_data_dir = self.data_dir
+        self.transient_output_dir = self.output_dir
+        if self.scratch_dir is not None:
+            self.transient_data_dir = self.scratch_dir
+            self.transient_output_dir = self.scratch_dir
+
         # configuration from 'libvirt' section
         self.libvirt_uri = oz.ozutil.config_get_key(config, 'libvirt', 'uri',
                                                     'qemu:///system')
@@ -170,6 +239,8 @@ class Guest(object):
                                                      None)
         self.bridge_name = oz.ozutil.config_get_key(config, 'libvirt',
                                                     'bridge_name', None)
+        config_has_cpus = oz.ozutil.config_get_key(config, 'libvirt', 'cpus',
+                                                   None) is not None
         self.install_cpus = oz.ozutil.config_get_key(config, 'libvirt', 'cpus',
                                                      1)
         # the memory in the configuration file is specified in megabytes, but
@@ -183,6 +254,20 @@ class Guest(object):
                                                            'memory', 1024)) * 1024
         self.image_type = oz.ozutil.config_get_key(config, 'libvirt',
                                                    'image_type', 'raw')
+        # the install profile from the TDL takes precedence over the one in
+        # the configuration file
+        self.install_profile = self.tdl.install_profile
+        if self.install_profile is None:
+            self.install_profile = oz.ozutil.config_get_key(config, 'libvirt',
+                                                            'install_profile',
+                                                            'default')
+        if self.install_profile not in ["default", "performance"]:
+            raise oz.OzException.OzException("Unknown install profile " + self.install_profile)
+        # the performance profile gives the installer more vCPUs, unless the
+        # user explicitly asked for a number
+        self.install_profile_cpus = self.install_cpus
+        if self.install_profile == "performance" and not config_has_cpus:
+            self.install_profile_cpus = min(4, multiprocessing.cpu_count())
 
         # configuration from 'cache' section
         self.cache_original_media = oz.ozutil.config_get_boolean_key(config,
@@ -195,8 +280,101 @@ class Guest(object):
                                                                      False)
         self.cache_jeos = oz.ozutil.config_get_boolean_key(config, 'cache',
                                                            'jeos', False)
+        self.customize_layers = oz.ozutil.config_get_boolean_key(config,
+                                                                 'cache',
+                                                                 'customize_layers',
+                                                                 False)
 
         self.jeos_cache_dir = os.path.join(self.data_dir, "jeos")
+        self.layer_cache_dir = os.path.join(self.data_dir, "layers")
+        # whether the snapshots of the layers can be quiesced through the
+        # guest agent; None until it is tried
+        self.layer_quiesce = None
+
+        # configuration from 'io' section; the buffer size in the
+        # configuration file is specified in kilobytes
+        self.io_buffer_size = int(oz.ozutil.config_get_key(config, 'io',
+                                                           'buffer_size',
+                                                           1024)) * 1024
+        self.io_drop_cache = oz.ozutil.config_get_boolean_key(config, 'io',
+                                                              'drop_cache',
+                                                              False)
+        self.io_direct = oz.ozutil.config_get_boolean_key(config, 'io',
+                                                          'direct', False)
+
+        # configuration from 'console' section
+        self.console_redirect = oz.ozutil.config_get_boolean_key(config,
+                                                                 'console',
+                                                                 'redirect',
+                                                                 False)
+        self.console_fail_fast = oz.ozutil.config_get_boolean_key(config,
+                                                                  'console',
+                                                                  'fail_fast',
+                                                                  True)
+
+        # configuration from 'screen' section; a hang_window of 0 disables
+        # the hang detection
+        self.screen_hang_window = int(oz.ozutil.config_get_key(config,
+                                                               'screen',
+                                                               'hang_window',
+                                                               0))
+        self.screen_interval = int(oz.ozutil.config_get_key(config, 'screen',
+                                                            'interval', 10))
+        self.screen_max_disk_rate = float(oz.ozutil.config_get_key(config,
+                                                                   'screen',
+                                                                   'max_disk_rate',
+                                                                   20))
+        self.screen_max_network_rate = float(oz.ozutil.config_get_key(config,
+                                                                      'screen',
+                                                                      'max_network_rate',
+                                                                      16384))
+        if self.screen_hang_window < 0:
+            raise oz.OzException.OzException("The screen hang_window must not be negative")
+        if self.screen_hang_window:
+            if self.screen_interval < 1 or self.screen_interval >= self.screen_hang_window:
+                raise oz.OzException.OzException("The screen interval must be at least 1 second and shorter than the hang_window")
+            if self.console_redirect:
+                # the installer talks to the serial console then, so the
+                # screen stays the same no matter how the install is doing
+                raise oz.OzException.OzException("The screen hang_window cannot be used when the console is redirected")
+
+        # configuration from 'guestfs' section; the appliances are shared by
+        # all of the guests in this process
+        guestfs_keep_warm = oz.ozutil.config_get_boolean_key(config, 'guestfs',
+                                                             'keep_warm', True)
+        self.guestfs_manager = oz.GuestfsManager.get_guestfs_manager(self.guestfs_cache_dir,
+                                                                     guestfs_keep_warm)
+
+        # configuration from 'customize' section
+        self.batch_commands = oz.ozutil.config_get_boolean_key(config,
+                                                               'customize',
+                                                               'batch_commands',
+                                                               False)
+        self.offline_customize = oz.ozutil.config_get_boolean_key(config,
+                                                                  'customize',
+                                                                  'offline',
+                                                                  True)
+        self.warm_restore = oz.ozutil.config_get_boolean_key(config,
+                                                             'customize',
+                                                             'warm_restore',
+                                                             False)
+        self.install_time_customize = oz.ozutil.config_get_boolean_key(config,
+                                                                       'customize',
+                                                                       'install_time',
+                                                                       False)
+        # True when the install media carry the customization in the TDL
+        self.customize_in_install = False
+        # True once an install did the customization in the TDL
+        self.customized_at_install = False
+
+        # the serial console of all of the install phases goes to one log
+        self.install_console_log = os.path.join(self.console_log_dir,
+                                                self.tdl.name + "-" + str(self.uuid) + ".log")
+        # lists of (regular expression, description) tuples that recognize
+        # the install stages and the fatal installer errors on the console;
+        # subclasses fill these in for their installers
+        self.install_stage_patterns = []
+        self.install_error_patterns = []
 
         # configuration of "safe" ICICLE generation option
         self.safe_icicle_gen = oz.ozutil.config_get_boolean_key(config,
@@ -212,6 +390,10 @@ class Guest(object):
 
         self.jeos_filename = os.path.join(self.jeos_cache_dir,
                                           self.tdl.distro + self.tdl.update + self.tdl.arch + '.' + jeos_extension)
+        # the saved memory state of a booted JEOS, for warm restores
+        self.warm_state_dir = self.jeos_filename + ".warm"
+        # True as long as the disk image is an unmodified copy of the JEOS
+        self.diskimage_is_jeos = False
 
         self.diskimage = output_disk
         if self.diskimage is None:
@@ -224,9 +406,12 @@ class Guest(object):
         if not os.path.isabs(self.diskimage):
             raise oz.OzException.OzException("Output disk image must be an absolute path")
 
-        self.icicle_tmp = os.path.join(self.data_dir, "icicletmp",
+        self.icicle_tmp = os.path.join(self.transient_data_dir, "icicletmp",
                                        self.tdl.name)
-        self.listen_port = random.randrange(1024, 65535)
+        self.listen_port = _allocate_listen_port()
+        # the libvirt network behind the bridge, used to look up the DHCP
+        # lease of the guest; False if there is none
+        self.dhcp_network = None
 
         self.connect_to_libvirt()
 
@@ -252,15 +437,27 @@ class Guest(object):
         if self.rootpw is None:
             self.rootpw = "ozrootpw"
 
-        try:
-            # PPC64 directory structure differs from x86; disabling ISO boots
-            if self.tdl.arch not in ["ppc64", "ppc64le"]:
-                self.url = self._check_url(iso=iso_allowed, url=url_allowed)
+        # configuration from 'install' section; checking the install URL can
+        # mean probing it over the network, which is only worth it for guests
+        # that are going to be installed
+        check_url = oz.ozutil.config_get_boolean_key(config, 'install',
+                                                     'check_url', True)
+        if not check_url:
+            if self.tdl.installtype == 'iso':
+                self.url = self.tdl.iso
             else:
-                self.url = self._check_url(iso=False, url=url_allowed)
-        except:
-            self.log.debug("Install URL validation failed:", exc_info=True)
-            raise
+                self.url = self.tdl.url
+        else:
+            try:
+                # PPC64 directory structure differs from x86; disabling ISO
+                # boots
+                if self.tdl.arch not in ["ppc64", "ppc64le"]:
+                    self.url = self._check_url(iso=iso_allowed, url=url_allowed)
+                else:
+                    self.url = self._check_url(iso=False, url=url_allowed)
+            except:
+                self.log.debug("Install URL validation failed:", exc_info=True)
+                raise
 
         oz.ozutil.mkdir_p(self.icicle_tmp)
 
@@ -268,6 +465,19 @@ class Guest(object):
         if self.tdl.disksize is not None:
             self.disksize = int(self.tdl.disksize)
 
+        # the disk image can also be installed to in the scratch area; it is
+        # moved to its final location once the install succeeds.  The scratch
+        # area is shared by all builds, so the name of the image there is
+        # derived from the full path of the final disk image
+        self.install_diskimage = self.diskimage
+        if self.scratch_dir is not None and scratch_install_disk:
+            if self.disksize * 1024 * 1024 * 1024 <= scratch_budget:
+                pathhash = hashlib.sha1(os.path.realpath(self.diskimage).encode('utf-8')).hexdigest()[:16]
+                self.install_diskimage = os.path.join(self.scratch_dir,
+                                                      "%s-%s" % (pathhash, os.path.basename(self.diskimage)))
+            else:
+                self.log.warning("Disk image of %dGB does not fit in the scratch area, installing to %s", self.disksize, self.diskimage)
+
         self.auto = auto
         if self.auto is None:
             self.auto = self.get_auto_path()
@@ -278,6 +488,8 @@ class Guest(object):
         self.log.debug("nicmodel: %s, clockoffset: %s", self.nicmodel, self.clockoffset)
         self.log.debug("mousetype: %s, disk_bus: %s, disk_dev: %s", self.mousetype, self.disk_bus, self.disk_dev)
         self.log.debug("icicletmp: %s, listen_port: %d", self.icicle_tmp, self.listen_port)
+        self.log.debug("scratch_dir: %s, install_diskimage: %s", self.scratch_dir, self.install_diskimage)
+        self.log.debug("install_profile: %s, install_profile_cpus: %s", self.install_profile, self.install_profile_cpus)
 
     def image_name(self):
         """
@@ -322,11 +534,12 @@ class Guest(object):
         except libvirt.libvirtError:
             pass
 
-        try:
-            os.unlink(self.diskimage)
-        except OSError as err:
-            if err.errno != errno.ENOENT:
-                raise
+        for diskimage in set([self.diskimage, self.install_diskimage]):
+            try:
+                os.unlink(diskimage)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
 
     def check_for_guest_conflict(self):
         """
@@ -351,6 +564,35 @@ class Guest(object):
         if os.access(self.diskimage, os.F_OK):
             raise oz.OzException.OzException("Diskimage %s already exists" % (self.diskimage))
 
+        if self.install_diskimage != self.diskimage and os.access(self.install_diskimage, os.F_OK):
+            raise oz.OzException.OzException("Diskimage %s already exists in the scratch area" % (self.install_diskimage))
+
+    def request_install_customization(self):
+        """
+        Method to ask for the customization in the TDL to be done by the
+        installer, which saves booting the installed guest to customize it.
+        It has to be called before generate_install_media(), and only has an
+        effect if install_time is enabled in the customize section of the
+        configuration and the installer of the guest can do the whole
+        customization.  Returns True if the install media will carry the
+        customization; customize() then skips it.
+        """
+        self.customize_in_install = False
+        if not self.tdl.packages and not self.tdl.files and not self.tdl.commands:
+            return False
+        if self.install_time_customize and self._can_customize_in_install():
+            self.log.debug("Customizing %s during the install", self.tdl.name)
+            self.customize_in_install = True
+        return self.customize_in_install
+
+    def _can_customize_in_install(self):
+        """
+        Internal method to find out whether the installer can do the
+        customization in the TDL; expected to be overridden by subclasses
+        that support it.
+        """
+        return False
+
     # the next 4 methods are intended to be overridden by the individual
     # OS backends; raise an error if they are called but not implemented
 
@@ -377,6 +619,14 @@ class Guest(object):
         """
         raise oz.OzException.OzException("ICICLE generation for %s%s is not implemented" % (self.tdl.distro, self.tdl.update))
 
+    def generate_icicle_offline(self, libvirt_xml):
+        """
+        Base method for generating the ICICLE manifest straight from the disk
+        image, without booting the operating system.  This is expected to be
+        overridden by subclasses that support offline ICICLE generation.
+        """
+        raise oz.OzException.OzException("Offline ICICLE generation for %s%s is not implemented" % (self.tdl.distro, self.tdl.update))
+
     # this method is intended to be an optimization if the user wants to do
     # both customize and generate_icicle
     def customize_and_generate_icicle(self, libvirt_xml):
@@ -421,12 +671,20 @@ class Guest(object):
         self.lxml_subelement(serial, "target", None, {'port':'1'})
 
     def _generate_xml(self, bootdev, installdev, kernel=None, initrd=None,
-                      cmdline=None):
+                      cmdline=None, install=False):
         """
-        Method to generate libvirt XML useful for installation.
+        Method to generate libvirt XML useful for installation.  If install is
+        True, the XML is for a domain that is running the installer, and the
+        settings of the install profile are applied to it; the XML that is
+        handed back to the user never has them.
         """
         self.log.info("Generate XML for guest %s with bootdev %s", self.tdl.name, bootdev)
 
+        performance = install and self.install_profile == "performance"
+        cpus = self.install_cpus
+        if performance:
+            cpus = self.install_profile_cpus
+
         # top-level domain element
         domain = lxml.etree.Element("domain", type=self.libvirt_type)
         # name element
@@ -439,7 +697,7 @@ class Guest(object):
         # clock offset
         self.lxml_subelement(domain, "clock", None, {'offset':self.clockoffset})
         # vcpu
-        self.lxml_subelement(domain, "vcpu", str(self.install_cpus))
+        self.lxml_subelement(domain, "vcpu", str(cpus))
         # features
         features = self.lxml_subelement(domain, "features")
         self.lxml_subelement(features, "acpi")
@@ -450,6 +708,10 @@ class Guest(object):
             # Possibly related to BZ 1171501 - need host passthrough for aarch64 and arm with kvm
             cpu = self.lxml_subelement(domain, "cpu", None, { 'mode': 'custom', 'match': 'exact' })
             model = self.lxml_subelement(cpu, "model", "host", { 'fallback': 'allow' })
+        elif performance and self.libvirt_type == "kvm":
+            # the installer is never migrated, so it can use all of the host
+            # CPU features
+            self.lxml_subelement(domain, "cpu", None, {'mode':'host-passthrough'})
         # os
         osNode = self.lxml_subelement(domain, "os")
         mods = None
@@ -465,6 +727,8 @@ class Guest(object):
         if cmdline:
             if self.tdl.arch == "armv7l":
                 cmdline += " console=ttyAMA0"
+            if install and self._install_console_args():
+                cmdline += " " + self._install_console_args()
             self.lxml_subelement(osNode, "cmdline", cmdline)
         # poweroff, reboot, crash
         self.lxml_subelement(domain, "on_poweroff", "destroy")
@@ -481,6 +745,10 @@ class Guest(object):
         self.lxml_subelement(interface, "source", None, {'bridge':self.bridge_name})
         self.lxml_subelement(interface, "mac", None, {'address':self.macaddr})
         self.lxml_subelement(interface, "model", None, {'type':self.nicmodel})
+        if performance and self.nicmodel == "virtio" and int(cpus) > 1:
+            # multiqueue is only available with vhost-net and virtio
+            self.lxml_subelement(interface, "driver", None,
+                                 {'name':'vhost', 'queues':str(cpus)})
         # input
         mousedict = {'bus':self.mousetype}
         if self.mousetype == "ps2":
@@ -496,8 +764,20 @@ class Guest(object):
         # boot disk
         bootDisk = self.lxml_subelement(devices, "disk", None, {'device':'disk', 'type':'file'})
         self.lxml_subelement(bootDisk, "target", None, {'dev':self.disk_dev, 'bus':self.disk_bus})
-        self.lxml_subelement(bootDisk, "source", None, {'file':self.diskimage})
-        self.lxml_subelement(bootDisk, "driver", None, {'name':'qemu', 'type':self.image_type})
+        diskimage = self.diskimage
+        if install:
+            diskimage = self.install_diskimage
+        self.lxml_subelement(bootDisk, "source", None, {'file':diskimage})
+        driver = {'name':'qemu', 'type':self.image_type}
+        if performance:
+            # the disk image is thrown away if the install fails, so it is
+            # safe to ignore flush requests from the guest.  The image is
+            # synced to stable storage once the install has finished; see
+            # _finish_install_disk()
+            driver['cache'] = 'unsafe'
+            driver['io'] = 'threads'
+            driver['discard'] = 'unmap'
+        self.lxml_subelement(bootDisk, "driver", None, driver)
         # install disk (if any)
         if not installdev:
             installdev_list = []
@@ -521,7 +801,8 @@ class Guest(object):
                                      backing_filename=None):
         """
         Internal method to generate a diskimage.
-        Set image_filename to override the default selection of self.diskimage
+        Set image_filename to override the default selection of
+        self.install_diskimage
         Set backing_filename to force diskimage to be a writeable qcow2 snapshot
         backed by "backing_filename" which can be either a raw image or a
         qcow2 image.
@@ -533,7 +814,7 @@ class Guest(object):
 
         self.log.info("Generating %dGB diskimage for %s", size, self.tdl.name)
 
-        diskimage = self.diskimage
+        diskimage = self.install_diskimage
         if image_filename:
             diskimage = image_filename
 
@@ -585,78 +866,80 @@ class Guest(object):
         self.lxml_subelement(vol, "capacity", str(capacity), {'unit':'G'})
         vol_xml = lxml.etree.tostring(vol, pretty_print=True)
 
-        # sigh.  Yes, this is racy; if a pool is defined during this loop, we
-        # might miss it.  I'm not quite sure how to do it better, and in any
-        # case we don't expect that to happen often
-        started = False
-        found = False
-        for poolname in self.libvirt_conn.listDefinedStoragePools() + self.libvirt_conn.listStoragePools():
-            pool = self.libvirt_conn.storagePoolLookupByName(poolname)
-            doc = lxml.etree.fromstring(pool.XMLDesc(0))
-            res = doc.xpath('/pool/target/path')
-            if len(res) != 1:
-                continue
-            if res[0].text == directory:
-                # OK, this pool manages that directory; make sure it is running
-                found = True
-                if not pool.isActive():
-                    pool.create(0)
-                    started = True
-                break
-
-        if not found:
-            pool = self.libvirt_conn.storagePoolCreateXML(pool_xml, 0)
-            started = True
-
-        # libvirt will not allow us to do certain operations (like a refresh)
-        # while other operations are happening on a pool (like creating a new
-        # volume).  Since we don't exactly know which other processes might be
-        # running on the system, we take a system-wide Oz lock to ensure that
-        # these succeed.  In most cases these operations will be fast and thus
-        # the lock will not be held very long.
-        lockfile = os.path.join(self.icicle_tmp, "libvirt_pool_lockfile")
-        (refresh_lock,outdir) = self._open_locked_file(lockfile)
-        pool.refresh(0)
-
-        # this is a bit complicated, because of the cases that can
-        # happen.  The cases are:
-        #
-        # 1.  The volume did not exist.  In this case, storageVolLookupByName()
-        #     throws an exception, which we just ignore.  We then go on to
-        #     create the volume
-        # 2.  The volume did exist.  In this case, storageVolLookupByName()
-        #     returns a valid volume object, and then we delete the volume
-        try:
-            try:
-                vol = pool.storageVolLookupByName(filename)
-                vol.delete(0)
-            except libvirt.libvirtError as e:
-                if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
-                    raise
+        # the pool is only started for as long as it takes to create the
+        # volume, and other guests in this process must not stop it in the
+        # meantime
+        with _storage_pool_lock:
+            # sigh.  Yes, this is racy; if a pool is defined during this loop, we
+            # might miss it.  I'm not quite sure how to do it better, and in any
+            # case we don't expect that to happen often
+            started = False
+            found = False
+            for poolname in self.libvirt_conn.listDefinedStoragePools() + self.libvirt_conn.listStoragePools():
+                pool = self.libvirt_conn.storagePoolLookupByName(poolname)
+                doc = lxml.etree.fromstring(pool.XMLDesc(0))
+                res = doc.xpath('/pool/target/path')
+                if len(res) != 1:
+                    continue
+                if res[0].text == directory:
+                    # OK, this pool manages that directory; make sure it is running
+                    found = True
+                    if not pool.isActive():
+                        pool.create(0)
+                        started = True
+                    break
 
+            if not found:
+                pool = self.libvirt_conn.storagePoolCreateXML(pool_xml, 0)
+                started = True
+
+            # libvirt will not allow us to do certain operations (like a refresh)
+            # while other operations are happening on a pool (like creating a new
+            # volume).  Since we don't exactly know which other processes might be
+            # running on the system, we take a system-wide Oz lock to ensure that
+            # these succeed.  In most cases these operations will be fast and thus
+            # the lock will not be held very long.
+            lockfile = os.path.join(self.icicle_tmp, "libvirt_pool_lockfile")
+            (refresh_lock,outdir) = self._open_locked_file(lockfile)
+
+            # this is a bit complicated, because of the cases that can
+            # happen.  The cases are:
+            #
+            # 1.  The volume did not exist.  In this case, storageVolLookupByName()
+            #     throws an exception, which we just ignore.  We then go on to
+            #     create the volume
+            # 2.  The volume did exist.  In this case, storageVolLookupByName()
+            #     returns a valid volume object, and then we delete the volume
             try:
-                pool.createXML(vol_xml, 0)
-            except libvirt.libvirtError as e:
-                raise
-        finally:
-            if started:
-                pool.destroy()
+                pool.refresh(0)
+                try:
+                    vol = pool.storageVolLookupByName(filename)
+                    vol.delete(0)
+                except libvirt.libvirtError as e:
+                    if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+                        raise
 
-        # remember to unlock the refresh lock
-        os.close(refresh_lock)
+                try:
+                    pool.createXML(vol_xml, 0)
+                except libvirt.libvirtError as e:
+                    raise
+            finally:
+                if started:
+                    pool.destroy()
+                # remember to unlock the refresh lock
+                os.close(refresh_lock)
 
         if create_partition:
             if backing_filename:
                 self.log.warning("Asked to create partition against a copy-on-write snapshot - ignoring")
             else:
-                g_handle = guestfs.GuestFS()
-                g_handle.add_drive_opts(self.diskimage, format=self.image_type,
-                                        readonly=0)
-                g_handle.launch()
-                devices = g_handle.list_devices()
-                g_handle.part_init(devices[0], "msdos")
-                g_handle.part_add(devices[0], 'p', 1, 2)
-                g_handle.close()
+                g_handle, devices = self.guestfs_manager.open([(diskimage, self.image_type, False)],
+                                                              "partitioning " + diskimage)
+                try:
+                    g_handle.part_init(devices[0], "msdos")
+                    g_handle.part_add(devices[0], 'p', 1, 2)
+                finally:
+                    self.guestfs_manager.release(g_handle)
 
     def generate_diskimage(self, size=10, force=False):
         """
@@ -697,13 +980,22 @@ class Guest(object):
 
         return disks, interfaces
 
-    def _get_disk_and_net_activity(self, libvirt_dom, disks, interfaces):
+    def _get_disk_and_net_activity(self, libvirt_dom, disks, interfaces,
+                                   watch=None):
         """
         Method to collect the disk and network activity by the domain.  The
         method returns two numbers: the first is the sum of all disk activity
         from all disks, and the second is the sum of all network traffic from
-        all network devices.
+        all network devices.  If watch is sampling activity, the next bulk
+        sample taken by the domain monitor is used (which also waits for it);
+        otherwise, or if there is no sample, the devices are queried one by
+        one.
         """
+        if watch is not None and watch.sampling:
+            sample = watch.next_sample(5)
+            if sample is not None:
+                return sample
+
         total_disk_req = 0
         for dev in disks:
             rd_req, rd_bytes, wr_req, wr_bytes, errs = libvirt_dom.blockStats(dev)
@@ -720,22 +1012,28 @@ class Guest(object):
         """
         Internal method to wait for a clean shutdown of a libvirt domain that
         is suspected to have cleanly quit.  If that domain did cleanly quit,
-        then we will hit a libvirt VIR_ERR_NO_DOMAIN exception on the very
-        first libvirt call and return with no delay.  If no exception, or some
-        other exception occurs, we wait up to 10 seconds for the domain to go
-        away.  If the domain is still there after 10 seconds then we raise the
-        original exception that was passed in.
-        """
-        count = 10
-        while count > 0:
-            self.log.debug("Waiting for %s to complete shutdown, %d/10", self.tdl.name, count)
-            try:
-                libvirt_dom.info()
-            except libvirt.libvirtError as e:
-                if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+        then the lifecycle event (or a libvirt VIR_ERR_NO_DOMAIN exception)
+        tells us so right away and we return with no delay.  Otherwise, we
+        wait up to 10 seconds for the domain to go away.  If the domain is
+        still there after 10 seconds then we raise the original exception
+        that was passed in.
+        """
+        watch = self._watch_domain(libvirt_dom)
+        try:
+            count = 10
+            while count > 0:
+                if watch.stopped():
                     break
-            count -= 1
-            time.sleep(1)
+                self.log.debug("Waiting for %s to complete shutdown, %d/10", self.tdl.name, count)
+                try:
+                    libvirt_dom.info()
+                except libvirt.libvirtError as e:
+                    if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                        break
+                count -= 1
+                watch.wait(1)
+        finally:
+            watch.close()
 
         if count == 0:
             # Got something other than the expected exception even after 10
@@ -756,6 +1054,81 @@ class Guest(object):
                 # the passed in exception was None, just raise a generic error
                 raise oz.OzException.OzException("Unknown libvirt error")
 
+    def _watch_domain(self, libvirt_dom, sample_activity=False,
+                      screen_interval=0):
+        """
+        Method to start watching the lifecycle of libvirt_dom.  The returned
+        watch tells (within milliseconds, if libvirt lifecycle events are
+        available) when the domain has stopped; it must be closed when no
+        longer needed.  If sample_activity is True, the watch also gets the
+        disk and network activity of the domain, sampled in bulk together
+        with the other domains of this process.  If screen_interval is not 0,
+        the screen of the domain is hashed that often, to tell how long it
+        has been static.
+        """
+        return oz.DomainMonitor.watch_domain(self.libvirt_conn, libvirt_dom,
+                                             sample_activity, screen_interval)
+
+    def _install_console_args(self):
+        """
+        Method to get the kernel command line arguments that make the
+        installer use the serial console (so that its output ends up in the
+        console log), if that was asked for in the configuration.
+        """
+        if self.console_redirect and self.tdl.arch in ["i386", "x86_64"]:
+            # the last console is the one that the installer talks to
+            return "console=tty0 console=ttyS0"
+        return ""
+
+    def _monitor_console(self, libvirt_dom):
+        """
+        Method to start streaming the serial console of libvirt_dom into the
+        console log of this install.  Returns the ConsoleMonitor object, which
+        must be closed when no longer needed, or None if the console is not
+        available.
+        """
+        oz.ozutil.mkdir_p(self.console_log_dir)
+        console = oz.ConsoleMonitor.ConsoleMonitor(libvirt_dom,
+                                                   self.install_console_log,
+                                                   self.install_stage_patterns,
+                                                   self.install_error_patterns)
+        if not console.start():
+            return None
+
+        self.log.debug("Logging the console of %s to %s", self.tdl.name,
+                       self.install_console_log)
+        return console
+
+    def _install_hung(self, watch, activity):
+        """
+        Method to tell whether an install appears to be hung: the screen has
+        not changed for hang_window seconds, and the disk and network
+        activity over that window stayed below the configured rates.
+        Installers that sit at a prompt can still do enough background I/O
+        (swap, logging) to keep the inactivity countdown from running out,
+        while an install that is making progress on an unchanged screen
+        (say, a text installer downloading packages) keeps the disk or the
+        network busy.  activity is the list of (time, total disk requests,
+        total network bytes) samples of the last hang_window seconds.
+        """
+        if not self.screen_hang_window:
+            return False
+        if watch.screen_static_for() < self.screen_hang_window:
+            return False
+        if not activity:
+            return False
+
+        start_time, start_disk, start_net = activity[0]
+        end_time, end_disk, end_net = activity[-1]
+        elapsed = end_time - start_time
+        if elapsed < self.screen_hang_window:
+            # not sampled for long enough yet
+            return False
+
+        disk_rate = (end_disk - start_disk) / float(elapsed)
+        net_rate = (end_net - start_net) / float(elapsed)
+        return disk_rate < self.screen_max_disk_rate and net_rate < self.screen_max_network_rate
+
     def _wait_for_install_finish(self, libvirt_dom, count,
                                  inactivity_timeout=300):
         """
@@ -772,48 +1145,94 @@ class Guest(object):
         inactivity_countdown = inactivity_timeout
         origcount = count
         saved_exception = None
-        while count > 0 and inactivity_countdown > 0:
-            if count % 10 == 0:
-                self.log.debug("Waiting for %s to finish installing, %d/%d", self.tdl.name, count, origcount)
-            try:
-                total_disk_req, total_net_bytes = self._get_disk_and_net_activity(libvirt_dom, disks, interfaces)
-            except libvirt.libvirtError as e:
-                # we save the exception here because we want to raise it later
-                # if this was a "real" exception
-                saved_exception = e
-                break
-
-            # rd_req and wr_req are the *total* number of disk read requests and
-            # write requests ever made for this domain.  Similarly rd_bytes and
-            # wr_bytes are the total number of network bytes read or written
-            # for this domain
-
-            # we define activity as having done a read or write request on the
-            # install disk, or having done at least 4KB of network transfers in
-            # the last second.  The thinking is that if the installer is putting
-            # bits on disk, there will be disk activity, so we should keep
-            # waiting.  On the other hand, the installer might be downloading
-            # bits to eventually install on disk, so we look for network
-            # activity as well.  We say that transfers of at least 4KB must be
-            # made, however, to try to reduce false positives from things like
-            # ARP requests
-
-            if (total_disk_req == last_disk_activity) and (total_net_bytes < (last_network_activity + 4096)):
-                # if we saw no read or write requests since the last iteration,
-                # decrement our activity timer
-                inactivity_countdown -= 1
-            else:
-                # if we did see some activity, then we can reset the timer
-                inactivity_countdown = inactivity_timeout
-
-            last_disk_activity = total_disk_req
-            last_network_activity = total_net_bytes
-            count -= 1
-            time.sleep(1)
+        screen_interval = 0
+        if self.screen_hang_window:
+            screen_interval = self.screen_interval
+        screen_hung = False
+        activity = collections.deque()
+        # an installer that fails to do the customization typically stops at
+        # an error dialog, which would only end with the timeout
+        fail_fast = self.console_fail_fast or self.customize_in_install
+        watch = self._watch_domain(libvirt_dom, sample_activity=True,
+                                   screen_interval=screen_interval)
+        console = self._monitor_console(libvirt_dom)
+        try:
+            while count > 0 and inactivity_countdown > 0:
+                if watch.stopped():
+                    break
+                if console is not None and console.failed() and fail_fast:
+                    break
+                if self._install_hung(watch, activity):
+                    screen_hung = True
+                    break
+                if count % 10 == 0:
+                    self.log.debug("Waiting for %s to finish installing, %d/%d", self.tdl.name, count, origcount)
+                try:
+                    total_disk_req, total_net_bytes = self._get_disk_and_net_activity(libvirt_dom, disks, interfaces, watch)
+                except libvirt.libvirtError as e:
+                    # we save the exception here because we want to raise it
+                    # later if this was a "real" exception
+                    saved_exception = e
+                    break
 
-        # We get here because of a libvirt exception, an absolute timeout, or
-        # an I/O timeout; we sort this out below
-        if count == 0:
+                # rd_req and wr_req are the *total* number of disk read
+                # requests and write requests ever made for this domain.
+                # Similarly rd_bytes and wr_bytes are the total number of
+                # network bytes read or written for this domain
+
+                # we define activity as having done a read or write request on
+                # the install disk, or having done at least 4KB of network
+                # transfers in the last second.  The thinking is that if the
+                # installer is putting bits on disk, there will be disk
+                # activity, so we should keep waiting.  On the other hand, the
+                # installer might be downloading bits to eventually install on
+                # disk, so we look for network activity as well.  We say that
+                # transfers of at least 4KB must be made, however, to try to
+                # reduce false positives from things like ARP requests
+
+                if (total_disk_req == last_disk_activity) and (total_net_bytes < (last_network_activity + 4096)):
+                    # if we saw no read or write requests since the last
+                    # iteration, decrement our activity timer
+                    inactivity_countdown -= 1
+                else:
+                    # if we did see some activity, then we can reset the timer
+                    inactivity_countdown = inactivity_timeout
+
+                last_disk_activity = total_disk_req
+                last_network_activity = total_net_bytes
+                if self.screen_hang_window:
+                    # keep the activity of the last hang_window seconds
+                    now = time.time()
+                    activity.append((now, total_disk_req, total_net_bytes))
+                    while len(activity) > 1 and activity[1][0] <= now - self.screen_hang_window:
+                        activity.popleft()
+                count -= 1
+                if not watch.sampling:
+                    # a sampling watch already paced us while waiting for the
+                    # sample
+                    watch.wait(1)
+        finally:
+            watch.close()
+            if console is not None:
+                console.close()
+
+        # We get here because the domain stopped, because the installer
+        # reported an error on the console, because the screen froze, because
+        # of a libvirt exception, an absolute timeout, or an I/O timeout; we
+        # sort this out below
+        if console is not None and console.failed() and fail_fast:
+            screenshot_text = ""
+            if not watch.stopped():
+                screenshot_text = self._capture_screenshot(libvirt_dom)
+            raise oz.OzException.OzException("Installer failed (%s): %s.  Check the console log at %s for more detail.  %s" % (console.error[0], console.error[1], self.install_console_log, screenshot_text))
+        elif screen_hung:
+            screenshot_text = self._capture_screenshot(libvirt_dom)
+            raise oz.OzException.OzException("Screen unchanged and little disk or network activity for %d seconds, the install appears to be hung.  %s" % (self.screen_hang_window, screenshot_text))
+        elif watch.stopped():
+            # the lifecycle event told us that the domain went away, so there
+            # is nothing left to confirm
+            pass
+        elif count == 0:
             # if we timed out, then let's make sure to take a screenshot.
             screenshot_text = self._capture_screenshot(libvirt_dom)
             raise oz.OzException.OzException("Timed out waiting for install to finish.  %s" % (screenshot_text))
@@ -822,12 +1241,60 @@ class Guest(object):
             # we presume the install has hung.  Fail here
             screenshot_text = self._capture_screenshot(libvirt_dom)
             raise oz.OzException.OzException("No disk activity in %d seconds, failing.  %s" % (inactivity_timeout, screenshot_text))
-
-        # We get here only if we got a libvirt exception
-        self._wait_for_clean_shutdown(libvirt_dom, saved_exception)
+        else:
+            # We get here only if we got a libvirt exception
+            self._wait_for_clean_shutdown(libvirt_dom, saved_exception)
 
         self.log.info("Install of %s succeeded", self.tdl.name)
 
+    def _discard_install_disk(self):
+        """
+        Method to remove the disk image in the scratch area when it is not
+        going to be installed to after all (because a cached JEOS turned up
+        after generate_diskimage() created it).
+        """
+        if self.install_diskimage == self.diskimage:
+            return
+        try:
+            os.unlink(self.install_diskimage)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def _finish_install_disk(self):
+        """
+        Method to put the disk image written during the install into its final
+        place.  If the install ran in the scratch area, the disk image is
+        streamed out to its final location.  The performance install profile
+        runs the installer with cache='unsafe', which means that qemu ignores
+        the flushes issued by the guest; in that case (and after a move), do
+        the flush on the guest's behalf here before the install is considered
+        finished.
+        """
+        if self.install_diskimage != self.diskimage:
+            self.log.info("Moving %s to %s", self.install_diskimage, self.diskimage)
+            self._copyfile_sparse(self.install_diskimage, self.diskimage)
+            os.chmod(self.diskimage,
+                     stat.S_IMODE(os.stat(self.install_diskimage).st_mode))
+            os.unlink(self.install_diskimage)
+        elif self.install_profile != "performance":
+            return
+
+        self.log.debug("Syncing %s to disk", self.diskimage)
+        fd = os.open(self.diskimage, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _copyfile_sparse(self, src, dest):
+        """
+        Method to copy a large file (like a disk image) sparsely, using the
+        bulk I/O settings from the configuration file.
+        """
+        oz.ozutil.copyfile_sparse(src, dest, self.io_buffer_size,
+                                  self.io_drop_cache, self.io_direct)
+
     def _wait_for_guest_shutdown(self, libvirt_dom, count=90):
         """
         Method to wait around for orderly shutdown of a running guest.  Returns
@@ -835,16 +1302,25 @@ class Guest(object):
         """
         origcount = count
         saved_exception = None
-        while count > 0:
-            if count % 10 == 0:
-                self.log.debug("Waiting for %s to shutdown, %d/%d", self.tdl.name, count, origcount)
-            try:
-                libvirt_dom.info()
-            except libvirt.libvirtError as e:
-                saved_exception = e
-                break
-            count -= 1
-            time.sleep(1)
+        watch = self._watch_domain(libvirt_dom)
+        try:
+            while count > 0:
+                if watch.stopped():
+                    break
+                if count % 10 == 0:
+                    self.log.debug("Waiting for %s to shutdown, %d/%d", self.tdl.name, count, origcount)
+                try:
+                    libvirt_dom.info()
+                except libvirt.libvirtError as e:
+                    saved_exception = e
+                    break
+                count -= 1
+                watch.wait(1)
+        finally:
+            watch.close()
+
+        if watch.stopped():
+            return True
 
         # Timed Out
         if count == 0:
@@ -900,10 +1376,14 @@ class Guest(object):
 
         local_sum = getattr(hashlib, hashname)()
 
-        buf = oz.ozutil.read_bytes_from_fd(outputfd, 4096)
+        offset = 0
+        buf = oz.ozutil.read_bytes_from_fd(outputfd, self.io_buffer_size)
         while buf != '':
             local_sum.update(buf)
-            buf = oz.ozutil.read_bytes_from_fd(outputfd, 4096)
+            if self.io_drop_cache:
+                oz.ozutil.drop_page_cache(outputfd, offset, len(buf))
+            offset += len(buf)
+            buf = oz.ozutil.read_bytes_from_fd(outputfd, self.io_buffer_size)
 
         return local_sum.hexdigest() == upstream_sum
 
@@ -943,7 +1423,8 @@ class Guest(object):
         os.ftruncate(fd, 0)
 
         self.log.info("Fetching the original install media from %s", url)
-        oz.ozutil.http_download_file(url, fd, True, self.log)
+        oz.ozutil.http_download_file(url, fd, True, self.log,
+                                     self.io_drop_cache)
 
         filesize = os.fstat(fd)[stat.ST_SIZE]
 
@@ -997,9 +1478,57 @@ class Guest(object):
 
         return text
 
-    def _guestfs_handle_setup(self, libvirt_xml):
+    def _running_domain_disks(self):
         """
-        Method to setup a guestfs handle to the guest disks.
+        Method to find the names of the running domains, and the disk files
+        that they use.  Returns a tuple of two sets.  Newer libvirt hands out
+        the disks of all domains in a single getAllDomainStats() call; older
+        libvirt needs the XML of every running domain.
+        """
+        names = set()
+        disks = set()
+
+        try:
+            stats = self.libvirt_conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_BLOCK,
+                                                        libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        except (AttributeError, libvirt.libvirtError):
+            self.log.debug("Could not get the stats of all domains, looking at each one", exc_info=True)
+            stats = None
+
+        if stats is not None:
+            for dom, record in stats:
+                names.add(dom.name())
+                for key, value in record.items():
+                    # FIXME: this will only work for files and block devices;
+                    # network disks have no path
+                    if key.startswith('block.') and key.endswith('.path'):
+                        disks.add(value)
+            return names, disks
+
+        for domid in self.libvirt_conn.listDomainsID():
+            try:
+                doc = lxml.etree.fromstring(self.libvirt_conn.lookupByID(domid).XMLDesc(0))
+            except:
+                self.log.debug("Could not get XML for domain ID (%s) - it may have disappeared (continuing)", domid)
+                continue
+
+            namenode = doc.xpath('/domain/name')
+            if len(namenode) != 1:
+                # hm, odd, a domain without a name?
+                raise oz.OzException.OzException("Saw a domain without a name, something weird is going on")
+            names.add(namenode[0].text)
+            for source in doc.xpath('/domain/devices/disk/source'):
+                # FIXME: this will only work for files; we can make it work
+                # for other things by following something like:
+                # http://git.annexia.org/?p=libguestfs.git;a=blob;f=src/virt.c;h=2c6be3c6a2392ab8242d1f4cee9c0d1445844385;hb=HEAD#l169
+                disks.add(str(source.get('file')))
+
+        return names, disks
+
+    def _guestfs_handle_setup(self, libvirt_xml, readonly=False):
+        """
+        Method to setup a guestfs handle to the guest disks.  If readonly is
+        True, the disk image is opened and mounted read-only.
         """
         input_doc = lxml.etree.fromstring(libvirt_xml)
         namenode = input_doc.xpath('/domain/name')
@@ -1021,106 +1550,108 @@ class Guest(object):
         else:
             raise oz.OzException.OzException("invalid <disk> entry without a driver")
 
-        for domid in self.libvirt_conn.listDomainsID():
-            try:
-                doc = lxml.etree.fromstring(self.libvirt_conn.lookupByID(domid).XMLDesc(0))
-            except:
-                self.log.debug("Could not get XML for domain ID (%s) - it may have disappeared (continuing)", domid)
-                continue
-
-            namenode = doc.xpath('/domain/name')
-            if len(namenode) != 1:
-                # hm, odd, a domain without a name?
-                raise oz.OzException.OzException("Saw a domain without a name, something weird is going on")
-            if input_name == namenode[0].text:
-                raise oz.OzException.OzException("Cannot setup ICICLE generation on a running guest")
-            disks = doc.xpath('/domain/devices/disk')
-            if len(disks) < 1:
-                # odd, a domain without a disk, but don't worry about it
-                continue
-            for guestdisk in disks:
-                for source in guestdisk.xpath("source"):
-                    # FIXME: this will only work for files; we can make it work
-                    # for other things by following something like:
-                    # http://git.annexia.org/?p=libguestfs.git;a=blob;f=src/virt.c;h=2c6be3c6a2392ab8242d1f4cee9c0d1445844385;hb=HEAD#l169
-                    filename = str(source.get('file'))
-                    if filename == input_disk:
-                        raise oz.OzException.OzException("Cannot setup ICICLE generation on a running disk")
-
+        running_names, running_disks = self._running_domain_disks()
+        if input_name in running_names:
+            raise oz.OzException.OzException("Cannot setup ICICLE generation on a running guest")
+        if input_disk in running_disks:
+            raise oz.OzException.OzException("Cannot setup ICICLE generation on a running disk")
 
         self.log.info("Setting up guestfs handle for %s", self.tdl.name)
-        g = guestfs.GuestFS()
 
         self.log.debug("Adding disk image %s", input_disk)
-        # NOTE: we use "add_drive_opts" here so we can specify the type
-        # of the diskimage.  Otherwise it might be possible for an attacker
-        # to fool libguestfs with a specially-crafted diskimage that looks
-        # like a qcow2 disk (thanks to rjones for the tip)
-        g.add_drive_opts(input_disk, format=input_disk_type)
-
-        self.log.debug("Launching guestfs")
-        g.launch()
-
-        self.log.debug("Inspecting guest OS")
-        roots = g.inspect_os()
-
-        if len(roots) == 0:
-            raise oz.OzException.OzException("No operating systems found on the disk")
-
-        self.log.debug("Getting mountpoints")
-        for root in roots:
-            self.log.debug("Root device: %s", root)
-
-            # the problem here is that the list of mountpoints returned by
-            # inspect_get_mountpoints is in no particular order.  So if the
-            # diskimage contains /usr and /usr/local on different devices,
-            # but /usr/local happened to come first in the listing, the
-            # devices would get mapped improperly.  The clever solution here is
-            # to sort the mount paths by length; this will ensure that they
-            # are mounted in the right order.  Thanks to rjones for the hint,
-            # and the example code that comes from the libguestfs.org python
-            # example page.
-            mps = g.inspect_get_mountpoints(root)
-            def _compare(a, b):
-                """
-                Method to sort disks by length.
-                """
-                if len(a[0]) > len(b[0]):
-                    return 1
-                elif len(a[0]) == len(b[0]):
-                    return 0
-                else:
-                    return -1
-            mps.sort(_compare)
-            for mp_dev in mps:
-                try:
-                    g.mount_options('', mp_dev[1], mp_dev[0])
-                except:
-                    if mp_dev[0] == '/':
-                        # If we cannot mount root, we may as well give up
-                        raise
+        # NOTE: the guestfs manager uses "add_drive_opts" so we can specify
+        # the type of the diskimage.  Otherwise it might be possible for an
+        # attacker to fool libguestfs with a specially-crafted diskimage that
+        # looks like a qcow2 disk (thanks to rjones for the tip)
+        g, devices = self.guestfs_manager.open([(input_disk, input_disk_type, readonly)],
+                                               "the disk image of " + self.tdl.name)
+
+        try:
+            self.log.debug("Inspecting guest OS")
+            roots = g.inspect_os()
+
+            if len(roots) == 0:
+                raise oz.OzException.OzException("No operating systems found on the disk")
+
+            self.log.debug("Getting mountpoints")
+            for root in roots:
+                self.log.debug("Root device: %s", root)
+
+                # the problem here is that the list of mountpoints returned by
+                # inspect_get_mountpoints is in no particular order.  So if the
+                # diskimage contains /usr and /usr/local on different devices,
+                # but /usr/local happened to come first in the listing, the
+                # devices would get mapped improperly.  The clever solution here is
+                # to sort the mount paths by length; this will ensure that they
+                # are mounted in the right order.  Thanks to rjones for the hint,
+                # and the example code that comes from the libguestfs.org python
+                # example page.
+                mps = g.inspect_get_mountpoints(root)
+                def _compare(a, b):
+                    """
+                    Method to sort disks by length.
+                    """
+                    if len(a[0]) > len(b[0]):
+                        return 1
+                    elif len(a[0]) == len(b[0]):
+                        return 0
                     else:
-                        # some custom guests may have fstab content with
-                        # "nofail" as a mount option.  For example, images
-                        # built for EC2 with ephemeral mappings.  These
-                        # fail at this point.  Allow things to continue.
-                        # Profound failures will trigger later on during
-                        # the process.
-                        self.log.warning("Unable to mount (%s) on (%s) - trying to continue", mp_dev[1], mp_dev[0])
+                        return -1
+                mps.sort(_compare)
+                for mp_dev in mps:
+                    try:
+                        if readonly:
+                            g.mount_ro(mp_dev[1], mp_dev[0])
+                        else:
+                            g.mount_options('', mp_dev[1], mp_dev[0])
+                    except:
+                        if mp_dev[0] == '/':
+                            # If we cannot mount root, we may as well give up
+                            raise
+                        else:
+                            # some custom guests may have fstab content with
+                            # "nofail" as a mount option.  For example, images
+                            # built for EC2 with ephemeral mappings.  These
+                            # fail at this point.  Allow things to continue.
+                            # Profound failures will trigger later on during
+                            # the process.
+                            self.log.warning("Unable to mount (%s) on (%s) - trying to continue", mp_dev[1], mp_dev[0])
+        except:
+            # the handle is no good to the caller, but the appliance may
+            # well be to the next one
+            self.guestfs_manager.release(g)
+            raise
+
         return g
 
+    def _guestfs_batch(self, g_handle):
+        """
+        Method to start a GuestfsBatch of changes to the disk image behind
+        g_handle.  The changes are made in a shell script in the guest when
+        the binaries of the guest can run on this host.
+        """
+        hostarch = os.uname()[4]
+        if hostarch in ["i386", "i586", "i686"]:
+            hostarch = "i386"
+        use_shell = self.tdl.arch == hostarch or (hostarch == "x86_64" and self.tdl.arch == "i386")
+        return oz.GuestfsBatch.GuestfsBatch(g_handle, use_shell)
+
     def _guestfs_remove_if_exists(self, g_handle, path):
         """
         Method to remove a file if it exists in the disk image.
         """
-        if g_handle.exists(path):
+        if isinstance(g_handle, oz.GuestfsBatch.GuestfsBatch):
+            g_handle.remove_if_exists(path)
+        elif g_handle.exists(path):
             g_handle.rm_rf(path)
 
     def _guestfs_move_if_exists(self, g_handle, orig_path, replace_path):
         """
         Method to move a file if it exists in the disk image.
         """
-        if g_handle.exists(orig_path):
+        if isinstance(g_handle, oz.GuestfsBatch.GuestfsBatch):
+            g_handle.move_if_exists(orig_path, replace_path)
+        elif g_handle.exists(orig_path):
             g_handle.mv(orig_path, replace_path)
 
     def _guestfs_path_backup(self, g_handle, orig):
@@ -1134,6 +1665,12 @@ class Guest(object):
         Method to restore a backup file in the disk image.
         """
         backup = orig + ".ozbackup"
+        if isinstance(g_handle, oz.GuestfsBatch.GuestfsBatch) and g_handle.undo:
+            # undoing a failed setup: orig is only replaced if it was backed
+            # up, and only removed if the setup created it
+            g_handle.remove_if_exists(orig)
+            g_handle.restore_backup(backup, orig)
+            return
         self._guestfs_remove_if_exists(g_handle, orig)
         self._guestfs_move_if_exists(g_handle, backup, orig)
 
@@ -1148,6 +1685,8 @@ class Guest(object):
         self.log.debug("Unmounting all")
         g_handle.umount_all()
 
+        self.guestfs_manager.release(g_handle)
+
     def _modify_libvirt_xml_for_serial(self, libvirt_xml):
         """
         Internal method to take input libvirt XML (which may have been provided
@@ -1214,12 +1753,86 @@ class Guest(object):
         self.log.debug("Generated XML:\n%s", xml)
         return xml
 
+    def generate_overlay(self, libvirt_xml):
+        """
+        Method to create the disk image of this guest as a thin qcow2 overlay
+        on top of the disk image of the (installed) guest in libvirt_xml.
+        Returns libvirt XML for the overlay, with the name, UUID and MAC
+        address of this guest, so that many overlays of one image can be
+        customized at the same time.  The image under the overlays must not
+        change while they are around.
+        """
+        input_doc = lxml.etree.fromstring(libvirt_xml)
+        source = input_doc.xpath('/domain/devices/disk/source')
+        if len(source) < 1:
+            raise oz.OzException.OzException("invalid libvirt XML with no disk source")
+        backing_disk = source[0].get('file')
+        if backing_disk == self.diskimage:
+            raise oz.OzException.OzException("The overlay cannot replace the disk image it is on top of")
+
+        self.log.info("Creating overlay %s on top of %s", self.diskimage,
+                      backing_disk)
+        self._internal_generate_diskimage(force=True,
+                                          image_filename=self.diskimage,
+                                          backing_filename=backing_disk)
+
+        xml = self._modify_libvirt_xml_diskimage(libvirt_xml, self.diskimage,
+                                                 'qcow2')
+        doc = lxml.etree.fromstring(xml)
+        namenode = doc.xpath('/domain/name')
+        if len(namenode) != 1:
+            raise oz.OzException.OzException("invalid libvirt XML with no name")
+        namenode[0].text = self.tdl.name
+        for uuidnode in doc.xpath('/domain/uuid'):
+            uuidnode.text = str(self.uuid)
+        macs = doc.xpath('/domain/devices/interface/mac')
+        if macs:
+            macs[0].set('address', self.macaddr)
+
+        return lxml.etree.tostring(doc, pretty_print=True)
+
+    def _get_leased_address(self):
+        """
+        Method to look up the IPv4 address that the libvirt network behind
+        the bridge leased to the MAC address of the guest.  Returns None if
+        there is no such lease, or if the bridge is not managed by a libvirt
+        network.
+        """
+        if self.dhcp_network is None:
+            self.dhcp_network = False
+            try:
+                for network in self.libvirt_conn.listAllNetworks():
+                    if network.bridgeName() == self.bridge_name:
+                        self.dhcp_network = network
+                        break
+            except (AttributeError, libvirt.libvirtError):
+                self.log.debug("Could not look up the libvirt networks",
+                               exc_info=True)
+
+        if not self.dhcp_network:
+            return None
+
+        try:
+            leases = self.dhcp_network.DHCPLeases(self.macaddr)
+        except (AttributeError, libvirt.libvirtError):
+            self.log.debug("Could not look up the DHCP leases", exc_info=True)
+            self.dhcp_network = False
+            return None
+
+        for lease in leases:
+            if lease['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                return lease['ipaddr']
+
+        return None
+
     def _wait_for_guest_boot(self, libvirt_dom):
         """
         Method to wait around for a guest to boot.  Orderly guests will boot
         up and announce their presence via a TCP message; if that happens within
         the timeout, this method returns the IP address of the guest.  If that
-        doesn't happen an exception is raised.
+        doesn't happen an exception is raised.  In the meantime, the DHCP
+        leases of the libvirt network are checked as well; once the guest has
+        a lease and its ssh port accepts connections, it is considered booted.
         """
         self.log.info("Waiting for guest %s to boot", self.tdl.name)
 
@@ -1229,58 +1842,47 @@ class Guest(object):
             sock.settimeout(1)
             sock.connect(('127.0.0.1', self.listen_port))
 
+            # the announcement is read and parsed by the socket monitor thread
+            # that serves all of the guests in this process, so all we do here
+            # is wait for it (or for the domain to go away)
+            announce = oz.SocketMonitor.AnnounceWait(self.announce_token)
+            monitor = oz.SocketMonitor.get_socket_monitor()
+            monitor.add(sock, announce.readable)
+            watch = self._watch_domain(libvirt_dom)
             addr = None
-            count = 300
-            data = ''
-            while count > 0:
-                do_sleep = True
-                if count % 10 == 0:
-                    self.log.debug("Waiting for guest %s to boot, %d/300", self.tdl.name, count)
-                try:
-                    # note that we have to build the data up here, since there
-                    # is no guarantee that we will get the whole write in one go
-                    data += sock.recv(100)
-                except socket.timeout:
-                    # the socket times out after 1 second.  We can just fall
-                    # through to the below code because it is a noop, *except* that
-                    # we don't want to sleep.  Set the flag
-                    do_sleep = False
-
-                # OK, we got data back from the socket.  Check to see if it is
-                # is what we expect; essentially, some up-front garbage,
-                # followed by a !<ip>,<uuid>!
-                # Exclude ! from the wildcard to avoid errors when receiving two
-                # announce messages in the same string
-                match = re.search("!([^!]*?,[^!]*?)!$", data)
-                if match is not None:
-                    if len(match.groups()) != 1:
-                        raise oz.OzException.OzException("Guest checked in with no data")
-                    split = match.group(1).split(',')
-                    if len(split) != 2:
-                        raise oz.OzException.OzException("Guest checked in with bogus data")
-                    addr = split[0]
-                    uuidstr = split[1]
-                    try:
-                        # use socket.inet_aton() to validate the IP address
-                        socket.inet_aton(addr)
-                    except socket.error:
-                        raise oz.OzException.OzException("Guest checked in with invalid IP address")
-
-                    if uuidstr != str(self.uuid):
-                        raise oz.OzException.OzException("Guest checked in with unknown UUID")
-                    break
-
-                # if the data we got didn't match, we need to continue waiting.
-                # before going to sleep, make sure that the domain is still
-                # around
-                libvirt_dom.info()
-                if do_sleep:
-                    time.sleep(1)
-                count -= 1
+            try:
+                count = 300
+                while count > 0:
+                    if count % 10 == 0:
+                        self.log.debug("Waiting for guest %s to boot, %d/300", self.tdl.name, count)
+                    if announce.wait(1):
+                        break
+                    if count % 2 == 0:
+                        leased = self._get_leased_address()
+                        if leased is not None and oz.ozutil.port_open(leased, 22, 0.5):
+                            self.log.debug("Found the address of guest %s in the DHCP leases", self.tdl.name)
+                            addr = leased
+                            break
+                    if watch.stopped():
+                        # this raises the libvirt error about the missing
+                        # domain, if there is one
+                        libvirt_dom.info()
+                        raise oz.OzException.OzException("Guest %s stopped before it announced itself" % (self.tdl.name))
+                    count -= 1
+            finally:
+                watch.close()
+                monitor.remove(sock)
         finally:
             sock.close()
 
         if addr is None:
+            if announce.error is not None:
+                raise oz.OzException.OzException(announce.error)
+            addr = announce.addr
+
+        if addr is None:
+            if announce.closed:
+                raise oz.OzException.OzException("Serial port of guest %s closed before it announced itself" % (self.tdl.name))
             raise oz.OzException.OzException("Timed out waiting for guest to boot")
 
         self.log.debug("IP address of guest is %s", addr)
@@ -1440,9 +2042,9 @@ class CDGuest(Guest):
                                      self.tdl.distro + self.tdl.update + self.tdl.arch + "-" + self.tdl.installtype + ".iso")
         self.modified_iso_cache = os.path.join(self.data_dir, "isos",
                                                self.tdl.distro + self.tdl.update + self.tdl.arch + "-" + self.tdl.installtype + "-oz.iso")
-        self.output_iso = os.path.join(self.output_dir,
+        self.output_iso = os.path.join(self.transient_output_dir,
                                        self.tdl.name + "-" + self.tdl.installtype + "-oz.iso")
-        self.iso_contents = os.path.join(self.data_dir, "isocontent",
+        self.iso_contents = os.path.join(self.transient_data_dir, "isocontent",
                                          self.tdl.name + "-" + self.tdl.installtype)
 
         self.log.debug("Original ISO path: %s", self.orig_iso)
@@ -1469,14 +2071,12 @@ class CDGuest(Guest):
         os.makedirs(self.iso_contents)
 
         self.log.info("Setting up guestfs handle for %s", self.tdl.name)
-        gfs = guestfs.GuestFS()
         self.log.debug("Adding ISO image %s", self.orig_iso)
-        gfs.add_drive_opts(self.orig_iso, readonly=1, format='raw')
-        self.log.debug("Launching guestfs")
-        gfs.launch()
+        gfs, devices = self.guestfs_manager.open([(self.orig_iso, 'raw', True)],
+                                                 "the ISO of " + self.tdl.name)
         try:
             self.log.debug("Mounting ISO")
-            gfs.mount_options('ro', "/dev/sda", "/")
+            gfs.mount_options('ro', devices[0], "/")
 
             self.log.debug("Checking if there is enough space on the filesystem")
             isostat = gfs.statvfs("/")
@@ -1532,7 +2132,7 @@ class CDGuest(Guest):
         finally:
             gfs.sync()
             gfs.umount_all()
-            gfs.kill_subprocess()
+            self.guestfs_manager.release(gfs)
 
     def _get_primary_volume_descriptor(self, cdfd):
         """
@@ -1677,7 +2277,9 @@ class CDGuest(Guest):
         """
         if not force and os.access(self.jeos_filename, os.F_OK):
             self.log.info("Found cached JEOS (%s), using it", self.jeos_filename)
-            oz.ozutil.copyfile_sparse(self.jeos_filename, self.diskimage)
+            self._copyfile_sparse(self.jeos_filename, self.diskimage)
+            self._discard_install_disk()
+            self.diskimage_is_jeos = True
             return self._generate_xml("hd", None)
 
         self.log.info("Running install for %s", self.tdl.name)
@@ -1696,21 +2298,28 @@ class CDGuest(Guest):
             if reboots_to_go == reboots:
                 if kernelfname and os.access(kernelfname, os.F_OK) and ramdiskfname and os.access(ramdiskfname, os.F_OK) and cmdline:
                     xml = self._generate_xml(None, None, kernelfname,
-                                             ramdiskfname, cmdline)
+                                             ramdiskfname, cmdline,
+                                             install=True)
                 else:
-                    xml = self._generate_xml("cdrom", cddev)
+                    xml = self._generate_xml("cdrom", cddev, install=True)
             else:
-                xml = self._generate_xml("hd", cddev)
+                xml = self._generate_xml("hd", cddev, install=True)
 
             dom = self.libvirt_conn.createXML(xml, 0)
             self._wait_for_install_finish(dom, timeout)
 
             reboots_to_go -= 1
 
-        if self.cache_jeos:
+        self._finish_install_disk()
+        self.customized_at_install = self.customize_in_install
+
+        if self.cache_jeos and self.customized_at_install:
+            self.log.info("Not caching the JEOS, since it was customized during the install")
+        elif self.cache_jeos:
             self.log.info("Caching JEOS")
             oz.ozutil.mkdir_p(self.jeos_cache_dir)
-            oz.ozutil.copyfile_sparse(self.diskimage, self.jeos_filename)
+            self._copyfile_sparse(self.diskimage, self.jeos_filename)
+            self.diskimage_is_jeos = True
 
         return self._generate_xml("hd", None)
 
@@ -1807,7 +2416,7 @@ class CDGuest(Guest):
                 # if we found a cached JEOS, we don't need to do anything here;
                 # we'll copy the JEOS itself later on
                 return
-            elif os.access(self.modified_iso_cache, os.F_OK):
+            elif os.access(self.modified_iso_cache, os.F_OK) and not self.customize_in_install:
                 self.log.info("Using cached modified media")
                 shutil.copyfile(self.modified_iso_cache, self.output_iso)
                 return
@@ -1825,7 +2434,9 @@ class CDGuest(Guest):
                 self._add_iso_extras()
                 self._modify_iso()
                 self._generate_new_iso()
-                if self.cache_modified_media:
+                # modified media with the customization of a TDL are only
+                # good for that TDL
+                if self.cache_modified_media and not self.customize_in_install:
                     self.log.info("Caching modified media for future use")
                     shutil.copyfile(self.output_iso, self.modified_iso_cache)
             finally:
@@ -1887,9 +2498,9 @@ class FDGuest(Guest):
                                         self.tdl.distro + self.tdl.update + self.tdl.arch + ".img")
         self.modified_floppy_cache = os.path.join(self.data_dir, "floppies",
                                                   self.tdl.distro + self.tdl.update + self.tdl.arch + "-oz.img")
-        self.output_floppy = os.path.join(self.output_dir,
+        self.output_floppy = os.path.join(self.transient_output_dir,
                                           self.tdl.name + "-oz.img")
-        self.floppy_contents = os.path.join(self.data_dir, "floppycontent",
+        self.floppy_contents = os.path.join(self.transient_data_dir, "floppycontent",
                                             self.tdl.name)
 
         self.log.debug("Original floppy path: %s", self.orig_floppy)
@@ -1916,7 +2527,9 @@ class FDGuest(Guest):
         """
         if not force and os.access(self.jeos_filename, os.F_OK):
             self.log.info("Found cached JEOS, using it")
-            oz.ozutil.copyfile_sparse(self.jeos_filename, self.diskimage)
+            self._copyfile_sparse(self.jeos_filename, self.diskimage)
+            self._discard_install_disk()
+            self.diskimage_is_jeos = True
             return self._generate_xml("hd", None)
 
         self.log.info("Running install for %s", self.tdl.name)
@@ -1926,14 +2539,21 @@ class FDGuest(Guest):
         if timeout is None:
             timeout = 1200
 
-        dom = self.libvirt_conn.createXML(self._generate_xml("fd", fddev),
+        dom = self.libvirt_conn.createXML(self._generate_xml("fd", fddev,
+                                                             install=True),
                                           0)
         self._wait_for_install_finish(dom, timeout)
 
-        if self.cache_jeos:
+        self._finish_install_disk()
+        self.customized_at_install = self.customize_in_install
+
+        if self.cache_jeos and self.customized_at_install:
+            self.log.info("Not caching the JEOS, since it was customized during the install")
+        elif self.cache_jeos:
             self.log.info("Caching JEOS")
             oz.ozutil.mkdir_p(self.jeos_cache_dir)
-            oz.ozutil.copyfile_sparse(self.diskimage, self.jeos_filename)
+            self._copyfile_sparse(self.diskimage, self.jeos_filename)
+            self.diskimage_is_jeos = True
 
         return self._generate_xml("hd", None)
 
@@ -0,0 +1,345 @@
+# Copyright (C) 2014  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Batching of changes to the disk image of a guest
+"""
+
+import collections
+import tempfile
+import tarfile
+import time
+import io
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+class GuestfsBatch(object):
+    """
+    Class to collect changes to the disk image of a guest and to make them
+    in as few libguestfs calls as possible.  It stands in for a libguestfs
+    handle: the calls that change the disk image are recorded, and all other
+    calls go straight to the handle, so they see the disk image as it was
+    before any of the recorded changes.  apply() writes all of the files in
+    a single tar stream, and makes the rest of the changes with a shell
+    script run in the guest.  If the binaries of the guest cannot run on
+    this host (use_shell is False), apply() makes the recorded calls one by
+    one instead.
+
+    If apply() fails part of the way through, the batch from undo_batch()
+    takes back whatever it got to: backups are only restored if they were
+    made, and only the files that the failed batch created are removed.
+    Which of the paths the batch writes to already exist is found out in
+    one go when the batch is applied, before anything is changed.
+    """
+    def __init__(self, g_handle, use_shell=True):
+        self.g_handle = g_handle
+        self.use_shell = use_shell
+        # list of (call, args) tuples, in the order they were recorded
+        self.ops = []
+        # the paths this batch creates, that is the ones it writes to that
+        # did not exist before the batch was applied
+        self.created = set()
+        # the paths this batch writes to that have not been checked yet
+        self._unchecked = []
+        # True for a batch that undoes a failed batch
+        self.undo = False
+
+    def __getattr__(self, name):
+        """
+        Method to hand everything that is not recorded to the handle.
+        """
+        return getattr(self.g_handle, name)
+
+    def _note_created(self, path):
+        """
+        Internal method to remember to check whether path exists yet, so
+        that it counts as created by this batch if it does not.
+        """
+        if not self.undo:
+            self._unchecked.append(path)
+
+    def _check_created(self):
+        """
+        Internal method to find out which of the paths this batch writes to
+        do not exist yet.  With use_shell, this is a single call for all of
+        them.
+        """
+        paths = list(collections.OrderedDict.fromkeys(self._unchecked))
+        self._unchecked = []
+        if not paths:
+            return
+
+        if not self.use_shell:
+            for path in paths:
+                if not self.g_handle.exists(path):
+                    self.created.add(path)
+            return
+
+        script = "".join(["[ -e %s ] || echo %d\n" % (quote(path), index)
+                          for index, path in enumerate(paths)])
+        output = self.g_handle.sh(script)
+        for line in output.split():
+            self.created.add(paths[int(line)])
+
+    def undo_batch(self):
+        """
+        Method to start a batch that undoes this one after apply() failed.
+        In it, backups are only restored where they exist, removals are
+        limited to the paths that this batch created, and removing a
+        missing file is not an error.
+        """
+        self._check_created()
+        undo = GuestfsBatch(self.g_handle, self.use_shell)
+        undo.undo = True
+        undo.created = set(self.created)
+        return undo
+
+    def write(self, path, content):
+        """
+        Method to write content to the file at path, with mode 0644.
+        """
+        self._note_created(path)
+        self.ops.append(('write', (path, content)))
+
+    def upload(self, filename, path):
+        """
+        Method to copy the local file filename to path.  The file is read
+        right away, so it can be removed as soon as this returns.
+        """
+        with open(filename, 'rb') as f:
+            self.write(path, f.read())
+
+    def chmod(self, mode, path):
+        """
+        Method to change the mode of path.
+        """
+        self.ops.append(('chmod', (mode, path)))
+
+    def mkdir(self, path):
+        """
+        Method to create the directory path.
+        """
+        self._note_created(path)
+        self.ops.append(('mkdir', (path,)))
+
+    def mkdir_p(self, path):
+        """
+        Method to create the directory path and any missing parents.
+        """
+        self._note_created(path)
+        self.ops.append(('mkdir_p', (path,)))
+
+    def ln_sf(self, target, linkname):
+        """
+        Method to (re)create linkname as a symlink to target.
+        """
+        self._note_created(linkname)
+        self.ops.append(('ln_sf', (target, linkname)))
+
+    def mv(self, src, dest):
+        """
+        Method to move src to dest.
+        """
+        self.ops.append(('mv', (src, dest)))
+
+    def rm(self, path):
+        """
+        Method to remove the file path.  When undoing, the file may never
+        have been created, so it does not have to exist.
+        """
+        if self.undo:
+            self.rm_f(path)
+            return
+        self.ops.append(('rm', (path,)))
+
+    def rm_f(self, path):
+        """
+        Method to remove the file path, if there is one.
+        """
+        self.ops.append(('rm_f', (path,)))
+
+    def rm_rf(self, path):
+        """
+        Method to remove path and everything under it.
+        """
+        self.ops.append(('rm_rf', (path,)))
+
+    def move_if_exists(self, src, dest):
+        """
+        Method to move src to dest if src exists when the batch is applied.
+        """
+        self.ops.append(('move_if_exists', (src, dest)))
+
+    def remove_if_exists(self, path):
+        """
+        Method to remove path and everything under it if path exists when
+        the batch is applied.  When undoing, only paths that the failed
+        batch created are removed.
+        """
+        if self.undo and path not in self.created:
+            return
+        self.ops.append(('remove_if_exists', (path,)))
+
+    def restore_backup(self, backup, orig):
+        """
+        Method to put backup back in place of orig if backup exists when the
+        batch is applied.
+        """
+        self.ops.append(('restore_backup', (backup, orig)))
+
+    def _replay(self, call, args):
+        """
+        Internal method to make a single recorded call on the handle.
+        """
+        g_handle = self.g_handle
+        if call == 'move_if_exists':
+            if g_handle.exists(args[0]):
+                g_handle.mv(args[0], args[1])
+        elif call == 'remove_if_exists':
+            if g_handle.exists(args[0]):
+                g_handle.rm_rf(args[0])
+        elif call == 'restore_backup':
+            if g_handle.exists(args[0]):
+                g_handle.rm_rf(args[1])
+                g_handle.mv(args[0], args[1])
+        else:
+            getattr(g_handle, call)(*args)
+
+    def _tar_in(self, files):
+        """
+        Internal method to write files, an OrderedDict of path -> [content,
+        mode], to the disk image in a single tar stream.
+        """
+        tarfp = tempfile.NamedTemporaryFile(prefix="oz-batch-", suffix=".tar")
+        try:
+            tar = tarfile.open(fileobj=tarfp, mode='w')
+            try:
+                for path, (content, mode) in files.items():
+                    if not isinstance(content, bytes):
+                        content = content.encode('utf-8')
+                    info = tarfile.TarInfo(path.lstrip('/'))
+                    info.size = len(content)
+                    info.mode = mode
+                    info.mtime = time.time()
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = "root"
+                    tar.addfile(info, io.BytesIO(content))
+            finally:
+                tar.close()
+            tarfp.flush()
+            self.g_handle.tar_in(tarfp.name, '/')
+        finally:
+            tarfp.close()
+
+    def plan(self):
+        """
+        Method to turn the recorded calls into a list of ('sh', script) and
+        ('tar', files) tuples that have the same effect when they are done in
+        order.  Shell commands are moved ahead of the files written before
+        them unless they touch one of those files, so usually there is at
+        most one of each.
+        """
+        steps = []
+        script = []
+        files = collections.OrderedDict()
+
+        def _flush():
+            """
+            Function to end the current script and tar stream.
+            """
+            if script:
+                steps.append(('sh', "set -e\n" + "\n".join(script) + "\n"))
+                del script[:]
+            if files:
+                steps.append(('tar', collections.OrderedDict(files)))
+                files.clear()
+
+        for call, args in self.ops:
+            if call == 'write':
+                files[args[0]] = [args[1], 0o644]
+                continue
+            if call == 'chmod' and args[1] in files:
+                files[args[1]][1] = args[0]
+                continue
+
+            line, paths = _shell_command(call, args)
+            for path in paths:
+                if any(_path_overlaps(path, written) for written in files):
+                    _flush()
+                    break
+            script.append(line)
+        _flush()
+
+        return steps
+
+    def apply(self):
+        """
+        Method to make all of the recorded changes to the disk image.
+        """
+        self._check_created()
+
+        if not self.use_shell:
+            ops = self.ops
+            self.ops = []
+            for call, args in ops:
+                self._replay(call, args)
+            return
+
+        steps = self.plan()
+        self.ops = []
+        for kind, data in steps:
+            if kind == 'sh':
+                self.g_handle.sh(data)
+            else:
+                self._tar_in(data)
+
+def _path_overlaps(path, other):
+    """
+    Function to check whether path and other are the same, or one is under
+    the other.
+    """
+    path = path.rstrip('/')
+    other = other.rstrip('/')
+    return path == other or path.startswith(other + '/') or other.startswith(path + '/')
+
+def _shell_command(call, args):
+    """
+    Function to get the shell command for a recorded call, along with the
+    paths that the command changes.
+    """
+    if call == 'chmod':
+        return "chmod %o %s" % (args[0], quote(args[1])), [args[1]]
+    if call == 'ln_sf':
+        return "ln -sf %s %s" % (quote(args[0]), quote(args[1])), [args[1]]
+    if call in ['mv', 'move_if_exists']:
+        line = "mv %s %s" % (quote(args[0]), quote(args[1]))
+        if call == 'move_if_exists':
+            line = "if [ -e %s ]; then %s; fi" % (quote(args[0]), line)
+        return line, [args[0], args[1]]
+    if call == 'restore_backup':
+        return "if [ -e %s ]; then rm -rf %s; mv %s %s; fi" % (quote(args[0]),
+                                                            quote(args[1]),
+                                                            quote(args[0]),
+                                                            quote(args[1])), [args[0], args[1]]
+    if call == 'remove_if_exists':
+        return "if [ -e %s ]; then rm -rf %s; fi" % (quote(args[0]),
+                                                     quote(args[0])), [args[0]]
+
+    commands = {'mkdir': "mkdir", 'mkdir_p': "mkdir -p", 'rm': "rm",
+                'rm_f': "rm -f", 'rm_rf': "rm -rf"}
+    return "%s %s" % (commands[call], quote(args[0])), [args[0]]
@@ -0,0 +1,221 @@
+# Copyright (C) 2014  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Management of the libguestfs appliances that Oz uses
+"""
+
+import threading
+import logging
+import time
+import guestfs
+
+import oz.ozutil
+
+_manager_lock = threading.Lock()
+_manager = None
+
+class GuestfsManager(object):
+    """
+    Class to hand out launched libguestfs handles.  Launching the appliance
+    takes several seconds, so when keep_warm is True and the libguestfs
+    backend can hot-plug drives, handles are not closed when they are
+    released; their drives are removed instead, and the next caller gets the
+    running appliance with its own drives hot-added.  Otherwise, every
+    caller gets a handle of its own, which is closed when it is released.
+    All of the appliances are built in (and reused from) cachedir.
+    """
+    def __init__(self, cachedir, keep_warm):
+        self.log = logging.getLogger('%s.%s' % (__name__,
+                                                self.__class__.__name__))
+        self.cachedir = cachedir
+        self.keep_warm = keep_warm
+        # None until we know whether the backend can hot-plug drives
+        self.hotplug = None
+        # list of (description, seconds) tuples, one for each launch
+        self.launch_times = []
+        self._lock = threading.Lock()
+        self._idle = []
+        self._labels = {}
+        self._label_seq = 0
+
+    def _new_handle(self):
+        """
+        Internal method to create an unlaunched handle.
+        """
+        g_handle = guestfs.GuestFS()
+        if self.cachedir is not None:
+            oz.ozutil.mkdir_p(self.cachedir)
+            try:
+                g_handle.set_cachedir(self.cachedir)
+            except AttributeError:
+                # older libguestfs only looks at LIBGUESTFS_CACHEDIR
+                pass
+        return g_handle
+
+    def _launch(self, g_handle, description):
+        """
+        Internal method to launch the appliance of a handle, and to record
+        how long that took.
+        """
+        self.log.debug("Launching guestfs for %s", description)
+        start = time.time()
+        g_handle.launch()
+        elapsed = time.time() - start
+        self.log.debug("Launched guestfs for %s in %.1f seconds", description,
+                       elapsed)
+        with self._lock:
+            self.launch_times.append((description, elapsed))
+
+    def _warm_handle(self):
+        """
+        Internal method to get a launched handle without drives that drives
+        can be hot-plugged into, or None if there is no such thing.
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            if not self.keep_warm or self.hotplug is False:
+                return None
+
+        g_handle = self._new_handle()
+        if self.hotplug is None:
+            try:
+                backend = g_handle.get_backend()
+            except AttributeError:
+                backend = ''
+            if not backend.startswith('libvirt'):
+                self.log.debug("The guestfs backend (%s) cannot hot-plug drives, not keeping appliances around",
+                               backend)
+                self.hotplug = False
+                g_handle.close()
+                return None
+
+        try:
+            self._launch(g_handle, "a warm appliance")
+        except RuntimeError:
+            self.log.debug("Could not launch guestfs without drives",
+                           exc_info=True)
+            self.hotplug = False
+            g_handle.close()
+            return None
+
+        return g_handle
+
+    def open(self, drives, description):
+        """
+        Method to get a launched handle with drives attached.  drives is a
+        list of (path, format, readonly) tuples.  Returns a tuple of the
+        handle and the list of the devices of the drives, in the same order.
+        The handle must be given back with release().
+        """
+        hotplug_failed = False
+        g_handle = self._warm_handle()
+        if g_handle is not None:
+            labels = []
+            try:
+                for path, fmt, readonly in drives:
+                    with self._lock:
+                        self._label_seq += 1
+                        label = "oz%d" % (self._label_seq)
+                    g_handle.add_drive_opts(path, format=fmt,
+                                            readonly=int(readonly),
+                                            label=label)
+                    labels.append(label)
+                disk_labels = g_handle.list_disk_labels()
+                devices = [disk_labels[name] for name in labels]
+                with self._lock:
+                    self.hotplug = True
+                    self._labels[id(g_handle)] = labels
+                self.log.debug("Hot-plugged %s into a warm guestfs appliance",
+                               description)
+                return g_handle, devices
+            except (RuntimeError, KeyError):
+                # this can just as well be the fault of the drives (say, a
+                # missing file) as of hot-plugging; the cold launch below
+                # tells which
+                self.log.debug("Could not hot-plug %s", description,
+                               exc_info=True)
+                hotplug_failed = True
+                with self._lock:
+                    self._labels[id(g_handle)] = labels
+                self.release(g_handle)
+
+        g_handle = self._new_handle()
+        try:
+            for path, fmt, readonly in drives:
+                g_handle.add_drive_opts(path, format=fmt, readonly=int(readonly))
+            self._launch(g_handle, description)
+        except:
+            g_handle.close()
+            raise
+
+        if hotplug_failed:
+            self.log.debug("The guestfs backend cannot hot-plug drives, not keeping appliances around")
+            self._disable_hotplug()
+
+        return g_handle, g_handle.list_devices()
+
+    def _disable_hotplug(self):
+        """
+        Internal method to stop hot-plugging drives, and to close the warm
+        appliances.
+        """
+        with self._lock:
+            self.hotplug = False
+            idle = self._idle
+            self._idle = []
+        for g_handle in idle:
+            g_handle.close()
+
+    def release(self, g_handle):
+        """
+        Method to give back a handle returned by open().  Anything that is
+        still mounted is unmounted, and the volume groups on the drives are
+        deactivated, so that the warm appliance keeps no device-mapper
+        devices pointing at drives that are gone.
+        """
+        with self._lock:
+            labels = self._labels.pop(id(g_handle), None)
+        if labels is None:
+            g_handle.close()
+            return
+
+        try:
+            g_handle.umount_all()
+            g_handle.vg_activate_all(False)
+            for label in labels:
+                g_handle.remove_drive(label)
+        except RuntimeError:
+            self.log.debug("Could not clean the drives out of a warm guestfs appliance",
+                           exc_info=True)
+            g_handle.close()
+            return
+
+        with self._lock:
+            self._idle.append(g_handle)
+
+def get_guestfs_manager(cachedir=None, keep_warm=True):
+    """
+    Function to get the GuestfsManager shared by all of the guests in this
+    process.  The arguments only matter for the first call.
+    """
+    global _manager
+
+    with _manager_lock:
+        if _manager is None:
+            _manager = GuestfsManager(cachedir, keep_warm)
+        return _manager
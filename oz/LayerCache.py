@@ -0,0 +1,126 @@
+# Copyright (C) 2014  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Cache of the disk layers of customizations
+"""
+
+import hashlib
+import errno
+import json
+import os
+import uuid
+
+import oz.ozutil
+
+def file_digest(filename):
+    """
+    Function to get the SHA-256 hex digest of the contents of a file.
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+class LayerCache(object):
+    """
+    Class to keep the disk state after each step of a customization as a
+    qcow2 layer, keyed by a hash over the base image and all of the steps up
+    to and including that one.  Each layer is backed by the layer of the
+    step before it, so a customization whose first steps match an earlier
+    one can start from the deepest layer that is already there.  A layer is
+    only used once it is published, that is once its metadata (the name of
+    the layer file, and whatever the customization needs to carry on from
+    it) is written to <hash>.json; the layer files themselves get names of
+    their own, so concurrent customizations never write to the same file.
+    """
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+
+    def chain(self, base, steps):
+        """
+        Method to get the list of chained hashes of steps (a list of
+        strings that describe the steps), starting from the description of
+        the base image.
+        """
+        hashes = []
+        previous = hashlib.sha256(base.encode('utf-8')).hexdigest()
+        for step in steps:
+            previous = hashlib.sha256((previous + "\n" + step).encode('utf-8')).hexdigest()
+            hashes.append(previous)
+        return hashes
+
+    def _metafile(self, key):
+        """
+        Internal method to get the name of the metadata file of a layer.
+        """
+        return os.path.join(self.cachedir, key + ".json")
+
+    def load(self, key):
+        """
+        Method to get the metadata of a published layer, or None if there is
+        no such (usable) layer.
+        """
+        try:
+            with open(self._metafile(key)) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not os.path.exists(meta.get('file', '')):
+            return None
+        return meta
+
+    def deepest(self, hashes):
+        """
+        Method to find how many of the leading hashes have a published layer.
+        """
+        depth = 0
+        for key in hashes:
+            if self.load(key) is None:
+                break
+            depth += 1
+        return depth
+
+    def new_file(self, prefix):
+        """
+        Method to get a unique name for a new layer file, starting with
+        prefix.
+        """
+        oz.ozutil.mkdir_p(self.cachedir)
+        return os.path.join(self.cachedir,
+                            "%s-%s.qcow2" % (prefix[:16], uuid.uuid4().hex))
+
+    def publish(self, key, meta):
+        """
+        Method to publish a layer.  Returns False if the layer was already
+        published by somebody else, in which case the caller still owns the
+        files it made.
+        """
+        oz.ozutil.mkdir_p(self.cachedir)
+        try:
+            fd = os.open(self._metafile(key),
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError as err:
+            if err.errno == errno.EEXIST:
+                return False
+            raise
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        return True
@@ -19,12 +19,40 @@ Linux installation
 """
 
 import re
-import time
 import libvirt
 import os
+import shutil
+import subprocess
+import tempfile
+import json
+import time
+import lxml.etree
 
 import oz.Guest
+import oz.LayerCache
 import oz.OzException
+import oz.SocketMonitor
+import oz.ozutil
+
+# what debian-installer (which the Debian and Ubuntu guests use) prints on
+# the console
+DI_STAGE_PATTERNS = [
+    (r'Installing the base system', 'base system installation'),
+    (r'Configuring apt|Configuring the package manager', 'package manager configuration'),
+    (r'Select and install software', 'software installation'),
+    (r'Installing (?:the )?GRUB', 'boot loader installation'),
+    (r'Finishing the installation', 'finishing'),
+]
+DI_ERROR_PATTERNS = [
+    (r'An installation step failed|Installation step failed', 'installation step failed'),
+    (r'Bad archive mirror', 'bad archive mirror'),
+    (r'Debootstrap [Ee]rror|Failed to determine the codename for the release', 'base system installation failed'),
+    (r'Unable to install (?:GRUB|the selected kernel)', 'boot loader installation failed'),
+    (r'No kernel modules were found|No common CD-ROM drive was detected', 'installer media problem'),
+    (r'Failed to (?:partition|create a file system)|No root file system is defined', 'partitioning failed'),
+    (r'Failed to run preseeded command|Execution of preseeded command', 'preseeded command failed'),
+    (re.escape(oz.ozutil.INSTALL_SCRIPT_FAILED_MARKER), 'customization failed'),
+]
 
 class LinuxCDGuest(oz.Guest.CDGuest):
     """
@@ -36,34 +64,105 @@ class LinuxCDGuest(oz.Guest.CDGuest):
                                   nicmodel, None, None, diskbus, iso_allowed,
                                   url_allowed, macaddress)
 
+        # (guest address, control directory, control socket) of the master
+        # ssh connection that commands and uploads are multiplexed over
+        self.ssh_session = None
+        # the directories known to exist on the guest of ssh_session
+        self.ssh_known_dirs = set()
+        # the private key to log into the guest with.  A guest restored from
+        # a saved memory state or started from a cached layer was set up
+        # with the key of an earlier customization, which is kept with the
+        # state or the layer; the shared sshprivkey is never overwritten
+        self.guest_sshkey = self.sshprivkey
+
     def _test_ssh_connection(self, guestaddr):
         """
         Internal method to test out the ssh connection before we try to use it.
         Under systemd, the IP address of a guest can come up and reportip can
         run before the ssh key is generated and sshd starts up.  This check
-        makes sure that we allow an additional 30 seconds (1 second per ssh
-        attempt) for sshd to finish initializing.
+        allows an additional 30 seconds for sshd to finish initializing.  To
+        keep it cheap, the ssh port is probed for the sshd banner (every
+        quarter of a second, sharing one thread with the probes of the other
+        guests in this process), and a single authenticated command is only
+        run once sshd has answered.
         """
-        count = 30
-        success = False
-        while count > 0:
-            try:
-                self.log.debug("Testing ssh connection, try %d", count)
-                start = time.time()
-                self.guest_execute_command(guestaddr, 'ls', timeout=1)
-                self.log.debug("Succeeded")
-                success = True
-                break
-            except oz.ozutil.SubprocessException:
-                # ensure that we spent at least one second before trying again
-                end = time.time()
-                if (end - start) < 1:
-                    time.sleep(1 - (end - start))
-                count -= 1
+        probe = oz.SocketMonitor.SshBannerProbe(guestaddr)
+        probe.start()
+        try:
+            self.log.debug("Waiting for the ssh banner of the guest")
+            if not probe.wait(30):
+                self.log.debug("Failed to connect to ssh on running guest")
+                raise oz.OzException.OzException("Failed to connect to ssh on running guest")
+        finally:
+            probe.cancel()
+
+        self.log.debug("Got ssh banner %s after %d tries", probe.banner,
+                       probe.attempts)
+
+        try:
+            self.guest_execute_command(guestaddr, 'ls')
+        except oz.ozutil.SubprocessException:
+            self.log.debug("Failed to log in with ssh on running guest")
+            raise oz.OzException.OzException("Failed to log in with ssh on running guest")
+
+    def _image_ssh_setup_announce_service(self, g_handle):
+        """
+        Method to install a systemd service that makes the guest announce
+        itself once, as soon as it has an address and sshd is listening.  The
+        announcement cron job only runs once a minute, so it stays around as a
+        fallback in case the service gives up.  Nothing is done on guests
+        that do not use systemd.
+        """
+        if not g_handle.is_dir('/etc/systemd/system'):
+            return
 
-        if not success:
-            self.log.debug("Failed to connect to ssh on running guest")
-            raise oz.OzException.OzException("Failed to connect to ssh on running guest")
+        self.log.debug("Installing the announcement service")
+
+        g_handle.write('/root/reportip-boot', """\
+#!/bin/bash
+for i in $(seq 1 120); do
+    DEV=$(awk '{if ($2 == 0) print $1}' /proc/net/route | head -n 1)
+    if [ -n "$DEV" ]; then
+        ADDR=$(ip -4 -o addr show dev $DEV | awk '{print $4}' | cut -d/ -f1 | head -n 1)
+        # port 22 (0016) in the LISTEN (0A) state
+        if [ -n "$ADDR" ] && grep -q ':0016 0*:0000 0A ' /proc/net/tcp /proc/net/tcp6 2>/dev/null; then
+            echo -n "!$ADDR,%s!" > /dev/ttyS1
+            exit 0
+        fi
+    fi
+    sleep 0.5
+done
+exit 0
+""" % (self.announce_token))
+        g_handle.chmod(0o755, '/root/reportip-boot')
+
+        g_handle.write('/etc/systemd/system/oz-announce.service', """\
+[Unit]
+Description=Announce the guest to the Oz host
+Wants=network-online.target
+After=network-online.target sshd.service ssh.service
+
+[Service]
+Type=oneshot
+ExecStart=/bin/bash /root/reportip-boot
+
+[Install]
+WantedBy=multi-user.target
+""")
+
+        g_handle.mkdir_p('/etc/systemd/system/multi-user.target.wants')
+        g_handle.ln_sf('/etc/systemd/system/oz-announce.service',
+                       '/etc/systemd/system/multi-user.target.wants/oz-announce.service')
+
+    def _image_ssh_teardown_announce_service(self, g_handle):
+        """
+        Method to undo _image_ssh_setup_announce_service.
+        """
+        self.log.debug("Removing the announcement service")
+        for path in ['/etc/systemd/system/multi-user.target.wants/oz-announce.service',
+                     '/etc/systemd/system/oz-announce.service',
+                     '/root/reportip-boot']:
+            self._guestfs_remove_if_exists(g_handle, path)
 
     def get_default_runlevel(self, g_handle):
         """
@@ -79,9 +178,9 @@ class LinuxCDGuest(oz.Guest.CDGuest):
 
         return runlevel
 
-    def guest_execute_command(self, guestaddr, command, timeout=10):
+    def _ssh_options(self, guestaddr, timeout):
         """
-        Method to execute a command on the guest and return the output.
+        Internal method to get the options that ssh and scp are run with.
         """
         # ServerAliveInterval protects against NAT firewall timeouts
         # on long-running commands with no output
@@ -91,57 +190,192 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         #
         # -F /dev/null makes sure that we don't use the global or per-user
         # configuration files
+        options = ["-i", self.guest_sshkey,
+                   "-F", "/dev/null",
+                   "-o", "ServerAliveInterval=30",
+                   "-o", "StrictHostKeyChecking=no",
+                   "-o", "ConnectTimeout=" + str(timeout),
+                   "-o", "UserKnownHostsFile=/dev/null",
+                   "-o", "PasswordAuthentication=no",
+                   "-o", "IdentitiesOnly yes"]
 
-        return oz.ozutil.subprocess_check_output(["ssh", "-i", self.sshprivkey,
-                                                  "-F", "/dev/null",
-                                                  "-o", "ServerAliveInterval=30",
-                                                  "-o", "StrictHostKeyChecking=no",
-                                                  "-o", "ConnectTimeout=" + str(timeout),
-                                                  "-o", "UserKnownHostsFile=/dev/null",
-                                                  "-o", "PasswordAuthentication=no",
-                                                  "-o", "IdentitiesOnly yes",
-                                                  "root@" + guestaddr, command],
-                                                 printfn=self.log.debug)
+        if self.ssh_session is not None and self.ssh_session[0] == guestaddr:
+            # if the master connection went away, ssh just connects on its own
+            options += ["-o", "ControlPath=" + self.ssh_session[2]]
+
+        return options
+
+    def _open_ssh_session(self, guestaddr, timeout=10):
+        """
+        Method to open a master ssh connection to the guest.  Until
+        _close_ssh_session() is called, guest_execute_command() and
+        guest_live_upload() run over this connection instead of connecting
+        and authenticating every time.  If the master connection cannot be
+        opened, they just keep connecting on their own.
+        """
+        self._close_ssh_session()
+
+        # the control socket has to fit into a unix socket address, so keep
+        # its path short
+        controldir = tempfile.mkdtemp(prefix="oz-ssh-")
+        controlpath = os.path.join(controldir, "master")
+        masterlog = os.path.join(controldir, "master.log")
+
+        # -f sends the master to the background once it is logged in.  Its
+        # output goes to a file, since it lives on after ssh returns
+        with open(os.devnull, 'r') as devnull:
+            with open(masterlog, 'w') as logfp:
+                retcode = subprocess.call(["ssh"] + self._ssh_options(guestaddr, timeout) +
+                                          ["-M", "-N", "-f",
+                                           "-o", "ControlPath=" + controlpath,
+                                           "root@" + guestaddr],
+                                          stdin=devnull, stdout=logfp,
+                                          stderr=logfp)
+        if retcode != 0:
+            with open(masterlog, 'r') as logfp:
+                self.log.debug("Master ssh connection failed(%d): %s", retcode,
+                               logfp.read())
+            self.log.warn("Could not open a shared ssh connection to the guest, connecting for every command")
+            shutil.rmtree(controldir)
+            return
+
+        self.ssh_session = (guestaddr, controldir, controlpath)
+
+    def _close_ssh_session(self):
+        """
+        Method to close the master ssh connection opened by
+        _open_ssh_session(), if any.
+        """
+        if self.ssh_session is None:
+            return
+
+        guestaddr, controldir, controlpath = self.ssh_session
+        self.ssh_session = None
+        self.ssh_known_dirs = set()
+
+        try:
+            # after a shutdown, the master has usually exited on its own
+            oz.ozutil.subprocess_check_output(["ssh", "-F", "/dev/null",
+                                               "-o", "ControlPath=" + controlpath,
+                                               "-O", "exit",
+                                               "root@" + guestaddr],
+                                              printfn=self.log.debug)
+        except oz.ozutil.SubprocessException:
+            pass
+        shutil.rmtree(controldir, ignore_errors=True)
+
+    def guest_execute_command(self, guestaddr, command, timeout=10,
+                              stdin=None):
+        """
+        Method to execute a command on the guest and return the output.  If
+        stdin is given, it is a file that the command reads its input from.
+        """
+        kwargs = {}
+        if stdin is not None:
+            kwargs['stdin'] = stdin
+
+        return oz.ozutil.subprocess_check_output(["ssh"] + self._ssh_options(guestaddr, timeout) +
+                                                 ["root@" + guestaddr, command],
+                                                 printfn=self.log.debug,
+                                                 **kwargs)
 
     def guest_live_upload(self, guestaddr, file_to_upload, destination,
                           timeout=10):
         """
         Method to copy a file to the live guest.
         """
-        self.guest_execute_command(guestaddr,
-                                   "mkdir -p " + os.path.dirname(destination),
-                                   timeout)
+        # over the shared connection, there is no need to create the same
+        # directory over and over again
+        directory = os.path.dirname(destination)
+        if self.ssh_session is None or directory not in self.ssh_known_dirs:
+            self.guest_execute_command(guestaddr, "mkdir -p " + directory,
+                                       timeout)
+            if self.ssh_session is not None:
+                self.ssh_known_dirs.add(directory)
 
-        # ServerAliveInterval protects against NAT firewall timeouts
-        # on long-running commands with no output
-        #
-        # PasswordAuthentication=no prevents us from falling back to
-        # keyboard-interactive password prompting
-        #
-        # -F /dev/null makes sure that we don't use the global or per-user
-        # configuration files
-        return oz.ozutil.subprocess_check_output(["scp", "-i", self.sshprivkey,
-                                                  "-F", "/dev/null",
-                                                  "-o", "ServerAliveInterval=30",
-                                                  "-o", "StrictHostKeyChecking=no",
-                                                  "-o", "ConnectTimeout=" + str(timeout),
-                                                  "-o", "UserKnownHostsFile=/dev/null",
-                                                  "-o", "PasswordAuthentication=no",
-                                                  "-o", "IdentitiesOnly yes",
-                                                  file_to_upload,
+        return oz.ozutil.subprocess_check_output(["scp"] + self._ssh_options(guestaddr, timeout) +
+                                                 [file_to_upload,
                                                   "root@" + guestaddr + ":" + destination],
                                                  printfn=self.log.debug)
 
-    def _customize_files(self, guestaddr):
+    def _customize_files(self, guestaddr, files=None):
         """
-        Method to upload the custom files specified in the TDL to the guest.
+        Method to upload the custom files specified in the TDL (or just the
+        ones in files, a dictionary of the same form as self.tdl.files) to
+        the guest.
         """
         self.log.info("Uploading custom files")
-        for name, fp in list(self.tdl.files.items()):
-            # all of the self.tdl.files are named temporary files; we just need
-            # to fetch the name out and have scp upload it
+        if files is None:
+            files = self.tdl.files
+        if not files:
+            return
+
+        # all of the files are named temporary files; we just need to fetch
+        # the names out.  They are streamed to the guest as a single tar
+        # archive, which also creates the directories they go into
+        filedict = {}
+        for name, fp in list(files.items()):
+            filedict[fp.name] = name
+
+        tarfp = tempfile.NamedTemporaryFile(prefix="oz-files-", suffix=".tar")
+        try:
+            oz.ozutil.write_tar(filedict, tarfp.name)
+            try:
+                self.guest_execute_command(guestaddr,
+                                           "tar -C / --no-overwrite-dir -xpf -",
+                                           timeout=10, stdin=tarfp)
+                return
+            except oz.ozutil.SubprocessException:
+                # most likely there is no tar in the guest
+                self.log.debug("Uploading the files as a tar archive failed, uploading them one by one")
+        finally:
+            tarfp.close()
+
+        for name, fp in list(files.items()):
             self.guest_live_upload(guestaddr, fp.name, name)
 
+    def _run_commands(self, guestaddr, commands, phase):
+        """
+        Method to run the custom commands of one phase ("precommands" or
+        "commands") of the TDL in the guest, in order.  With batch_commands,
+        all of them are run by a single script that is streamed to the guest
+        over one ssh session.
+        """
+        if not commands:
+            return
+
+        if not self.batch_commands:
+            for cmd in commands:
+                self.guest_execute_command(guestaddr, cmd.read())
+            return
+
+        texts = [cmd.read() for cmd in commands]
+        runnerfp = tempfile.NamedTemporaryFile(prefix="oz-runner-",
+                                               suffix=".sh")
+        try:
+            runnerfp.write(oz.ozutil.generate_command_runner(texts))
+            runnerfp.flush()
+            runnerfp.seek(0)
+            # the commands read their input from /dev/null, so the runner
+            # can be fed to the shell on its standard input
+            stdout, stderr, retcode = self.guest_execute_command(guestaddr,
+                                                                 "sh -s",
+                                                                 stdin=runnerfp)
+        finally:
+            runnerfp.close()
+
+        results = oz.ozutil.parse_runner_output(stdout)
+        for index, status, output in results:
+            self.log.debug("Custom %s: command %d of %d exited with status %s",
+                           phase, index, len(texts), status)
+
+        if not results or results[-1][1] != 0 or len(results) != len(texts):
+            if results:
+                index, status, output = results[-1]
+            else:
+                index, status, output = 1, None, stdout
+            raise oz.OzException.OzException("Custom %s: command %d failed (status %s): %s" % (phase, index, status, output.strip()))
+
     def _shutdown_guest(self, guestaddr, libvirt_dom):
         """
         Method to shutdown the guest (gracefully at first, then with prejudice).
@@ -226,8 +460,7 @@ class LinuxCDGuest(oz.Guest.CDGuest):
 
         self._customize_repos(guestaddr)
 
-        for cmd in self.tdl.precommands:
-            self.guest_execute_command(guestaddr, cmd.read())
+        self._run_commands(guestaddr, self.tdl.precommands, "precommands")
 
         self.log.debug("Installing custom packages")
         packstr = ''
@@ -240,15 +473,271 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         self._customize_files(guestaddr)
 
         self.log.debug("Running custom commands")
-        for cmd in self.tdl.commands:
-            self.guest_execute_command(guestaddr, cmd.read())
+        self._run_commands(guestaddr, self.tdl.commands, "commands")
+
+        self._finish_customize(guestaddr)
 
+    def _finish_customize(self, guestaddr):
+        """
+        Method to do what is left after all of the customization steps.
+        """
         self.log.debug("Removing non-persisted repos")
         self._remove_repos(guestaddr)
 
         self.log.debug("Syncing")
         self.guest_execute_command(guestaddr, 'sync')
 
+    def _customize_steps(self):
+        """
+        Method to split the customization in the TDL up into the steps that
+        do_customize goes through.  Returns a list of (kind, key, function)
+        tuples in order, where key describes everything that goes into the
+        step, and function does the step when it is called with the address
+        of the guest.  Unlike in do_customize, every command is a step of
+        its own.
+        """
+        steps = []
+        if self.tdl.repositories:
+            repos = sorted([[repo.name, repo.url, repo.signed, repo.persisted,
+                             repo.sslverify]
+                            for repo in self.tdl.repositories.values()])
+            steps.append(('repos', "repos " + json.dumps(repos),
+                          self._customize_repos))
+
+        def _command_step(kind, cmd):
+            """
+            Function to get the step that runs a single command.
+            """
+            return (kind, "%s %s" % (kind, oz.LayerCache.file_digest(cmd.name)),
+                    lambda guestaddr: self._run_commands(guestaddr, [cmd],
+                                                         kind + "s"))
+
+        for cmd in self.tdl.precommands:
+            steps.append(_command_step('precommand', cmd))
+
+        if self.tdl.packages:
+            names = [package.name for package in self.tdl.packages]
+            packstr = ''.join(['"' + name + '" ' for name in names])
+            steps.append(('packages', "packages " + json.dumps(sorted(names)),
+                          lambda guestaddr: self._install_packages(guestaddr,
+                                                                   packstr)))
+
+        for name in sorted(self.tdl.files.keys()):
+            fp = self.tdl.files[name]
+            steps.append(('file', "file %s %s" % (json.dumps(name),
+                                                  oz.LayerCache.file_digest(fp.name)),
+                          lambda guestaddr, name=name, fp=fp: self._customize_files(guestaddr, {name: fp})))
+
+        for cmd in self.tdl.commands:
+            steps.append(_command_step('command', cmd))
+
+        return steps
+
+    def _preseed_repository(self, repo):
+        """
+        Method to get the apt-setup form ("<url> <suite> <components>") of
+        a TDL repository, or None if it has no such form (like a PPA).
+        """
+        line = repo.url.strip('\'"').strip()
+        if line.startswith("deb "):
+            line = line[4:].strip()
+        if not re.match(r"^(https?|ftp|file)://\S+\s+\S+", line):
+            return None
+        return line
+
+    def _preseed_can_customize(self):
+        """
+        Method to find out whether debian-installer can do the
+        customization in the TDL.  The precommands have to run before the
+        packages are installed in a running guest, which a preseed cannot
+        do, and apt-setup only takes plain sources.list entries.
+        """
+        if self.tdl.precommands:
+            self.log.debug("The TDL has precommands, so it cannot be customized during the install")
+            return False
+        for repo in list(self.tdl.repositories.values()):
+            if self._preseed_repository(repo) is None:
+                self.log.debug("Repository %s is not a sources.list entry, so the TDL cannot be customized during the install",
+                               repo.name)
+                return False
+        return True
+
+    def _preseed_add_customization(self, preseedpath, installer_dir):
+        """
+        Method to add the customization in the TDL to a preseed file: the
+        repositories become apt-setup local repositories and the packages
+        are added to pkgsel/include.  The files and commands go into a
+        script next to the preseed file, which the installer finds in
+        installer_dir and runs in the installed system from the
+        late_command; if it fails, INSTALL_SCRIPT_FAILED_MARKER is written to
+        the serial console.  Returns the path of the script.
+        """
+        self.log.debug("Adding the customization to the preseed file")
+        with open(preseedpath) as f:
+            physical = f.readlines()
+
+        # a setting can be continued on the next line with a backslash, so
+        # work on whole settings
+        lines = []
+        current = ""
+        for line in physical:
+            current += line
+            if not line.rstrip("\n").endswith("\\"):
+                lines.append(current)
+                current = ""
+        if current:
+            lines.append(current)
+
+        names = " ".join([package.name for package in self.tdl.packages])
+        scriptname = os.path.join(installer_dir, "oz-customize.sh")
+        # a failing late_command stops the installer at a dialog, so it is
+        # also reported on the serial console, where the install is watched
+        late = "cp %s /target/tmp/oz-customize.sh && in-target sh /tmp/oz-customize.sh || { echo %s > /dev/ttyS0 ; exit 1 ; }" % (scriptname, oz.ozutil.INSTALL_SCRIPT_FAILED_MARKER)
+
+        used = set()
+        have_include = False
+        have_late = False
+        for index, line in enumerate(lines):
+            match = re.match(r"^d-i\s+apt-setup/local(\d+)/", line)
+            if match:
+                used.add(int(match.group(1)))
+            if re.match(r"^d-i\s+pkgsel/include\s+string", line) and names:
+                lines[index] = line.rstrip("\n") + " " + names + "\n"
+                have_include = True
+            elif re.match(r"^d-i\s+preseed/late_command\s+string", line):
+                lines[index] = line.rstrip("\n") + " ; \\\n    " + late + "\n"
+                have_late = True
+
+        extra = ["\n"]
+        if names and not have_include:
+            extra.append("d-i pkgsel/include string %s\n" % (names))
+        localnum = 0
+        unsigned = False
+        for repo in list(self.tdl.repositories.values()):
+            while localnum in used:
+                localnum += 1
+            prefix = "d-i apt-setup/local%d/" % (localnum)
+            extra += [prefix + "repository string %s\n" % (self._preseed_repository(repo)),
+                      prefix + "comment string %s\n" % (repo.name),
+                      prefix + "source boolean false\n"]
+            used.add(localnum)
+            if not repo.signed:
+                unsigned = True
+        if unsigned:
+            extra.append("d-i debian-installer/allow_unauthenticated boolean true\n")
+        if not have_late:
+            extra.append("d-i preseed/late_command string %s\n" % (late))
+
+        with open(preseedpath, 'w') as f:
+            f.writelines(lines + extra)
+
+        files = []
+        for name, fp in sorted(self.tdl.files.items()):
+            with open(fp.name, 'rb') as f:
+                files.append((name, f.read()))
+        commands = []
+        for cmd in self.tdl.commands:
+            with open(cmd.name) as f:
+                commands.append(f.read())
+
+        scriptpath = os.path.join(os.path.dirname(preseedpath),
+                                  "oz-customize.sh")
+        with open(scriptpath, 'w') as f:
+            f.write(oz.ozutil.generate_install_script(files, commands,
+                                                      ["/tmp/oz-customize.sh"]))
+
+        return scriptpath
+
+    def _can_customize_offline(self):
+        """
+        Method to find out whether the customization can be done on the disk
+        image, without booting the guest.  That is the case when the TDL only
+        has files and commands that are marked as safe to run offline; package
+        and repository changes always need a running guest.
+        """
+        if not self.offline_customize:
+            return False
+        if self.tdl.packages or self.tdl.repositories:
+            return False
+        for cmd in self.tdl.precommands + self.tdl.commands:
+            if cmd not in self.tdl.offline_commands:
+                return False
+        return True
+
+    def _offline_execute_command(self, g_handle, command):
+        """
+        Method to run a command in a chroot of the disk image of the guest.
+        """
+        try:
+            output = g_handle.sh(command)
+        except RuntimeError as err:
+            raise oz.OzException.OzException("Offline command failed: %s" % (err))
+        self.log.debug(output)
+
+    def _offline_relabel(self, g_handle, paths):
+        """
+        Method to restore the SELinux labels of paths on the disk image of the
+        guest, if the guest uses SELinux.
+        """
+        if not g_handle.is_file('/etc/selinux/config'):
+            return
+
+        selinuxtype = 'targeted'
+        for line in g_handle.read_lines('/etc/selinux/config'):
+            if line.startswith('SELINUXTYPE='):
+                selinuxtype = line.split('=', 1)[1].strip()
+        specfile = '/etc/selinux/%s/contexts/files/file_contexts' % (selinuxtype)
+
+        try:
+            for path in paths:
+                g_handle.selinux_relabel(specfile, path)
+        except (AttributeError, RuntimeError):
+            # older libguestfs, or no setfiles in the guest; have the guest
+            # relabel itself on the next boot instead
+            self.log.debug("Could not relabel the disk image, scheduling a relabel on the next boot")
+            g_handle.touch('/.autorelabel')
+
+    def _offline_customize(self, libvirt_xml):
+        """
+        Method to customize the disk image of the guest through libguestfs,
+        without booting it.  The files are written in a single tar stream and
+        the commands are run in a chroot, in the same order as a customization
+        of the running guest would do it.
+        """
+        self.log.info("Customizing image offline")
+
+        g_handle = self._guestfs_handle_setup(libvirt_xml)
+        try:
+            for cmd in self.tdl.precommands:
+                self._offline_execute_command(g_handle, cmd.read())
+
+            relabel = []
+            if self.tdl.files:
+                self.log.info("Writing custom files")
+                filedict = {}
+                for name, fp in list(self.tdl.files.items()):
+                    filedict[fp.name] = name
+                    relabel.append(name)
+
+                tarfp = tempfile.NamedTemporaryFile(prefix="oz-files-",
+                                                    suffix=".tar")
+                try:
+                    oz.ozutil.write_tar(filedict, tarfp.name)
+                    g_handle.tar_in(tarfp.name, '/')
+                finally:
+                    tarfp.close()
+
+            self.log.debug("Running custom commands offline")
+            for cmd in self.tdl.commands:
+                self._offline_execute_command(g_handle, cmd.read())
+
+            if self.tdl.precommands or self.tdl.commands:
+                # there is no telling what the commands touched
+                relabel = ['/']
+            self._offline_relabel(g_handle, relabel)
+        finally:
+            self._guestfs_handle_cleanup(g_handle)
+
     def do_icicle(self, guestaddr):
         """
         Default method to collect the package information and generate the
@@ -256,6 +745,412 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         """
         raise oz.OzException.OzException("ICICLE generation is not implemented for this guest type")
 
+    def _offline_package_list(self, g_handle):
+        """
+        Method to read the list of installed packages out of the package
+        database on the disk image of the guest.  The packages are named the
+        way 'rpm -qa' and 'dpkg --get-selections' name them.
+        """
+        root = g_handle.inspect_get_roots()[0]
+        package_format = g_handle.inspect_get_package_format(root)
+        if package_format not in ["rpm", "deb"]:
+            raise oz.OzException.OzException("Cannot read the packages of a guest using the %s package format" % (package_format))
+
+        packages = []
+        for app in g_handle.inspect_list_applications2(root):
+            if package_format == "deb":
+                packages.append(app['app2_name'])
+                continue
+
+            package = "%s-%s-%s" % (app['app2_name'], app['app2_version'],
+                                    app['app2_release'])
+            if app['app2_arch'] and app['app2_arch'] != "(none)":
+                package += "." + app['app2_arch']
+            packages.append(package)
+
+        return packages
+
+    def _warm_state_usable(self):
+        """
+        Method to load the metadata of the memory state saved in
+        warm_state_dir.  Returns None if there is no such state, or if the
+        JEOS changed since it was saved.
+        """
+        try:
+            with open(os.path.join(self.warm_state_dir, "state.json")) as f:
+                meta = json.load(f)
+            st = os.stat(self.jeos_filename)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if meta.get('jeos') != [st.st_size, int(st.st_mtime)]:
+            self.log.debug("The saved memory state in %s is older than the JEOS, ignoring it",
+                           self.warm_state_dir)
+            return None
+
+        for key in ['uuid', 'macaddr', 'guestaddr', 'setup']:
+            if key not in meta:
+                self.log.debug("The saved memory state in %s has no %s, ignoring it",
+                               self.warm_state_dir, key)
+                return None
+
+        return meta
+
+    def _warm_setup_state(self):
+        """
+        Method to get the attributes that _collect_setup leaves behind for
+        _collect_teardown.  A restored guest skips _collect_setup, so they
+        are saved along with its memory state.
+        """
+        state = {}
+        for attr in ['sshd_was_active', 'crond_was_active',
+                     'ssh_startuplink', 'cron_startuplink']:
+            if hasattr(self, attr):
+                state[attr] = getattr(self, attr)
+        return state
+
+    def _warm_save(self, libvirt_dom, guestaddr):
+        """
+        Method to save the memory state of the running guest, a copy of its
+        disk image and the ssh key to log into it next to the JEOS, so that
+        later customizations of the JEOS can restore the guest instead of
+        booting it.  The guest is restored right away to carry on with this
+        customization; the (possibly new) domain is returned.  A state that
+        cannot be saved is not worth failing the customization over, so
+        errors are only logged.
+        """
+        self.log.info("Saving the memory state of %s for warm restores",
+                      self.tdl.name)
+        st = os.stat(self.jeos_filename)
+        statedir = tempfile.mkdtemp(prefix=os.path.basename(self.warm_state_dir) + "-",
+                                    dir=os.path.dirname(self.warm_state_dir))
+        memfile = os.path.join(statedir, "memory.save")
+        try:
+            try:
+                libvirt_dom.save(memfile)
+            except libvirt.libvirtError as err:
+                self.log.warning("Could not save the memory state of %s: %s",
+                                 self.tdl.name, err)
+                return libvirt_dom
+
+            # the domain is stopped now, so the disk image matches the memory
+            # state until the domain is restored
+            try:
+                self._copyfile_sparse(self.diskimage,
+                                      os.path.join(statedir, "disk." + self.image_type))
+                keyfile = os.path.join(statedir, "sshkey")
+                shutil.copyfile(self.guest_sshkey, keyfile)
+                os.chmod(keyfile, 0o600)
+                saved = True
+            except (IOError, OSError) as err:
+                self.log.warning("Could not save the disk image of %s: %s",
+                                 self.tdl.name, err)
+                saved = False
+
+            self.libvirt_conn.restore(memfile)
+            libvirt_dom = self.libvirt_conn.lookupByUUIDString(str(self.uuid))
+
+            if saved:
+                meta = {'jeos': [st.st_size, int(st.st_mtime)],
+                        'uuid': self.announce_token,
+                        'macaddr': self.macaddr,
+                        'guestaddr': guestaddr,
+                        'setup': self._warm_setup_state()}
+                with open(os.path.join(statedir, "state.json"), 'w') as f:
+                    json.dump(meta, f)
+                # a stale state is replaced; if another build saved a state
+                # in the meantime, keep that one
+                if os.path.isdir(self.warm_state_dir) and self._warm_state_usable() is None:
+                    shutil.rmtree(self.warm_state_dir, ignore_errors=True)
+                try:
+                    os.rename(statedir, self.warm_state_dir)
+                except OSError:
+                    self.log.debug("Another memory state was saved in %s, discarding this one",
+                                   self.warm_state_dir)
+        finally:
+            if os.path.isdir(statedir):
+                shutil.rmtree(statedir)
+
+        return libvirt_dom
+
+    def _warm_restore(self, libvirt_xml, meta):
+        """
+        Method to restore the memory state in warm_state_dir in place of
+        booting the guest.  The saved disk image replaces the disk image of
+        this guest, which has to be an unmodified copy of the JEOS.  The
+        domain is restored with the name, UUID and MAC address of this
+        guest, so that many guests can be restored from the same state at
+        once; the ssh key and the announcement token are taken over from the
+        saved state.  Returns the restored domain.
+        """
+        self.log.info("Restoring the saved memory state of the JEOS for %s",
+                      self.tdl.name)
+        memfile = os.path.join(self.warm_state_dir, "memory.save")
+        try:
+            dxml = self.libvirt_conn.saveImageGetXMLDesc(memfile, 0)
+        except libvirt.libvirtError as err:
+            raise oz.OzException.OzException("Could not read the saved memory state: %s" % (err))
+
+        # only the host side of the domain can change on a restore: the
+        # name, UUID and MAC address, the disk image and the port the serial
+        # console is sent to
+        dxml = self._modify_libvirt_xml_diskimage(dxml, self.diskimage,
+                                                  self.image_type)
+        dxml = self._modify_libvirt_xml_for_serial(dxml)
+        doc = lxml.etree.fromstring(dxml)
+        doc.xpath('/domain/name')[0].text = self.tdl.name
+        uuidnode = doc.xpath('/domain/uuid')
+        if uuidnode:
+            uuidnode[0].text = str(self.uuid)
+        else:
+            self.lxml_subelement(doc, "uuid", str(self.uuid))
+        for mac in doc.xpath('/domain/devices/interface/mac'):
+            mac.set('address', self.macaddr)
+        dxml = lxml.etree.tostring(doc, pretty_print=True)
+
+        self._copyfile_sparse(os.path.join(self.warm_state_dir,
+                                           "disk." + self.image_type),
+                              self.diskimage)
+        try:
+            self.libvirt_conn.restoreFlags(memfile, dxml,
+                                           libvirt.VIR_DOMAIN_SAVE_RUNNING)
+            libvirt_dom = self.libvirt_conn.lookupByUUIDString(str(self.uuid))
+        except libvirt.libvirtError as err:
+            # put the JEOS back, so the guest can be booted instead
+            self._copyfile_sparse(self.jeos_filename, self.diskimage)
+            raise oz.OzException.OzException("Could not restore the saved memory state: %s" % (err))
+
+        self.announce_token = meta['uuid']
+        self.guest_sshkey = os.path.join(self.warm_state_dir, "sshkey")
+        for attr, value in meta['setup'].items():
+            setattr(self, attr, value)
+
+        return libvirt_dom
+
+    def _warm_guest_address(self, libvirt_dom, meta):
+        """
+        Method to find the address of a restored guest.  If it already has
+        a lease for its new MAC address, that is used; otherwise it normally
+        still has the address it was saved with.  If neither answers, the
+        guest is waited for like a booting one, with the announcement token
+        of the saved state.
+        """
+        for guestaddr in [self._get_leased_address(), meta['guestaddr']]:
+            if guestaddr is not None and oz.ozutil.port_open(guestaddr, 22, 5):
+                return guestaddr
+
+        self.log.debug("Restored guest does not answer on %s, waiting for it to announce itself",
+                       meta['guestaddr'])
+        return self._wait_for_guest_boot(libvirt_dom)
+
+    def _warm_sync_clock(self, guestaddr):
+        """
+        Method to set the clock of a restored guest, which is as far behind
+        as the memory state is old.
+        """
+        try:
+            self.guest_execute_command(guestaddr,
+                                       "date -u -s @%d" % (int(time.time())))
+        except oz.ozutil.SubprocessException:
+            self.log.debug("Could not set the clock of the restored guest",
+                           exc_info=True)
+
+    def _layer_setup(self, cache, key, libvirt_xml):
+        """
+        Method to create the first layer of a layered customization: a
+        qcow2 overlay on top of the JEOS that _collect_setup was done to.
+        Returns the metadata of the published layer.
+        """
+        self.log.info("Creating the setup layer of the JEOS")
+        layer = cache.new_file(key)
+        keyfile = layer[:-len(".qcow2")] + "-sshkey"
+        try:
+            self._internal_generate_diskimage(force=True,
+                                              image_filename=layer,
+                                              backing_filename=self.jeos_filename)
+            self._collect_setup(self._modify_libvirt_xml_diskimage(libvirt_xml,
+                                                                   layer,
+                                                                   'qcow2'))
+            shutil.copyfile(self.sshprivkey, keyfile)
+            os.chmod(keyfile, 0o600)
+            meta = {'file': layer,
+                    'uuid': self.announce_token,
+                    'sshkey': keyfile,
+                    'setup': self._warm_setup_state()}
+            if cache.publish(key, meta):
+                return meta
+        except:
+            for filename in [layer, keyfile]:
+                if os.path.exists(filename):
+                    os.unlink(filename)
+            raise
+
+        # another customization created the same layer in the meantime
+        os.unlink(layer)
+        os.unlink(keyfile)
+        return cache.load(key)
+
+    def _layer_snapshot(self, libvirt_dom, dev, filename):
+        """
+        Method to make the running guest write to a new qcow2 overlay at
+        filename, on top of the disk image it was writing to, so that the
+        latter stops changing.  The filesystems of the guest are frozen
+        through the guest agent while the snapshot is taken, so the layer
+        is clean.  Returns False if that cannot be done (usually because the
+        guest has no agent), in which case nothing changed.
+        """
+        if self.layer_quiesce is False:
+            return False
+
+        snap = lxml.etree.Element("domainsnapshot")
+        disks = self.lxml_subelement(snap, "disks")
+        disk = self.lxml_subelement(disks, "disk", None,
+                                    {'name': dev, 'snapshot': 'external'})
+        self.lxml_subelement(disk, "driver", None, {'type': 'qcow2'})
+        self.lxml_subelement(disk, "source", None, {'file': filename})
+        try:
+            libvirt_dom.snapshotCreateXML(lxml.etree.tostring(snap),
+                                          libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE)
+        except libvirt.libvirtError:
+            # a snapshot that is not quiesced is only crash-consistent, so
+            # the guest is shut down for each layer instead
+            self.log.debug("Could not take a quiesced snapshot of %s, shutting it down for each layer instead",
+                           self.tdl.name, exc_info=True)
+            self.layer_quiesce = False
+            return False
+
+        self.layer_quiesce = True
+        return True
+
+    def _layer_boot(self, xml, top):
+        """
+        Method to boot the guest in xml from the disk image top, and to set
+        up the ssh session to it.  Returns a tuple of the domain and the
+        address of the guest.
+        """
+        top_xml = self._modify_libvirt_xml_diskimage(xml, top, 'qcow2')
+        libvirt_dom = self.libvirt_conn.createXML(top_xml, 0)
+        try:
+            guestaddr = self._wait_for_guest_boot(libvirt_dom)
+            self._test_ssh_connection(guestaddr)
+            self._open_ssh_session(guestaddr)
+        except:
+            self._shutdown_guest(None, libvirt_dom)
+            raise
+        return libvirt_dom, guestaddr
+
+    def _layered_customize(self, libvirt_xml, action):
+        """
+        Method to customize a copy of the JEOS through the layer cache.  The
+        customization starts from the deepest layer that earlier
+        customizations left behind for the same JEOS and the same first
+        steps; after each remaining step (and after the cleanup at the end),
+        the disk state is kept as a new layer.  If all of the layers are
+        there and no ICICLE is wanted, the guest is not booted at all.  The
+        result is flattened into the disk image, which is not touched if
+        anything fails.
+        """
+        cache = oz.LayerCache.LayerCache(self.layer_cache_dir)
+        st = os.stat(self.jeos_filename)
+        base = "%s %d %d %s" % (self.jeos_filename, st.st_size,
+                                int(st.st_mtime), self.__class__.__name__)
+        # removing the repositories that are not persisted has to come last,
+        # but its layer can be kept like that of any other step
+        steps = self._customize_steps() + [('finish', "finish",
+                                            self._finish_customize)]
+        hashes = cache.chain(base, ["setup"] + [key for kind, key, func in steps])
+        depth = cache.deepest(hashes)
+        self.log.info("Customizing from %d of %d cached layers", depth,
+                      len(hashes))
+
+        modified_xml = self._modify_libvirt_xml_for_serial(libvirt_xml)
+        targets = lxml.etree.fromstring(modified_xml).xpath('/domain/devices/disk/target')
+        if len(targets) < 1:
+            raise oz.OzException.OzException("invalid libvirt XML with no disk target")
+        dev = targets[0].get('dev')
+
+        if depth == 0:
+            meta = self._layer_setup(cache, hashes[0], modified_xml)
+            depth = 1
+        else:
+            meta = cache.load(hashes[depth - 1])
+
+        # the layers were set up for remote access with the announcement
+        # token and ssh key of the customization that created them; the
+        # guest keeps its own UUID
+        self.announce_token = meta['uuid']
+        self.guest_sshkey = meta['sshkey']
+        for attr, value in meta['setup'].items():
+            setattr(self, attr, value)
+
+        # the files of this customization that are not (yet) published
+        owned = []
+        icicle = None
+        try:
+            top = cache.new_file(hashes[depth] if depth < len(hashes) else "top")
+            owned.append(top)
+            self._internal_generate_diskimage(force=True, image_filename=top,
+                                              backing_filename=meta['file'])
+
+            if depth < len(hashes) or action == "gen_and_mod":
+                libvirt_dom, guestaddr = self._layer_boot(modified_xml, top)
+                try:
+                    for index in range(depth, len(hashes)):
+                        kind, key, func = steps[index - 1]
+                        self.log.debug("Customization step %d of %d (%s)",
+                                       index, len(steps), kind)
+                        func(guestaddr)
+                        self.guest_execute_command(guestaddr, 'sync')
+
+                        nexttop = cache.new_file(hashes[index + 1] if index + 1 < len(hashes) else "top")
+                        owned.append(nexttop)
+                        if not self._layer_snapshot(libvirt_dom, dev, nexttop):
+                            # take the layer from a guest that is shut down,
+                            # and boot again from a new layer on top of it
+                            self._shutdown_guest(guestaddr, libvirt_dom)
+                            libvirt_dom = guestaddr = None
+                            self._close_ssh_session()
+                            self._internal_generate_diskimage(force=True,
+                                                              image_filename=nexttop,
+                                                              backing_filename=top)
+                        layer = dict(meta)
+                        layer['file'] = top
+                        if cache.publish(hashes[index], layer):
+                            owned.remove(top)
+                        top = nexttop
+
+                        if libvirt_dom is None and (index + 1 < len(hashes) or action == "gen_and_mod"):
+                            libvirt_dom, guestaddr = self._layer_boot(modified_xml, top)
+
+                    if action == "gen_and_mod":
+                        icicle = self.do_icicle(guestaddr)
+                finally:
+                    if libvirt_dom is not None:
+                        self._shutdown_guest(guestaddr, libvirt_dom)
+                    self._close_ssh_session()
+
+            self._collect_teardown(self._modify_libvirt_xml_diskimage(modified_xml,
+                                                                      top,
+                                                                      'qcow2'))
+
+            self.log.info("Flattening the layers into %s", self.diskimage)
+            tmpimage = self.diskimage + ".flatten"
+            try:
+                oz.ozutil.subprocess_check_output(["qemu-img", "convert",
+                                                   "-O", self.image_type,
+                                                   top, tmpimage],
+                                                  printfn=self.log.debug)
+                os.rename(tmpimage, self.diskimage)
+            finally:
+                if os.path.exists(tmpimage):
+                    os.unlink(tmpimage)
+        finally:
+            for filename in owned:
+                if os.path.exists(filename):
+                    os.unlink(filename)
+
+        return icicle
+
     def _internal_customize(self, libvirt_xml, action):
         """
         Internal method to customize and optionally generate an ICICLE for the
@@ -285,6 +1180,20 @@ class LinuxCDGuest(oz.Guest.CDGuest):
                 self.log.debug("Asked to gen_and_mod but no mods are present - changing action to gen_only")
                 action = "gen_only"
 
+        # whatever happens below, the disk image is not a plain copy of the
+        # JEOS anymore
+        jeos_copy = self.diskimage_is_jeos
+        self.guest_sshkey = self.sshprivkey
+        self.diskimage_is_jeos = False
+
+        if action == "mod_only" and self._can_customize_offline():
+            # nothing needs a running guest, so don't boot it
+            self._offline_customize(libvirt_xml)
+            return
+
+        if jeos_copy and self.customize_layers and action != "gen_only" and os.access(self.jeos_filename, os.F_OK):
+            return self._layered_customize(libvirt_xml, action)
+
         # when doing an oz-install with -g, this isn't necessary as it will
         # just replace the port with the same port.  However, it is very
         # necessary when doing an oz-customize since the serial port might
@@ -302,16 +1211,43 @@ class LinuxCDGuest(oz.Guest.CDGuest):
                                               image_filename=cow_diskimage)
             modified_xml = self._modify_libvirt_xml_diskimage(modified_xml, cow_diskimage, 'qcow2')
 
-        self._collect_setup(modified_xml)
+        # a guest whose disk image is a copy of the JEOS can be restored from
+        # (or saved to) the memory state of a booted JEOS, which already had
+        # _collect_setup done to it
+        warm = jeos_copy and self.warm_restore and not (action == "gen_only" and self.safe_icicle_gen) and os.access(self.jeos_filename, os.F_OK)
+        warm_state = None
+        libvirt_dom = None
+        if warm:
+            warm_state = self._warm_state_usable()
+        warm_save = warm and warm_state is None
+        if warm_state is not None:
+            try:
+                libvirt_dom = self._warm_restore(modified_xml, warm_state)
+            except oz.OzException.OzException as err:
+                self.log.warning("%s; booting the guest instead", err)
+                warm_state = None
+
+        if libvirt_dom is None:
+            self._collect_setup(modified_xml)
 
         icicle = None
         try:
-            libvirt_dom = self.libvirt_conn.createXML(modified_xml, 0)
+            if libvirt_dom is None:
+                libvirt_dom = self.libvirt_conn.createXML(modified_xml, 0)
 
             try:
                 guestaddr = None
-                guestaddr = self._wait_for_guest_boot(libvirt_dom)
-                self._test_ssh_connection(guestaddr)
+                if warm_state is not None:
+                    guestaddr = self._warm_guest_address(libvirt_dom,
+                                                         warm_state)
+                    self._test_ssh_connection(guestaddr)
+                    self._warm_sync_clock(guestaddr)
+                else:
+                    guestaddr = self._wait_for_guest_boot(libvirt_dom)
+                    self._test_ssh_connection(guestaddr)
+                    if warm_save:
+                        libvirt_dom = self._warm_save(libvirt_dom, guestaddr)
+                self._open_ssh_session(guestaddr)
 
                 if action == "gen_and_mod":
                     self.do_customize(guestaddr)
@@ -330,6 +1266,7 @@ class LinuxCDGuest(oz.Guest.CDGuest):
                     libvirt_dom.destroy()
                 else:
                     self._shutdown_guest(guestaddr, libvirt_dom)
+                self._close_ssh_session()
         finally:
             if action == "gen_only" and self.safe_icicle_gen:
                 # no need to teardown because we simply discard the file
@@ -344,6 +1281,9 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         """
         Method to customize the operating system after installation.
         """
+        if self.customized_at_install:
+            self.log.info("The installer already did the customization, skipping it")
+            return
         return self._internal_customize(libvirt_xml, "mod_only")
 
     def customize_and_generate_icicle(self, libvirt_xml):
@@ -352,6 +1292,9 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         after installation.  This is equivalent to calling customize() and
         generate_icicle() back-to-back, but is faster.
         """
+        if self.customized_at_install:
+            self.log.info("The installer already did the customization, only generating the ICICLE")
+            return self._internal_customize(libvirt_xml, "gen_only")
         return self._internal_customize(libvirt_xml, "gen_and_mod")
 
     def generate_icicle(self, libvirt_xml):
@@ -361,3 +1304,21 @@ class LinuxCDGuest(oz.Guest.CDGuest):
         other configuration on the diskimage.
         """
         return self._internal_customize(libvirt_xml, "gen_only")
+
+    def generate_icicle_offline(self, libvirt_xml):
+        """
+        Method to generate the ICICLE straight from the package database on
+        the disk image, through a read-only guestfs handle.  The guest is not
+        booted, and the disk image is never modified.
+        """
+        if self.tdl.icicle_extra_cmd:
+            raise oz.OzException.OzException("The ICICLE extra_command needs a running guest, so the ICICLE cannot be generated offline")
+
+        self.log.info("Generating ICICLE offline")
+        g_handle = self._guestfs_handle_setup(libvirt_xml, readonly=True)
+        try:
+            packages = self._offline_package_list(g_handle)
+        finally:
+            self._guestfs_handle_cleanup(g_handle)
+
+        return self._output_icicle_xml(packages, self.tdl.description)
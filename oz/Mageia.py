@@ -38,7 +38,7 @@ class MageiaGuest(oz.Guest.CDGuest):
         self.mageia_arch = self.tdl.arch
         if self.mageia_arch == "i386":
             self.mageia_arch = "i586"
-        self.output_floppy = os.path.join(self.output_dir,
+        self.output_floppy = os.path.join(self.transient_output_dir,
                                           self.tdl.name + "-" + self.tdl.installtype + "-oz.img")
 
 
@@ -107,7 +107,8 @@ label customiso
                                            "-cache-inodes", "-boot-info-table",
                                            "-v", "-o", self.output_iso,
                                            self.iso_contents],
-                                          printfn=self.log.debug)
+                                          printfn=self.log.debug,
+                                          max_output=oz.ozutil.MAX_KEPT_OUTPUT)
     def install(self, timeout=None, force=False):
         fddev = self._InstallDev("floppy", self.output_floppy, "fda")
         return self._do_install(timeout, force, 0, None, None, None,
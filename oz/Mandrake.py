@@ -91,7 +91,8 @@ label customiso
                                            "-cache-inodes", "-boot-info-table",
                                            "-v", "-o", self.output_iso,
                                            self.iso_contents],
-                                          printfn=self.log.debug)
+                                          printfn=self.log.debug,
+                                          max_output=oz.ozutil.MAX_KEPT_OUTPUT)
 
 class Mandrake82Guest(oz.Guest.CDGuest):
     """
@@ -103,7 +103,8 @@ label customiso
                                            "-cache-inodes", "-boot-info-table",
                                            "-v", "-o", self.output_iso,
                                            self.iso_contents],
-                                          printfn=self.log.debug)
+                                          printfn=self.log.debug,
+                                          max_output=oz.ozutil.MAX_KEPT_OUTPUT)
 
 def get_class(tdl, config, auto, output_disk=None, netdev=None, diskbus=None,
               macaddress=None):
@@ -101,7 +101,8 @@ class OpenSUSEGuest(oz.Linux.LinuxCDGuest):
                                            "-allow-leading-dots", "-l", "-v",
                                            "-o", self.output_iso,
                                            self.iso_contents],
-                                          printfn=self.log.debug)
+                                          printfn=self.log.debug,
+                                          max_output=oz.ozutil.MAX_KEPT_OUTPUT)
 
     def install(self, timeout=None, force=False):
         """
@@ -150,6 +151,8 @@ class OpenSUSEGuest(oz.Linux.LinuxCDGuest):
         self.log.debug("Removing reportip")
         self._guestfs_remove_if_exists(g_handle, '/root/reportip')
 
+        self._image_ssh_teardown_announce_service(g_handle)
+
         # reset the service link
         self.log.debug("Resetting cron service")
         if g_handle.exists('/usr/lib/systemd/system/cron.service'):
@@ -193,13 +196,12 @@ class OpenSUSEGuest(oz.Linux.LinuxCDGuest):
         g_handle = self._guestfs_handle_setup(libvirt_xml)
 
         try:
-            self._image_ssh_teardown_step_1(g_handle)
-
-            self._image_ssh_teardown_step_2(g_handle)
-
-            self._image_ssh_teardown_step_3(g_handle)
-
-            self._image_ssh_teardown_step_4(g_handle)
+            batch = self._guestfs_batch(g_handle)
+            self._image_ssh_teardown_step_1(batch)
+            self._image_ssh_teardown_step_2(batch)
+            self._image_ssh_teardown_step_3(batch)
+            self._image_ssh_teardown_step_4(batch)
+            batch.apply()
         finally:
             self._guestfs_handle_cleanup(g_handle)
             shutil.rmtree(self.icicle_tmp)
@@ -249,17 +251,11 @@ class OpenSUSEGuest(oz.Linux.LinuxCDGuest):
                                '/etc/systemd/system/multi-user.target.wants/sshd.service')
         else:
             self._guestfs_path_backup(g_handle, "/etc/init.d/after.local")
-            local = os.path.join(self.icicle_tmp, "after.local")
-            with open(local, "w") as f:
-                f.write("/sbin/service sshd start\n")
-            try:
-                g_handle.upload(local, "/etc/init.d/after.local")
-            finally:
-                os.unlink(local)
+            g_handle.write("/etc/init.d/after.local",
+                           "/sbin/service sshd start\n")
 
-        sshd_config_file = self.icicle_tmp + "/sshd_config"
-        with open(sshd_config_file, 'w') as f:
-            f.write("""PasswordAuthentication no
+        self._guestfs_path_backup(g_handle, "/etc/ssh/sshd_config")
+        g_handle.write('/etc/ssh/sshd_config', """PasswordAuthentication no
 UsePAM yes
 
 X11Forwarding yes
@@ -271,12 +267,6 @@ AcceptEnv LC_PAPER LC_NAME LC_ADDRESS LC_TELEPHONE LC_MEASUREMENT
 AcceptEnv LC_IDENTIFICATION LC_ALL
 """)
 
-        try:
-            self._guestfs_path_backup(g_handle, "/etc/ssh/sshd_config")
-            g_handle.upload(sshd_config_file, '/etc/ssh/sshd_config')
-        finally:
-            os.unlink(sshd_config_file)
-
     def _image_ssh_setup_step_3(self, g_handle):
         """
         Third step for allowing remote access (make the guest announce itself
@@ -285,53 +275,34 @@ AcceptEnv LC_IDENTIFICATION LC_ALL
         # part 3; make sure the guest announces itself
         self.log.debug("Step 3: Guest announcement")
 
-        scriptfile = os.path.join(self.icicle_tmp, "script")
-
         if g_handle.exists("/etc/NetworkManager/dispatcher.d"):
-            with open(scriptfile, 'w') as f:
-                f.write("""\
+            g_handle.write('/etc/NetworkManager/dispatcher.d/99-reportip', """\
 #!/bin/bash
 
 if [ "$1" = "eth0" -a "$2" = "up" ]; then
     echo -n "!$DHCP4_IP_ADDRESS,%s!" > /dev/ttyS1
 fi
-""" % (self.uuid))
-
-            try:
-                g_handle.upload(scriptfile,
-                                '/etc/NetworkManager/dispatcher.d/99-reportip')
-                g_handle.chmod(0755,
-                               '/etc/NetworkManager/dispatcher.d/99-reportip')
-            finally:
-                os.unlink(scriptfile)
+""" % (self.announce_token))
+            g_handle.chmod(0755,
+                           '/etc/NetworkManager/dispatcher.d/99-reportip')
 
         if not g_handle.exists('/etc/init.d/cron') or not g_handle.exists('/usr/sbin/cron'):
             raise oz.OzException.OzException("cron not installed on the image, cannot continue")
 
-        with open(scriptfile, 'w') as f:
-            f.write("""\
+        g_handle.write('/root/reportip', """\
 #!/bin/bash
 DEV=$(/bin/awk '{if ($2 == 0) print $1}' /proc/net/route) &&
 [ -z "$DEV" ] && exit 0
 ADDR=$(/sbin/ip -4 -o addr show dev $DEV | /bin/awk '{print $4}' | /usr/bin/cut -d/ -f1) &&
 [ -z "$ADDR" ] && exit 0
 echo -n "!$ADDR,%s!" > /dev/ttyS1
-""" % (self.uuid))
+""" % (self.announce_token))
+        g_handle.chmod(0o755, '/root/reportip')
 
-        try:
-            g_handle.upload(scriptfile, '/root/reportip')
-            g_handle.chmod(0o755, '/root/reportip')
-        finally:
-            os.unlink(scriptfile)
+        g_handle.write('/etc/cron.d/announce',
+                       '*/1 * * * * root /bin/bash -c "/root/reportip"\n')
 
-        announcefile = os.path.join(self.icicle_tmp, "announce")
-        with open(announcefile, 'w') as f:
-            f.write('*/1 * * * * root /bin/bash -c "/root/reportip"\n')
-
-        try:
-            g_handle.upload(announcefile, '/etc/cron.d/announce')
-        finally:
-            os.unlink(announcefile)
+        self._image_ssh_setup_announce_service(g_handle)
 
         if g_handle.exists('/usr/lib/systemd/system/cron.service'):
             if g_handle.exists('/etc/systemd/system/multi-user.target.wants/cron.service'):
@@ -358,25 +329,23 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
         # 2)  Make sure sshd is running on boot
         # 3)  Make the guest announce itself to the host
 
+        # the steps only record their changes, which are all made at once at
+        # the end, so a step that fails leaves the disk image untouched
         try:
+            batch = self._guestfs_batch(g_handle)
+            self._image_ssh_setup_step_1(batch)
+            self._image_ssh_setup_step_2(batch)
+            self._image_ssh_setup_step_3(batch)
+
             try:
-                self._image_ssh_setup_step_1(g_handle)
-
-                try:
-                    self._image_ssh_setup_step_2(g_handle)
-
-                    try:
-                        self._image_ssh_setup_step_3(g_handle)
-                    except:
-                        self._image_ssh_teardown_step_3(g_handle)
-                        raise
-                except:
-                    self._image_ssh_teardown_step_2(g_handle)
-                    raise
+                batch.apply()
             except:
-                self._image_ssh_teardown_step_1(g_handle)
+                undo = batch.undo_batch()
+                self._image_ssh_teardown_step_1(undo)
+                self._image_ssh_teardown_step_2(undo)
+                self._image_ssh_teardown_step_3(undo)
+                undo.apply()
                 raise
-
         finally:
             self._guestfs_handle_cleanup(g_handle)
 
@@ -27,13 +27,45 @@ try:
 except ImportError:
     import ConfigParser as configparser
 import gzip
-import guestfs
 
 import oz.Guest
 import oz.Linux
 import oz.ozutil
 import oz.OzException
 
+# what anaconda prints on the console.  Installs fail on the errors right
+# away by default, so they only match the messages of fatal errors, not
+# anything that just looks like trouble (say, a traceback from a %post
+# script or a package that yum could not find in one of the repositories)
+ANACONDA_STAGE_PATTERNS = [
+    (r'Running pre-installation scripts', 'pre-installation scripts'),
+    (r'Starting package installation process|Installing software', 'package installation'),
+    (r'Installing boot ?loader', 'boot loader installation'),
+    (r'Performing post-installation setup tasks', 'post-installation setup'),
+    (r'Running post-installation scripts', 'post-installation scripts'),
+]
+ANACONDA_ERROR_PATTERNS = [
+    (r'An unknown error has occurr?ed|anaconda [\d.-]+ exception report', 'anaconda crash'),
+    (r'The following problem occurred on line \d+ of the kickstart file|KickstartParseError', 'kickstart error'),
+    (r"You have specified that the (?:package|group) '[^']*' should be installed", 'missing package'),
+    (r'Some packages.* (?:are broken|have errors)|Error populating transaction', 'broken package set'),
+    (r'There was an error running the kickstart script', 'kickstart script failed'),
+    (r'No usable disks have been found|No disks detected', 'no usable disk'),
+    (re.escape(oz.ozutil.INSTALL_SCRIPT_FAILED_MARKER), 'customization failed'),
+]
+
+def _kickstart_has_end(kspath):
+    """
+    Function to find out whether the sections of a kickstart file end with
+    %end, which only the anaconda versions that also know about
+    %post --erroronfail want.
+    """
+    with open(kspath) as f:
+        for line in f:
+            if re.match(r"^%end\b", line):
+                return True
+    return False
+
 class RedHatLinuxCDGuest(oz.Linux.LinuxCDGuest):
     """
     Class for RedHat-based CD guests.
@@ -68,9 +100,9 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
         #         filesystem
         self.initrdtype = initrdtype
 
-        self.kernelfname = os.path.join(self.output_dir,
+        self.kernelfname = os.path.join(self.transient_output_dir,
                                         self.tdl.name + "-kernel")
-        self.initrdfname = os.path.join(self.output_dir,
+        self.initrdfname = os.path.join(self.transient_output_dir,
                                         self.tdl.name + "-ramdisk")
         self.kernelcache = os.path.join(self.data_dir, "kernels",
                                         self.tdl.distro + self.tdl.update + self.tdl.arch + "-kernel")
@@ -81,6 +113,9 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
         if self.tdl.kernel_param:
             self.cmdline += " " + self.tdl.kernel_param
 
+        self.install_stage_patterns = list(ANACONDA_STAGE_PATTERNS)
+        self.install_error_patterns = list(ANACONDA_ERROR_PATTERNS)
+
     def _generate_new_iso(self):
         """
         Method to create a new ISO based on the modified CD/DVD.
@@ -94,7 +129,8 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
                                            "-boot-info-table", "-v",
                                            "-o", self.output_iso,
                                            self.iso_contents],
-                                          printfn=self.log.debug)
+                                          printfn=self.log.debug,
+                                          max_output=oz.ozutil.MAX_KEPT_OUTPUT)
 
     def _check_iso_tree(self, customize_or_icicle):
         kernel = os.path.join(self.iso_contents, "isolinux", "vmlinuz")
@@ -109,6 +145,9 @@ Subsystem	sftp	/usr/libexec/openssh/sftp-server
         isolinuxcfg = os.path.join(self.iso_contents, "isolinux",
                                    "isolinux.cfg")
 
+        if self._install_console_args():
+            initrdline = initrdline.rstrip("\n") + " " + self._install_console_args() + "\n"
+
         with open(isolinuxcfg, "w") as f:
             f.write("""\
 default customiso
@@ -212,6 +251,8 @@ label customiso
         self.log.debug("Removing reportip")
         self._guestfs_remove_if_exists(g_handle, '/root/reportip')
 
+        self._image_ssh_teardown_announce_service(g_handle)
+
         # reset the service link
         self.log.debug("Resetting crond service")
         if g_handle.exists('/lib/systemd/system/crond.service'):
@@ -258,17 +299,14 @@ label customiso
         g_handle = self._guestfs_handle_setup(libvirt_xml)
 
         try:
-            self._image_ssh_teardown_step_1(g_handle)
-
-            self._image_ssh_teardown_step_2(g_handle)
-
-            self._image_ssh_teardown_step_3(g_handle)
-
-            self._image_ssh_teardown_step_4(g_handle)
-
-            self._image_ssh_teardown_step_5(g_handle)
-
-            self._image_ssh_teardown_step_6(g_handle)
+            batch = self._guestfs_batch(g_handle)
+            self._image_ssh_teardown_step_1(batch)
+            self._image_ssh_teardown_step_2(batch)
+            self._image_ssh_teardown_step_3(batch)
+            self._image_ssh_teardown_step_4(batch)
+            self._image_ssh_teardown_step_5(batch)
+            self._image_ssh_teardown_step_6(batch)
+            batch.apply()
         finally:
             self._guestfs_handle_cleanup(g_handle)
             shutil.rmtree(self.icicle_tmp)
@@ -308,15 +346,8 @@ label customiso
             self._guestfs_path_backup(g_handle, startuplink)
             g_handle.ln_sf('/etc/init.d/sshd', startuplink)
 
-        sshd_config_file = os.path.join(self.icicle_tmp, "sshd_config")
-        with open(sshd_config_file, 'w') as f:
-            f.write(self.sshd_config)
-
-        try:
-            self._guestfs_path_backup(g_handle, '/etc/ssh/sshd_config')
-            g_handle.upload(sshd_config_file, '/etc/ssh/sshd_config')
-        finally:
-            os.unlink(sshd_config_file)
+        self._guestfs_path_backup(g_handle, '/etc/ssh/sshd_config')
+        g_handle.write('/etc/ssh/sshd_config', self.sshd_config)
 
     def _image_ssh_setup_step_3(self, g_handle):
         """
@@ -334,53 +365,34 @@ label customiso
         # part 4; make sure the guest announces itself
         self.log.debug("Step 4: Guest announcement")
 
-        scriptfile = os.path.join(self.icicle_tmp, "script")
-
         if g_handle.exists("/etc/NetworkManager/dispatcher.d"):
-            with open(scriptfile, 'w') as f:
-                f.write("""\
+            g_handle.write('/etc/NetworkManager/dispatcher.d/99-reportip', """\
 #!/bin/bash
 
 if [ "$1" = "eth0" -a "$2" = "up" ]; then
     echo -n "!$DHCP4_IP_ADDRESS,%s!" > /dev/ttyS1
 fi
-""" % (self.uuid))
-
-            try:
-                g_handle.upload(scriptfile,
-                                '/etc/NetworkManager/dispatcher.d/99-reportip')
-                g_handle.chmod(0755,
-                               '/etc/NetworkManager/dispatcher.d/99-reportip')
-            finally:
-                os.unlink(scriptfile)
+""" % (self.announce_token))
+            g_handle.chmod(0755,
+                           '/etc/NetworkManager/dispatcher.d/99-reportip')
 
         if not g_handle.exists('/usr/sbin/crond'):
             raise oz.OzException.OzException("cron not installed on the image, cannot continue")
 
-        with open(scriptfile, 'w') as f:
-            f.write("""\
+        g_handle.write('/root/reportip', """\
 #!/bin/bash
 DEV=$(/bin/awk '{if ($2 == 0) print $1}' /proc/net/route) &&
 [ -z "$DEV" ] && exit 0
 ADDR=$(/sbin/ip -4 -o addr show dev $DEV | /bin/awk '{print $4}' | /bin/cut -d/ -f1) &&
 [ -z "$ADDR" ] && exit 0
 echo -n "!$ADDR,%s!" > /dev/ttyS1
-""" % (self.uuid))
-
-        try:
-            g_handle.upload(scriptfile, '/root/reportip')
-            g_handle.chmod(0755, '/root/reportip')
-        finally:
-            os.unlink(scriptfile)
+""" % (self.announce_token))
+        g_handle.chmod(0755, '/root/reportip')
 
-        announcefile = os.path.join(self.icicle_tmp, "announce")
-        with open(announcefile, 'w') as f:
-            f.write('*/1 * * * * root /bin/bash -c "/root/reportip"\n')
+        g_handle.write('/etc/cron.d/announce',
+                       '*/1 * * * * root /bin/bash -c "/root/reportip"\n')
 
-        try:
-            g_handle.upload(announcefile, '/etc/cron.d/announce')
-        finally:
-            os.unlink(announcefile)
+        self._image_ssh_setup_announce_service(g_handle)
 
         if g_handle.exists('/lib/systemd/system/crond.service'):
             if g_handle.exists('/etc/systemd/system/multi-user.target.wants/crond.service'):
@@ -402,15 +414,8 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
         self.log.debug("Step 5: Set SELinux to permissive mode")
         self._guestfs_path_backup(g_handle, '/etc/selinux/config')
 
-        selinuxfile = self.icicle_tmp + "/selinux"
-        with open(selinuxfile, 'w') as f:
-            f.write("SELINUX=permissive\n")
-            f.write("SELINUXTYPE=targeted\n")
-
-        try:
-            g_handle.upload(selinuxfile, "/etc/selinux/config")
-        finally:
-            os.unlink(selinuxfile)
+        g_handle.write("/etc/selinux/config",
+                       "SELINUX=permissive\nSELINUXTYPE=targeted\n")
 
     def _collect_setup(self, libvirt_xml):
         """
@@ -427,37 +432,27 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
         # 4)  Make the guest announce itself to the host
         # 5)  Set SELinux to permissive mode
 
+        # the steps only record their changes, which are all made at once at
+        # the end, so a step that fails leaves the disk image untouched
         try:
-            try:
-                self._image_ssh_setup_step_1(g_handle)
+            batch = self._guestfs_batch(g_handle)
+            self._image_ssh_setup_step_1(batch)
+            self._image_ssh_setup_step_2(batch)
+            self._image_ssh_setup_step_3(batch)
+            self._image_ssh_setup_step_4(batch)
+            self._image_ssh_setup_step_5(batch)
 
-                try:
-                    self._image_ssh_setup_step_2(g_handle)
-
-                    try:
-                        self._image_ssh_setup_step_3(g_handle)
-
-                        try:
-                            self._image_ssh_setup_step_4(g_handle)
-
-                            try:
-                                self._image_ssh_setup_step_5(g_handle)
-                            except:
-                                self._image_ssh_teardown_step_5(g_handle)
-                                raise
-                        except:
-                            self._image_ssh_teardown_step_4(g_handle)
-                            raise
-                    except:
-                        self._image_ssh_teardown_step_3(g_handle)
-                        raise
-                except:
-                    self._image_ssh_teardown_step_2(g_handle)
-                    raise
+            try:
+                batch.apply()
             except:
-                self._image_ssh_teardown_step_1(g_handle)
+                undo = batch.undo_batch()
+                self._image_ssh_teardown_step_1(undo)
+                self._image_ssh_teardown_step_2(undo)
+                self._image_ssh_teardown_step_3(undo)
+                self._image_ssh_teardown_step_4(undo)
+                self._image_ssh_teardown_step_5(undo)
+                undo.apply()
                 raise
-
         finally:
             self._guestfs_handle_cleanup(g_handle)
 
@@ -564,18 +559,17 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
             outf.writelines(inf)
             inf.close()
 
-            g = guestfs.GuestFS()
-            g.add_drive_opts(ext2file, format='raw')
-            self.log.debug("Launching guestfs")
-            g.launch()
-
-            g.mount_options('', g.list_devices()[0], "/")
+            g, devices = self.guestfs_manager.open([(ext2file, 'raw', False)],
+                                                   "the initrd of " + self.tdl.name)
+            try:
+                g.mount_options('', devices[0], "/")
 
-            g.upload(kspath, "/ks.cfg")
+                g.upload(kspath, "/ks.cfg")
 
-            g.sync()
-            g.umount_all()
-            g.kill_subprocess()
+                g.sync()
+                g.umount_all()
+            finally:
+                self.guestfs_manager.release(g)
 
             # kickstart is added, lets recompress it
             oz.ozutil.gzip_create(ext2file, self.initrdfname)
@@ -781,21 +775,7 @@ class RedHatLinuxCDYumGuest(RedHatLinuxCDGuest):
             filename = repo.name.replace(" ", "_") + ".repo"
             localname = os.path.join(self.icicle_tmp, filename)
             with open(localname, 'w') as f:
-                f.write("[%s]\n" % repo.name.replace(" ", "_"))
-                f.write("name=%s\n" % repo.name)
-                f.write("baseurl=%s\n" % repo.url)
-                f.write("skip_if_unavailable=1\n")
-                f.write("enabled=1\n")
-
-                if repo.sslverify:
-                    f.write("sslverify=1\n")
-                else:
-                    f.write("sslverify=0\n")
-
-                if repo.signed:
-                    f.write("gpgcheck=1\n")
-                else:
-                    f.write("gpgcheck=0\n")
+                f.write(self._repo_file_content(repo))
 
             try:
                 remotename = os.path.join("/etc/yum.repos.d/", filename)
@@ -803,6 +783,125 @@ class RedHatLinuxCDYumGuest(RedHatLinuxCDGuest):
             finally:
                 os.unlink(localname)
 
+    def _repo_file_content(self, repo):
+        """
+        Method to get the content of the yum repository file for a TDL
+        repository.
+        """
+        content = "[%s]\n" % repo.name.replace(" ", "_")
+        content += "name=%s\n" % repo.name
+        content += "baseurl=%s\n" % repo.url
+        content += "skip_if_unavailable=1\n"
+        content += "enabled=1\n"
+
+        if repo.sslverify:
+            content += "sslverify=1\n"
+        else:
+            content += "sslverify=0\n"
+
+        if repo.signed:
+            content += "gpgcheck=1\n"
+        else:
+            content += "gpgcheck=0\n"
+
+        return content
+
+    def _can_customize_in_install(self):
+        """
+        Method to find out whether anaconda can do the customization in the
+        TDL.  The precommands have to run before the packages are installed
+        in a running guest, which a kickstart cannot do.
+        """
+        if self.tdl.precommands:
+            self.log.debug("The TDL has precommands, so it cannot be customized during the install")
+            return False
+        if not _kickstart_has_end(self.auto):
+            # without --erroronfail, a failing %post does not fail the
+            # install, and the customization could silently be missing
+            self.log.debug("The kickstart has no %end, so it cannot be customized during the install")
+            return False
+        return True
+
+    def _copy_kickstart(self, outname):
+        """
+        Method to copy and modify a RedHat style kickstart file, adding the
+        customization in the TDL to it if the install is to do that.
+        """
+        RedHatLinuxCDGuest._copy_kickstart(self, outname)
+
+        if self.customize_in_install:
+            self._kickstart_add_customization(outname)
+
+    def _kickstart_add_customization(self, kspath):
+        """
+        Method to add the customization in the TDL to a kickstart file:
+        the repositories become repo commands, the packages are added to
+        the %packages section, and a %post script writes the repository
+        files and the files and runs the commands, like do_customize does.
+        If the script fails, INSTALL_SCRIPT_FAILED_MARKER is written to the
+        serial console.
+        """
+        self.log.debug("Adding the customization to the kickstart")
+        with open(kspath) as f:
+            lines = f.readlines()
+
+        # kickstarts of the anaconda versions that need %end have it in
+        # the sections, and the others do not understand it
+        has_end = _kickstart_has_end(kspath)
+        end = []
+        if has_end:
+            end = ["%end\n"]
+
+        repolines = []
+        for repo in list(self.tdl.repositories.values()):
+            line = 'repo --name="%s" --baseurl="%s"' % (repo.name.replace(" ", "_"),
+                                                         repo.url)
+            if repo.url.startswith("https") and not repo.sslverify:
+                line += " --noverifyssl"
+            repolines.append(line + "\n")
+
+        packages = [package.name + "\n" for package in self.tdl.packages]
+
+        # commands can go anywhere before the first section
+        output = repolines + lines
+        for index, line in enumerate(output):
+            if re.match(r"^%packages\b", line):
+                output[index + 1:index + 1] = packages
+                break
+        else:
+            if packages:
+                output += ["\n", "%packages\n"] + packages + end
+
+        files = []
+        remove = []
+        for repo in list(self.tdl.repositories.values()):
+            filename = os.path.join("/etc/yum.repos.d",
+                                    repo.name.replace(" ", "_") + ".repo")
+            files.append((filename, self._repo_file_content(repo)))
+            if not repo.persisted:
+                remove.append(filename)
+        for name, fp in sorted(self.tdl.files.items()):
+            with open(fp.name, 'rb') as f:
+                files.append((name, f.read()))
+        commands = []
+        for cmd in self.tdl.commands:
+            with open(cmd.name) as f:
+                commands.append(f.read())
+
+        post = "%post"
+        if has_end:
+            # --erroronfail came along with %end
+            post += " --erroronfail"
+        # anaconda only shows a failing %post on the screen (or ignores it),
+        # so the failure is also reported on the serial console, where the
+        # install is watched
+        output += ["\n", post + "\n", "(\n",
+                   oz.ozutil.generate_install_script(files, commands, remove),
+                   ") || { echo %s > /dev/ttyS0 ; exit 1 ; }\n" % (oz.ozutil.INSTALL_SCRIPT_FAILED_MARKER)] + end
+
+        with open(kspath, 'w') as f:
+            f.writelines(output)
+
     def _install_packages(self, guestaddr, packstr):
         self.guest_execute_command(guestaddr, 'yum -y install %s' % (packstr))
 
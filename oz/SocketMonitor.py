@@ -0,0 +1,408 @@
+# Copyright (C) 2014  Chris Lalancette <clalancette@gmail.com>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Monitoring of the sockets that Oz talks to guests over
+"""
+
+import threading
+import logging
+import select
+import socket
+import errno
+import heapq
+import time
+import os
+
+import oz.ozutil
+
+_monitor_lock = threading.Lock()
+_monitor = None
+
+class SocketMonitor(object):
+    """
+    Class to wait for data on many sockets at once.  A single thread polls
+    all of the sockets that were added, and calls the callback of a socket
+    whenever it is ready (readable, unless other poll events were asked
+    for); if the callback returns False, the socket is not polled anymore.
+    All changes to the set of polled sockets are done by the polling thread
+    itself, so the thread never polls a file descriptor that was closed
+    behind its back.  The thread also runs the functions scheduled with
+    call_later().
+    """
+    def __init__(self):
+        self.log = logging.getLogger('%s.%s' % (__name__,
+                                                self.__class__.__name__))
+        self._lock = threading.Lock()
+        self._poll = select.poll()
+        self._callbacks = {}
+        self._pending = []
+        self._timers = []
+        self._timer_seq = 0
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._poll.register(self._wakeup_read, select.POLLIN)
+        self._thread = threading.Thread(target=self._run,
+                                        name="oz-socket-monitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _request(self, op, sock, callback, events):
+        """
+        Internal method to hand a change of the polled sockets to the polling
+        thread, and to wait for it to be done.  Callbacks run in the polling
+        thread, so the change is done right away when they ask for it.
+        """
+        if threading.current_thread() is self._thread:
+            self._apply(op, sock, callback, events)
+            return
+
+        done = threading.Event()
+        with self._lock:
+            self._pending.append((op, sock, callback, events, done))
+        os.write(self._wakeup_write, b'x')
+        done.wait()
+
+    def add(self, sock, callback, events=select.POLLIN):
+        """
+        Method to start polling sock for events.  callback(sock) is called
+        from the polling thread whenever sock is ready.
+        """
+        sock.setblocking(False)
+        self._request('add', sock, callback, events)
+
+    def modify(self, sock, events):
+        """
+        Method to change the events that sock is polled for.
+        """
+        self._request('modify', sock, None, events)
+
+    def remove(self, sock):
+        """
+        Method to stop polling sock.  Once this returns, the callback of sock
+        will not be called anymore, so the socket can be closed.
+        """
+        self._request('remove', sock, None, None)
+
+    def call_later(self, delay, func):
+        """
+        Method to have the polling thread call func() in delay seconds.
+        """
+        with self._lock:
+            self._timer_seq += 1
+            heapq.heappush(self._timers, (time.time() + delay,
+                                          self._timer_seq, func))
+        if threading.current_thread() is not self._thread:
+            os.write(self._wakeup_write, b'x')
+
+    def _apply(self, op, sock, callback, events):
+        """
+        Internal method to change the polled sockets; only ever called in
+        the polling thread.
+        """
+        fd = sock.fileno()
+        if op == 'add':
+            self._callbacks[fd] = (sock, callback)
+            self._poll.register(fd, events | select.POLLERR | select.POLLHUP)
+        elif fd in self._callbacks:
+            if op == 'modify':
+                self._poll.modify(fd, events | select.POLLERR | select.POLLHUP)
+            else:
+                del self._callbacks[fd]
+                self._poll.unregister(fd)
+
+    def _apply_pending(self):
+        """
+        Internal method to apply the requested changes to the polled sockets.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+
+        for op, sock, callback, events, done in pending:
+            self._apply(op, sock, callback, events)
+            done.set()
+
+    def _run_timers(self):
+        """
+        Internal method to run the functions that are due, and to figure out
+        how long (in milliseconds) to poll until the next one is.
+        """
+        while True:
+            with self._lock:
+                if not self._timers:
+                    return None
+                when, seq, func = self._timers[0]
+                now = time.time()
+                if when > now:
+                    return int((when - now) * 1000) + 1
+                heapq.heappop(self._timers)
+            try:
+                func()
+            except Exception:
+                self.log.exception("Timer function failed")
+
+    def _run(self):
+        """
+        Internal method running in the polling thread.
+        """
+        while True:
+            timeout = self._run_timers()
+            try:
+                events = self._poll.poll(timeout)
+            except select.error as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, event in events:
+                if fd == self._wakeup_read:
+                    os.read(self._wakeup_read, 4096)
+                    continue
+
+                if fd not in self._callbacks:
+                    continue
+                sock, callback = self._callbacks[fd]
+                try:
+                    keep = callback(sock)
+                except Exception:
+                    self.log.exception("Socket callback failed")
+                    keep = False
+                if not keep and fd in self._callbacks:
+                    del self._callbacks[fd]
+                    self._poll.unregister(fd)
+
+            self._apply_pending()
+
+def get_socket_monitor():
+    """
+    Function to get the SocketMonitor shared by all of the guests in this
+    process.
+    """
+    global _monitor
+
+    with _monitor_lock:
+        if _monitor is None:
+            _monitor = SocketMonitor()
+        return _monitor
+
+class AnnounceWait(object):
+    """
+    Class to wait for the !<ip>,<uuid>! announcement of a booting guest on a
+    socket connected to its serial port.  The data is parsed as it arrives,
+    with a bounded buffer, and the wait ends the moment the announcement is
+    complete.
+    """
+    def __init__(self, expected_uuid):
+        self.expected_uuid = expected_uuid
+        self.addr = None
+        self.error = None
+        self.closed = False
+        self._buf = ''
+        self._event = threading.Event()
+
+    def readable(self, sock):
+        """
+        Method called from the SocketMonitor when the socket is readable.
+        Returns False once there is no point in reading any further.
+        """
+        try:
+            data = sock.recv(4096)
+        except socket.error as err:
+            if err.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR]:
+                return True
+            data = ''
+
+        if not data:
+            # the other end of the serial port went away
+            self.closed = True
+            self._event.set()
+            return False
+
+        announcements, self._buf = oz.ozutil.parse_announce(self._buf, data)
+        for announcement in announcements:
+            self._check_announcement(announcement)
+            if self._event.is_set():
+                return False
+
+        return True
+
+    def _check_announcement(self, announcement):
+        """
+        Internal method to validate an announcement, and to end the wait if it
+        is the one we are waiting for.
+        """
+        split = announcement.split(',')
+        if len(split) != 2:
+            self.error = "Guest checked in with bogus data"
+        else:
+            addr, uuidstr = split
+            try:
+                # use socket.inet_aton() to validate the IP address
+                socket.inet_aton(addr)
+            except socket.error:
+                self.error = "Guest checked in with invalid IP address"
+            else:
+                if uuidstr != self.expected_uuid:
+                    self.error = "Guest checked in with unknown UUID"
+                else:
+                    self.addr = addr
+        self._event.set()
+
+    def wait(self, timeout):
+        """
+        Method to wait up to timeout seconds for the announcement.  Returns
+        True if the wait is over (the guest announced itself, sent something
+        bogus, or the socket was closed), False otherwise.
+        """
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+class SshBannerProbe(object):
+    """
+    Class to find out cheaply when sshd on a guest is ready: every interval
+    seconds it tries to connect to the ssh port and to read the "SSH-" banner
+    that sshd greets its clients with, until it succeeds.  All of the probes
+    in a process share the thread of the SocketMonitor.
+    """
+    def __init__(self, addr, port=22, interval=0.25, attempt_timeout=5):
+        self.log = logging.getLogger('%s.%s' % (__name__,
+                                                self.__class__.__name__))
+        self.addr = addr
+        self.port = port
+        self.interval = interval
+        self.attempt_timeout = attempt_timeout
+        self.banner = None
+        self.attempts = 0
+        self._monitor = get_socket_monitor()
+        self._sock = None
+        self._connecting = False
+        self._buf = b''
+        self._cancelled = False
+        self._event = threading.Event()
+
+    def start(self):
+        """
+        Method to start probing.
+        """
+        self._monitor.call_later(0, self._connect)
+
+    def _connect(self):
+        """
+        Internal method to start a connection attempt; runs in the thread of
+        the SocketMonitor, like the rest of the internal methods.
+        """
+        if self._cancelled or self._event.is_set():
+            return
+
+        self.attempts += 1
+        attempt = self.attempts
+        self._buf = b''
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setblocking(False)
+        err = self._sock.connect_ex((self.addr, self.port))
+        if err not in [0, errno.EINPROGRESS, errno.EWOULDBLOCK]:
+            self._retry()
+            return
+
+        self._connecting = True
+        self._monitor.add(self._sock, self._ready, select.POLLOUT)
+
+        def _check_timeout():
+            """
+            Function to give up on an attempt that takes too long.
+            """
+            if attempt == self.attempts and self._sock is not None:
+                self._monitor.remove(self._sock)
+                self._retry()
+        self._monitor.call_later(self.attempt_timeout, _check_timeout)
+
+    def _retry(self):
+        """
+        Internal method to close the socket of the current attempt, and to
+        schedule the next one.
+        """
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._monitor.call_later(self.interval, self._connect)
+
+    def _ready(self, sock):
+        """
+        Internal method called when the socket of the current attempt is
+        ready.
+        """
+        if self._cancelled:
+            self._close()
+            return False
+
+        if self._connecting:
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                self._retry()
+                return False
+            self._connecting = False
+            self._monitor.modify(sock, select.POLLIN)
+            return True
+
+        try:
+            data = sock.recv(256)
+        except socket.error as err:
+            if err.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR]:
+                return True
+            data = b''
+
+        if not data:
+            self._retry()
+            return False
+
+        # the banner is the first line; anything before it is bounded
+        self._buf = (self._buf + data)[-512:]
+        for line in self._buf.split(b'\n')[:-1]:
+            if line.startswith(b'SSH-'):
+                self.banner = line.strip()
+                self._close()
+                self._event.set()
+                return False
+        return True
+
+    def _close(self):
+        """
+        Internal method to close the socket of the current attempt.
+        """
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def wait(self, timeout):
+        """
+        Method to wait up to timeout seconds for the banner.  Returns True if
+        sshd greeted us, False otherwise.
+        """
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+    def cancel(self):
+        """
+        Method to stop probing.
+        """
+        def _cancel():
+            """
+            Function to stop the current attempt.
+            """
+            self._cancelled = True
+            if self._sock is not None:
+                self._monitor.remove(self._sock)
+                self._close()
+        self._monitor.call_later(0, _cancel)
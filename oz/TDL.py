@@ -159,6 +159,9 @@ class TDL(object):
     description  - A free-form description of this TDL (optional).
     installtype  - The method to be used to install this operating system.
                    Currently this must be one of "url" or "iso".
+    install_profile - The install profile to use while installing this
+                   operating system (optional).  Currently this must be one
+                   of "default" or "performance".
     packages     - A list of Package objects describing the packages to be
                    installed on the operating system.  This list may be
                    empty.
@@ -171,6 +174,9 @@ class TDL(object):
     commands     - A dictionary of commands to run inside the guest VM.  The
                    dictionary is indexed by commands.  This dictionary may
                    be empty.
+    offline_commands - A list of the commands (and precommands) that are
+                   marked as safe to run on the disk image of the guest
+                   while it is not running.  This list may be empty.
     """
     def __init__(self, xmlstring, rootpw_required=False):
         # open the XML document
@@ -223,6 +229,10 @@ class TDL(object):
         if self.installtype is None:
             raise oz.OzException.OzException("Failed to find OS install type in TDL")
 
+        # the install profile is optional; if it is None, the Guest object
+        # uses the one from the configuration file
+        self.install_profile = install[0].get('profile')
+
         # we only support md5/sha1/sha256 sums for ISO install types.  However,
         # we make sure the instance variables are set to None for both types
         # so code lower down in the stack doesn't have to care about the ISO
@@ -288,6 +298,7 @@ class TDL(object):
         self.repositories = {}
         self._add_repositories(self.doc.xpath('/template/repositories/repository'))
 
+        self.offline_commands = []
         self.commands = self._parse_commands('/template/commands')
         self.precommands = self._parse_commands('/template/precommands')
 
@@ -373,6 +384,12 @@ class TDL(object):
             fp = data_from_type(name, contenttype, content)
             tmp.append((position, fp))
 
+            offline = oz.ozutil.string_to_bool(command.get('offline', 'no'))
+            if offline is None:
+                raise oz.OzException.OzException("Command %s offline property must be 'true', 'yes', 'false', or 'no'" % (name))
+            if offline:
+                self.offline_commands.append(fp)
+
         commands = []
         if not saw_position:
             for pos, fp in tmp:
@@ -64,9 +64,9 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
         if self.debarch == "x86_64":
             self.debarch = "amd64"
 
-        self.kernelfname = os.path.join(self.output_dir,
+        self.kernelfname = os.path.join(self.transient_output_dir,
                                         self.tdl.name + "-kernel")
-        self.initrdfname = os.path.join(self.output_dir,
+        self.initrdfname = os.path.join(self.transient_output_dir,
                                         self.tdl.name + "-ramdisk")
         self.kernelcache = os.path.join(self.data_dir, "kernels",
                                         self.tdl.distro + self.tdl.update + self.tdl.arch + "-kernel")
@@ -75,6 +75,9 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
 
         self.cmdline = "priority=critical locale=en_US"
 
+        self.install_stage_patterns = list(oz.Linux.DI_STAGE_PATTERNS)
+        self.install_error_patterns = list(oz.Linux.DI_ERROR_PATTERNS)
+
         self.reboots = 0
         if self.tdl.update in ["5.04", "5.10"]:
             self.reboots = 1
@@ -140,6 +143,8 @@ Subsystem       sftp    /usr/libexec/openssh/sftp-server
         oz.ozutil.mkdir_p(outdir)
 
         self._copy_preseed(outname)
+        if self.customize_in_install:
+            self._preseed_add_customization(outname, "/cdrom/preseed")
 
         self.log.debug("Modifying isolinux.cfg")
         isolinuxcfg = os.path.join(self.iso_contents, "isolinux",
@@ -178,10 +183,16 @@ PROMPT 0
                     f.write("  append file=/cdrom/preseed/customiso.seed boot=casper automatic-ubiquity noprompt keyboard-configuration/layoutcode=us initrd=/casper/" + self.casper_initrd + "\n")
                 else:
                     keyboard = "console-setup/layoutcode=us"
+                    # the console arguments have to go before the "--", since
+                    # everything after it is passed to init instead of the
+                    # kernel
+                    console = self._install_console_args()
+                    if console:
+                        console += " "
                     if self.tdl.update == "6.06":
                         keyboard = "kbd-chooser/method=us"
                     f.write("  kernel /install/vmlinuz\n")
-                    f.write("  append preseed/file=/cdrom/preseed/customiso.seed debian-installer/locale=en_US " + keyboard + " netcfg/choose_interface=auto keyboard-configuration/layoutcode=us priority=critical initrd=/install/initrd.gz --\n")
+                    f.write("  append preseed/file=/cdrom/preseed/customiso.seed debian-installer/locale=en_US " + keyboard + " netcfg/choose_interface=auto keyboard-configuration/layoutcode=us priority=critical " + console + "initrd=/install/initrd.gz --\n")
 
 
     def get_auto_path(self):
@@ -207,7 +218,8 @@ PROMPT 0
                                            "-cache-inodes", "-boot-info-table",
                                            "-v", "-o", self.output_iso,
                                            self.iso_contents],
-                                          printfn=self.log.debug)
+                                          printfn=self.log.debug,
+                                          max_output=oz.ozutil.MAX_KEPT_OUTPUT)
 
     def install(self, timeout=None, force=False):
         """
@@ -277,6 +289,8 @@ PROMPT 0
         self.log.debug("Removing reportip")
         self._guestfs_remove_if_exists(g_handle, '/root/reportip')
 
+        self._image_ssh_teardown_announce_service(g_handle)
+
         # reset the service link
         self.log.debug("Resetting cron service")
         if self.cron_startuplink:
@@ -329,15 +343,8 @@ PROMPT 0
         self._guestfs_path_backup(g_handle, self.ssh_startuplink)
         g_handle.ln_sf('/etc/init.d/ssh', self.ssh_startuplink)
 
-        sshd_config_file = os.path.join(self.icicle_tmp, "sshd_config")
-        with open(sshd_config_file, 'w') as f:
-            f.write(self.sshd_config)
-
-        try:
-            self._guestfs_path_backup(g_handle, '/etc/ssh/sshd_config')
-            g_handle.upload(sshd_config_file, '/etc/ssh/sshd_config')
-        finally:
-            os.unlink(sshd_config_file)
+        self._guestfs_path_backup(g_handle, '/etc/ssh/sshd_config')
+        g_handle.write('/etc/ssh/sshd_config', self.sshd_config)
 
     def _image_ssh_setup_step_3(self, g_handle):
         """
@@ -347,31 +354,21 @@ PROMPT 0
         # part 3; make sure the guest announces itself
         self.log.debug("Step 3: Guest announcement")
 
-        scriptfile = os.path.join(self.icicle_tmp, "script")
-
         if g_handle.exists("/etc/NetworkManager/dispatcher.d"):
-            with open(scriptfile, 'w') as f:
-                f.write("""\
+            g_handle.write('/etc/NetworkManager/dispatcher.d/99-reportip', """\
 #!/bin/bash
 
 if [ "$1" = "eth0" -a "$2" = "up" ]; then
     echo -n "!$DHCP4_IP_ADDRESS,%s!" > /dev/ttyS1
 fi
-""" % (self.uuid))
-
-            try:
-                g_handle.upload(scriptfile,
-                                '/etc/NetworkManager/dispatcher.d/99-reportip')
-                g_handle.chmod(0755,
-                               '/etc/NetworkManager/dispatcher.d/99-reportip')
-            finally:
-                os.unlink(scriptfile)
+""" % (self.announce_token))
+            g_handle.chmod(0755,
+                           '/etc/NetworkManager/dispatcher.d/99-reportip')
 
         if not g_handle.exists('/usr/sbin/cron'):
             raise oz.OzException.OzException("cron not installed on the image, cannot continue")
 
-        with open(scriptfile, 'w') as f:
-            f.write("""\
+        g_handle.write('/root/reportip', """\
 #!/bin/bash
 /bin/sleep 20
 DEV=$(/usr/bin/awk '{if ($2 == 0) print $1}' /proc/net/route) &&
@@ -379,22 +376,13 @@ DEV=$(/usr/bin/awk '{if ($2 == 0) print $1}' /proc/net/route) &&
 ADDR=$(/sbin/ip -4 -o addr show dev $DEV | /usr/bin/awk '{print $4}' | /usr/bin/cut -d/ -f1) &&
 [ -z "$ADDR" ] && exit 0
 echo -n "!$ADDR,%s!" > /dev/ttyS1
-""" % (self.uuid))
+""" % (self.announce_token))
+        g_handle.chmod(0755, '/root/reportip')
 
-        try:
-            g_handle.upload(scriptfile, '/root/reportip')
-            g_handle.chmod(0755, '/root/reportip')
-        finally:
-            os.unlink(scriptfile)
+        g_handle.write('/etc/cron.d/announce',
+                       '*/1 * * * * root /bin/bash -c "/root/reportip"\n')
 
-        announcefile = os.path.join(self.icicle_tmp, "announce")
-        with open(announcefile, 'w') as f:
-            f.write('*/1 * * * * root /bin/bash -c "/root/reportip"\n')
-
-        try:
-            g_handle.upload(announcefile, '/etc/cron.d/announce')
-        finally:
-            os.unlink(announcefile)
+        self._image_ssh_setup_announce_service(g_handle)
 
         self.cron_startuplink = self._get_service_runlevel_link(g_handle,
                                                                 'cron')
@@ -414,26 +402,23 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
         # 2)  Make sure sshd is running on boot
         # 3)  Make the guest announce itself to the host
 
+        # the steps only record their changes, which are all made at once at
+        # the end, so a step that fails leaves the disk image untouched
         try:
-            try:
-                self._image_ssh_setup_step_1(g_handle)
-
-                try:
-                    self._image_ssh_setup_step_2(g_handle)
-
-                    try:
-                        self._image_ssh_setup_step_3(g_handle)
+            batch = self._guestfs_batch(g_handle)
+            self._image_ssh_setup_step_1(batch)
+            self._image_ssh_setup_step_2(batch)
+            self._image_ssh_setup_step_3(batch)
 
-                    except:
-                        self._image_ssh_teardown_step_3(g_handle)
-                        raise
-                except:
-                    self._image_ssh_teardown_step_2(g_handle)
-                    raise
+            try:
+                batch.apply()
             except:
-                self._image_ssh_teardown_step_1(g_handle)
+                undo = batch.undo_batch()
+                self._image_ssh_teardown_step_1(undo)
+                self._image_ssh_teardown_step_2(undo)
+                self._image_ssh_teardown_step_3(undo)
+                undo.apply()
                 raise
-
         finally:
             self._guestfs_handle_cleanup(g_handle)
 
@@ -446,13 +431,12 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
         g_handle = self._guestfs_handle_setup(libvirt_xml)
 
         try:
-            self._image_ssh_teardown_step_1(g_handle)
-
-            self._image_ssh_teardown_step_2(g_handle)
-
-            self._image_ssh_teardown_step_3(g_handle)
-
-            self._image_ssh_teardown_step_4(g_handle)
+            batch = self._guestfs_batch(g_handle)
+            self._image_ssh_teardown_step_1(batch)
+            self._image_ssh_teardown_step_2(batch)
+            self._image_ssh_teardown_step_3(batch)
+            self._image_ssh_teardown_step_4(batch)
+            batch.apply()
         finally:
             self._guestfs_handle_cleanup(g_handle)
             shutil.rmtree(self.icicle_tmp)
@@ -468,6 +452,13 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
             self.guest_execute_command(guestaddr, "apt-add-repository --yes '%s'" % (repo.url.strip('\'"')))
             self.guest_execute_command(guestaddr, "apt-get update")
 
+    def _can_customize_in_install(self):
+        """
+        Method to find out whether debian-installer can do the customization
+        in the TDL.
+        """
+        return self._preseed_can_customize()
+
     def _install_packages(self, guestaddr, packstr):
         self.guest_execute_command(guestaddr,
                                    'apt-get install -y %s' % (packstr))
@@ -556,14 +547,17 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
                 os.unlink(self.initrdfname)
                 raise
 
-    def _create_cpio_initrd(self, preseedpath):
+    def _create_cpio_initrd(self, preseedpath, scriptpath=None):
         """
-        Internal method to create a modified CPIO initrd
+        Internal method to create a modified CPIO initrd, with the
+        customization script at scriptpath if there is one.
         """
         extrafname = os.path.join(self.icicle_tmp, "extra.cpio")
         self.log.debug("Writing cpio to %s", extrafname)
         cpiofiledict = {}
         cpiofiledict[preseedpath] = 'preseed.cfg'
+        if scriptpath is not None:
+            cpiofiledict[scriptpath] = 'oz-customize.sh'
         oz.ozutil.write_cpio(cpiofiledict, extrafname)
 
         try:
@@ -621,12 +615,18 @@ echo -n "!$ADDR,%s!" > /dev/ttyS1
 
             try:
                 preseedpath = os.path.join(self.icicle_tmp, "preseed.cfg")
+                scriptpath = None
                 self._copy_preseed(preseedpath)
 
                 try:
-                    self._create_cpio_initrd(preseedpath)
+                    if self.customize_in_install:
+                        scriptpath = self._preseed_add_customization(preseedpath,
+                                                                     "/")
+                    self._create_cpio_initrd(preseedpath, scriptpath)
                 finally:
                     os.unlink(preseedpath)
+                    if scriptpath is not None:
+                        os.unlink(scriptpath)
             except:
                 os.unlink(self.kernelfname)
                 raise
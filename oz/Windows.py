@@ -73,7 +73,8 @@ class Windows_v5(Windows):
                                            "-V", "Custom",
                                            "-o", self.output_iso,
                                            self.iso_contents],
-                                          printfn=self.log.debug)
+                                          printfn=self.log.debug,
+                                          max_output=oz.ozutil.MAX_KEPT_OUTPUT)
 
     def generate_diskimage(self, size=10, force=False):
         """
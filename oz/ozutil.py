@@ -21,6 +21,7 @@ Miscellaneous utility functions.
 
 import os
 import random
+import base64
 import subprocess
 import tempfile
 import errno
@@ -28,15 +29,41 @@ import stat
 import shutil
 import pycurl
 import gzip
-import time
 import select
+import socket
+import uuid
+import re
+import threading
 try:
     import configparser
 except ImportError:
     import ConfigParser as configparser
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
 import collections
 import ftplib
 import struct
+import tarfile
+import ctypes
+import ctypes.util
+import mmap
+import io
+
+try:
+    _buffer = buffer
+except NameError:
+    def _buffer(obj, offset, size):
+        """
+        Replacement for the python 2 buffer() builtin, returning a view of
+        size bytes of obj starting at offset without copying the data.
+        """
+        return memoryview(obj)[offset:offset + size]
 
 def generate_full_auto_path(relative):
     """
@@ -50,11 +77,16 @@ def generate_full_auto_path(relative):
     pkg_path = os.path.dirname(__file__)
     return os.path.abspath(os.path.join(pkg_path, "auto", relative))
 
+# cache of the executables found by executable_exists(), keyed by the program
+# name and the PATH it was looked up in
+_executable_cache = {}
+
 def executable_exists(program):
     """
     Function to find out whether an executable exists in the PATH
     of the user.  If so, the absolute path to the executable is returned.
-    If not, an exception is raised.
+    If not, an exception is raised.  Executables that were found are
+    remembered, so looking them up again is cheap.
     """
     def is_exe(fpath):
         """
@@ -65,14 +97,20 @@ def executable_exists(program):
     if program is None:
         raise Exception("Invalid program name passed")
 
+    key = (program, os.environ["PATH"])
+    if key in _executable_cache:
+        return _executable_cache[key]
+
     fpath, fname = os.path.split(program)
     if fpath:
         if is_exe(program):
+            _executable_cache[key] = program
             return program
     else:
         for path in os.environ["PATH"].split(os.pathsep):
             exe_file = os.path.join(path, program)
             if is_exe(exe_file):
+                _executable_cache[key] = exe_file
                 return exe_file
 
     raise Exception("Could not find %s" % (program))
@@ -86,7 +124,7 @@ def write_bytes_to_fd(fd, buf):
     offset = 0
     while size > 0:
         try:
-            bytes_written = os.write(fd, buf[offset:])
+            bytes_written = os.write(fd, _buffer(buf, offset, size))
             offset += bytes_written
             size -= bytes_written
         except OSError as err:
@@ -120,10 +158,90 @@ def read_bytes_from_fd(fd, num):
 
     return ret
 
-def copyfile_sparse(src, dest):
+# constants for posix_fadvise() and sync_file_range() from the Linux headers;
+# older versions of python do not expose these
+POSIX_FADV_DONTNEED = 4
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+_libc = None
+
+def _get_libc():
+    """
+    Function to get a handle to the C library, for the system calls that
+    python does not wrap.
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+def drop_page_cache(fd, offset, length):
+    """
+    Function to tell the kernel that the data between offset and
+    offset+length in fd will not be needed again soon, so it can be dropped
+    from the page cache.  This is only advice; the kernel cannot drop pages
+    that are still dirty (see writeback_page_cache()), and errors are
+    ignored.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+        return
+
+    try:
+        fadvise = _get_libc().posix_fadvise64
+    except (OSError, AttributeError):
+        return
+    fadvise(ctypes.c_int(fd), ctypes.c_int64(offset), ctypes.c_int64(length),
+            ctypes.c_int(POSIX_FADV_DONTNEED))
+
+def writeback_page_cache(fd, offset, length, wait):
+    """
+    Function to start writeback of the dirty data between offset and
+    offset+length in fd.  If wait is True, this waits for the writeback to
+    finish, after which the data can be dropped from the page cache with
+    drop_page_cache().
+    """
+    flags = SYNC_FILE_RANGE_WRITE
+    if wait:
+        flags |= SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WAIT_AFTER
+
+    try:
+        sync_file_range = _get_libc().sync_file_range
+    except (OSError, AttributeError):
+        if wait:
+            os.fdatasync(fd)
+        return
+    sync_file_range(ctypes.c_int(fd), ctypes.c_int64(offset),
+                    ctypes.c_int64(length), ctypes.c_uint(flags))
+
+def _open_maybe_direct(path, flags, direct):
+    """
+    Function to open path, with O_DIRECT if direct is True and the filesystem
+    supports it (tmpfs, for instance, does not).  Returns a tuple of the file
+    descriptor and whether it was opened with O_DIRECT.
+    """
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(path, flags | os.O_DIRECT), True
+        except OSError as err:
+            if err.errno != errno.EINVAL:
+                raise
+    return os.open(path, flags), False
+
+def copyfile_sparse(src, dest, buf_size=None, drop_cache=False, direct=False):
     """
     Function to copy a file sparsely if possible.  The logic here is
     all taken from coreutils cp, specifically the 'sparse_copy' function.
+    The file is copied in chunks of buf_size bytes (by default, the block
+    size of the source file, but at least 32kB); holes are still detected
+    at the finer granularity.  If drop_cache is True, the copied data is
+    dropped from the page cache as the copy goes along, so that copying a
+    large disk image does not push the working set of everything else on
+    the host (like running guests) out of memory.  If direct is True, the
+    page cache is bypassed altogether by using O_DIRECT, on filesystems that
+    support it.
     """
     if src is None:
         raise Exception("Source of copy cannot be None")
@@ -140,35 +258,91 @@ def copyfile_sparse(src, dest):
     if not os.path.exists(base):
         mkdir_p(base)
 
-    src_fd = os.open(src, os.O_RDONLY)
+    src_fd, src_direct = _open_maybe_direct(src, os.O_RDONLY, direct)
 
     try:
-        dest_fd = os.open(dest, os.O_WRONLY|os.O_CREAT|os.O_TRUNC)
+        dest_fd, dest_direct = _open_maybe_direct(dest,
+                                                  os.O_WRONLY|os.O_CREAT|os.O_TRUNC,
+                                                  direct)
 
         try:
             sb = os.fstat(src_fd)
 
             # See io_blksize() in coreutils for an explanation of why 32*1024
-            buf_size = max(32*1024, sb.st_blksize)
+            hole_size = max(32*1024, sb.st_blksize)
+            if buf_size is None:
+                buf_size = hole_size
+            # the chunks are a multiple of the hole size, which also keeps
+            # them aligned for O_DIRECT
+            buf_size = max(hole_size, buf_size - buf_size % hole_size)
+
+            # O_DIRECT needs an aligned buffer, which an anonymous mmap is
+            aligned = None
+            if src_direct or dest_direct:
+                aligned = mmap.mmap(-1, buf_size)
+                src_file = io.FileIO(src_fd, 'r', closefd=False)
 
             size = sb.st_size
             destlen = 0
+            last_chunk = None
             while size != 0:
-                buf = read_bytes_from_fd(src_fd, min(buf_size, size))
-                if len(buf) == 0:
+                if aligned is not None:
+                    buflen = src_file.readinto(aligned)
+                    buf = aligned[:buflen]
+                else:
+                    buf = read_bytes_from_fd(src_fd, min(buf_size, size))
+                    buflen = len(buf)
+                if buflen == 0:
                     break
 
-                buflen = len(buf)
-                if buf == '\0'*buflen:
-                    os.lseek(dest_fd, buflen, os.SEEK_CUR)
-                else:
-                    write_bytes_to_fd(dest_fd, buf)
+                offset = 0
+                while offset < buflen:
+                    chunk = min(hole_size, buflen - offset)
+                    if buf[offset:offset + chunk] == '\0'*chunk:
+                        os.lseek(dest_fd, chunk, os.SEEK_CUR)
+                    elif dest_direct:
+                        # O_DIRECT writes must be a multiple of the logical
+                        # block size; write out the tail padded with zeros,
+                        # the ftruncate() below cuts it off again
+                        padded = (chunk + 511) & ~511
+                        aligned[offset + chunk:offset + padded] = '\0'*(padded - chunk)
+                        write_bytes_to_fd(dest_fd, _buffer(aligned, offset,
+                                                           padded))
+                        os.lseek(dest_fd, destlen + offset + chunk,
+                                 os.SEEK_SET)
+                    elif aligned is not None:
+                        write_bytes_to_fd(dest_fd, _buffer(aligned, offset,
+                                                           chunk))
+                    else:
+                        write_bytes_to_fd(dest_fd, buf[offset:offset + chunk])
+                    offset += chunk
+
+                if drop_cache:
+                    if not src_direct:
+                        drop_page_cache(src_fd, destlen, buflen)
+                    if not dest_direct:
+                        # start writing this chunk back, and wait for the
+                        # previous one so it can be dropped; this keeps the
+                        # amount of dirty data bounded without stalling on
+                        # every chunk
+                        writeback_page_cache(dest_fd, destlen, buflen, False)
+                        if last_chunk is not None:
+                            writeback_page_cache(dest_fd, last_chunk[0],
+                                                 last_chunk[1], True)
+                            drop_page_cache(dest_fd, last_chunk[0],
+                                            last_chunk[1])
+                        last_chunk = (destlen, buflen)
 
                 destlen += buflen
                 size -= buflen
 
             os.ftruncate(dest_fd, destlen)
 
+            if last_chunk is not None:
+                writeback_page_cache(dest_fd, last_chunk[0], last_chunk[1],
+                                     True)
+                drop_page_cache(dest_fd, last_chunk[0], last_chunk[1])
+
         finally:
             os.close(dest_fd)
     finally:
@@ -358,70 +532,111 @@ class SubprocessException(Exception):
         Exception.__init__(self, msg)
         self.retcode = retcode
 
+# how much of the output of chatty commands (like genisoimage -v) to keep in
+# memory; all of it is still handed to the printfn of subprocess_check_output
+MAX_KEPT_OUTPUT = 64 * 1024
+
+class _OutputBuffer(object):
+    """
+    Internal class to collect the output of a subprocess.  If limit is not
+    None, only the last limit bytes of the output are kept.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def append(self, data):
+        """
+        Method to add a chunk of output.
+        """
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.limit is not None:
+            while self.size - len(self.chunks[0]) >= self.limit:
+                self.size -= len(self.chunks.popleft())
+
+    def getvalue(self):
+        """
+        Method to get the collected output.
+        """
+        out = ''.join(self.chunks)
+        if self.limit is not None:
+            out = out[-self.limit:]
+        return out
+
 def subprocess_check_output(*popenargs, **kwargs):
     """
-    Function to call a subprocess and gather the output.
+    Function to call a subprocess and gather the output.  The output is read
+    as it arrives and handed to printfn (if given), and the function returns
+    as soon as the subprocess exits.  If max_output is given, only the last
+    max_output bytes of stdout and of stderr are kept.
     """
     if 'stdout' in kwargs:
         raise ValueError('stdout argument not allowed, it will be overridden.')
     if 'stderr' in kwargs:
         raise ValueError('stderr argument not allowed, it will be overridden.')
 
-    printfn = None
-    if kwargs.has_key('printfn'):
-        printfn = kwargs['printfn']
-        del kwargs['printfn']
+    printfn = kwargs.pop('printfn', None)
+    max_output = kwargs.pop('max_output', None)
 
     executable_exists(popenargs[0][0])
 
     process = subprocess.Popen(stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                                *popenargs, **kwargs)
 
+    stdout_fd = process.stdout.fileno()
+    stderr_fd = process.stderr.fileno()
+    outputs = {stdout_fd: _OutputBuffer(max_output),
+               stderr_fd: _OutputBuffer(max_output)}
+
     poller = select.poll()
-    select_POLLIN_POLLPRI = select.POLLIN | select.POLLPRI
-    poller.register(process.stdout.fileno(), select_POLLIN_POLLPRI)
-    poller.register(process.stderr.fileno(), select_POLLIN_POLLPRI)
-
-    stdout = ''
-    stderr = ''
-    retcode = process.poll()
-    while retcode is None:
-        start = time.time()
+    for fd in outputs:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+
+    # read until both pipes are closed.  A child that leaves a background
+    # process holding the pipes open (ssh ControlPersist, for instance) would
+    # keep us here forever, so once the child has exited we only drain what
+    # is already there
+    open_fds = set(outputs)
+    exited = False
+    while open_fds:
+        if exited:
+            timeout = 0
+        else:
+            timeout = 100
         try:
-            ready = poller.poll(1000)
-        except select.error, e:
+            ready = poller.poll(timeout)
+        except select.error as e:
             if e.args[0] == errno.EINTR:
                 continue
             raise
 
+        if not ready:
+            if exited:
+                break
+            exited = process.poll() is not None
+            continue
+
         for fd, mode in ready:
-            if mode & select_POLLIN_POLLPRI:
-                data = os.read(fd, 4096)
-                if not data:
-                    poller.unregister(fd)
-                else:
-                    if printfn is not None:
-                        printfn(data)
-                    if fd == process.stdout.fileno():
-                        stdout += data
-                    else:
-                        stderr += data
-            else:
-                # Ignore hang up or errors.
+            data = ''
+            if mode & (select.POLLIN | select.POLLPRI | select.POLLHUP):
+                data = os.read(fd, 65536)
+            if not data:
+                # EOF, hang up or error
                 poller.unregister(fd)
+                open_fds.discard(fd)
+                continue
+            if printfn is not None:
+                printfn(data)
+            outputs[fd].append(data)
 
-        end = time.time()
-        if (end - start) < 1:
-            time.sleep(1 - (end - start))
-        retcode = process.poll()
-
-    tmpout, tmperr = process.communicate()
+    retcode = process.wait()
+    process.stdout.close()
+    process.stderr.close()
 
-    stdout += tmpout
-    stderr += tmperr
-    if printfn is not None:
-        printfn(tmperr)
-        printfn(tmpout)
+    stdout = outputs[stdout_fd].getvalue()
+    stderr = outputs[stderr_fd].getvalue()
 
     if retcode:
         cmd = ' '.join(*popenargs)
@@ -630,6 +845,36 @@ def write_cpio(inputdict, outputfile):
 
     outf.close()
 
+def write_tar(inputdict, outputfile):
+    """
+    Function to write a tar archive.  The inputdict is a dictionary of files
+    to put in the archive, where the dictionary key is the path to the file
+    on the local filesystem and the dictionary value is the location that the
+    file should have in the archive.  The files keep their mode, but are owned
+    by root in the archive.  The outputfile is the location of the final tar
+    archive that will be written.
+    """
+    if inputdict is None:
+        raise Exception("input dictionary was None")
+    if outputfile is None:
+        raise Exception("output file was None")
+
+    tar = tarfile.open(outputfile, "w")
+    try:
+        for inputfile, destfile in list(inputdict.items()):
+            info = tar.gettarinfo(inputfile, destfile.lstrip('/'))
+            info.uid = 0
+            info.gid = 0
+            info.uname = "root"
+            info.gname = "root"
+            inf = open(inputfile, 'rb')
+            try:
+                tar.addfile(info, inf)
+            finally:
+                inf.close()
+    finally:
+        tar.close()
+
 def config_get_key(config, section, key, default):
     """
     Function to retrieve config parameters out of the config file.
@@ -681,6 +926,249 @@ def rmtree_and_sync(directory):
     finally:
         os.close(fd)
 
+def get_memory_available(meminfo='/proc/meminfo'):
+    """
+    Function to find out how much memory (in bytes) is available on the host
+    for new allocations, without pushing the host into swap.  Newer kernels
+    export this directly as MemAvailable; on older kernels it is estimated
+    from the free memory plus the page cache.
+    """
+    values = {}
+    with open(meminfo, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            values[fields[0].rstrip(':')] = int(fields[1]) * 1024
+
+    if 'MemAvailable' in values:
+        return values['MemAvailable']
+
+    return values.get('MemFree', 0) + values.get('Buffers', 0) + values.get('Cached', 0)
+
+def scratch_space_available(directory, budget):
+    """
+    Function to check whether a RAM-backed scratch directory can hold budget
+    bytes of data.  Both the filesystem the directory lives on and the memory
+    of the host need to have at least that much room left, since tmpfs
+    happily accepts more data than fits into memory and pushes the host into
+    swap instead.
+    """
+    st = os.statvfs(directory)
+    if st.f_bavail * st.f_frsize < budget:
+        return False
+
+    return get_memory_available() >= budget
+
+def port_open(addr, port, timeout):
+    """
+    Function to check whether a TCP port at addr accepts connections,
+    waiting up to timeout seconds for the connection.
+    """
+    try:
+        sock = socket.create_connection((addr, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    sock.close()
+    return True
+
+# the longest announcement a guest can send; longer runs of data are garbage
+MAX_ANNOUNCE_LENGTH = 256
+
+def parse_announce(buf, data):
+    """
+    Function to incrementally find the !<ip>,<uuid>! announcements that
+    guests send over their serial port once they have booted.  buf is the
+    left over from the last call (or the empty string the first time), and
+    data is the newly received data.  Returns a tuple of the list of
+    announcements found (the text between the exclamation marks) and the
+    new left over, which is never longer than MAX_ANNOUNCE_LENGTH.
+    """
+    parts = (buf + data).split('!')
+    if len(parts) == 1:
+        # no announcement can start in this data
+        return [], ''
+
+    announcements = [part for part in parts[1:-1] if ',' in part]
+
+    leftover = parts[-1]
+    if len(leftover) >= MAX_ANNOUNCE_LENGTH:
+        return announcements, ''
+
+    return announcements, '!' + leftover
+
+def generate_command_runner(commands):
+    """
+    Function to generate a shell script that runs the list of commands (the
+    text of shell scripts) one after the other.  The output of each command
+    is framed by @@OZ-BEGIN <n>@@ and @@OZ-END <n> <exit status>@@ markers,
+    with n counting from 1, and the script stops after the first command
+    that fails.  The output can be picked apart with parse_runner_output().
+    """
+    token = uuid.uuid4().hex
+    for command in commands:
+        if token in command:
+            # practically impossible, but it would break the here-document
+            raise Exception("Command contains the here-document delimiter")
+
+    script = ["#!/bin/sh",
+              "oz_cmd=$(mktemp /tmp/oz-command.XXXXXX) || exit 1",
+              "trap 'rm -f \"$oz_cmd\"' EXIT"]
+    for index, command in enumerate(commands, 1):
+        if not command.endswith("\n"):
+            command += "\n"
+        script += ["cat > \"$oz_cmd\" <<'OZ_EOF_%s'" % (token),
+                   command + "OZ_EOF_%s" % (token),
+                   "echo \"@@OZ-BEGIN %d@@\"" % (index),
+                   "${SHELL:-/bin/sh} \"$oz_cmd\" < /dev/null 2>&1",
+                   "oz_status=$?",
+                   # the output of the command may not end in a newline
+                   "echo",
+                   "echo \"@@OZ-END %d $oz_status@@\"" % (index),
+                   # the exit status is reported in the marker
+                   "[ $oz_status -eq 0 ] || exit 0"]
+
+    return "\n".join(script) + "\n"
+
+# what installers print on the serial console when the script from
+# generate_install_script fails, so that the failure shows up in the console
+# log (and fails the install) even if the installer itself only shows it on
+# the screen
+INSTALL_SCRIPT_FAILED_MARKER = "@@OZ-CUSTOMIZE-FAILED@@"
+
+def generate_install_script(files, commands, remove=()):
+    """
+    Function to generate a shell script that installers can run in the
+    installed system to do the customization of a TDL: it writes files (a
+    list of (path, content) tuples), runs the list of commands (the text of
+    shell scripts) one after the other, and then removes the paths in
+    remove.  The script stops with a non-zero exit status after the first
+    command that fails.  The content of the files is base64 encoded, so it
+    can be binary.
+    """
+    token = uuid.uuid4().hex
+    for command in commands:
+        if token in command:
+            # practically impossible, but it would break the here-document
+            raise Exception("Command contains the here-document delimiter")
+
+    script = ["#!/bin/sh",
+              "oz_cmd=$(mktemp /tmp/oz-command.XXXXXX) || exit 1",
+              "trap 'rm -f \"$oz_cmd\"' EXIT"]
+    for path, content in files:
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        encoded = base64.b64encode(content).decode('ascii')
+        lines = [encoded[i:i + 76] for i in range(0, len(encoded), 76)]
+        script += ["mkdir -p %s || exit 1" % (quote(os.path.dirname(path) or '/')),
+                   "base64 -d > %s <<'OZ_EOF_%s' || exit 1" % (quote(path), token)]
+        script += lines
+        script.append("OZ_EOF_%s" % (token))
+    for index, command in enumerate(commands, 1):
+        if not command.endswith("\n"):
+            command += "\n"
+        script += ["cat > \"$oz_cmd\" <<'OZ_EOF_%s'" % (token),
+                   command + "OZ_EOF_%s" % (token),
+                   "/bin/sh \"$oz_cmd\" < /dev/null || { echo \"Custom command %d failed\" >&2; exit 1; }" % (index)]
+    for path in remove:
+        script.append("rm -f %s" % (quote(path)))
+
+    return "\n".join(script) + "\n"
+
+_runner_marker_re = re.compile(r'@@OZ-(BEGIN|END) (\d+)(?: (\d+))?@@\n?')
+
+def parse_runner_output(output):
+    """
+    Function to pick apart the output of a script generated by
+    generate_command_runner().  Returns a list of (n, exit status, output)
+    tuples, one for each of the commands that started; the exit status is
+    None if the command never finished.
+    """
+    results = []
+    start = None
+    for match in _runner_marker_re.finditer(output):
+        marker, index, status = match.groups()
+        if marker == 'BEGIN':
+            if start is not None:
+                results.append((start[0], None, output[start[1]:match.start()]))
+            start = (int(index), match.end())
+        elif start is not None and int(index) == start[0]:
+            results.append((start[0], int(status),
+                            output[start[1]:match.start()]))
+            start = None
+
+    if start is not None:
+        results.append((start[0], None, output[start[1]:]))
+
+    return results
+
+def run_parallel(func, items, workers):
+    """
+    Function to call func(item) for every item in items, with at most
+    workers calls running at the same time (each one in a thread of its
+    own).  This is a generator of (item, result, exception) tuples, which
+    are yielded as the calls finish; exception is None if the call
+    succeeded, and result is None if it raised an exception.
+    """
+    if workers < 1:
+        raise Exception("At least one worker is needed")
+
+    todo = queue.Queue()
+    count = 0
+    for item in items:
+        todo.put(item)
+        count += 1
+
+    done = queue.Queue()
+
+    def _worker():
+        """
+        Function running in the worker threads.
+        """
+        while True:
+            try:
+                item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                done.put((item, func(item), None))
+            except Exception as err:
+                done.put((item, None, err))
+
+    threads = []
+    for i in range(min(workers, count)):
+        thread = threading.Thread(target=_worker, name="oz-worker-%d" % (i))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for i in range(count):
+        yield done.get()
+
+    for thread in threads:
+        thread.join()
+
+def read_variants(variants):
+    """
+    Function to get the list of TDL files to customize overlays for, from
+    variants, which is either a directory of .tdl files or a file listing one
+    TDL per line.
+    """
+    if os.path.isdir(variants):
+        return [os.path.join(variants, name) for name in sorted(os.listdir(variants))
+                if name.endswith(".tdl")]
+
+    # paths in the list are relative to the list itself
+    basedir = os.path.dirname(variants)
+    tdlfiles = []
+    with open(variants, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            tdlfiles.append(os.path.join(basedir, line))
+    return tdlfiles
+
 def parse_config(config_file):
     """
     Function to parse the configuration file.  If the passed in config_file is
@@ -738,6 +1226,21 @@ def default_screenshot_dir():
     """
     return os.path.join(default_data_dir(), "screenshots")
 
+def default_console_log_dir():
+    """
+    Function to get the default path to the console log directory. The
+    directory is generated relative to the default data directory.
+    """
+    return os.path.join(default_data_dir(), "consolelogs")
+
+def default_guestfs_cache_dir():
+    """
+    Function to get the default path to the directory that the libguestfs
+    appliances are built in.  The directory is generated relative to the
+    default data directory.
+    """
+    return os.path.join(default_data_dir(), "guestfs")
+
 def http_get_header(url, redirect=True):
     """
     Function to get the HTTP headers from a URL.  The available headers will be
@@ -794,9 +1297,11 @@ def http_get_header(url, redirect=True):
 
     return info
 
-def http_download_file(url, fd, show_progress, logger):
+def http_download_file(url, fd, show_progress, logger, drop_cache=False):
     """
-    Function to download a file from url to file descriptor fd.
+    Function to download a file from url to file descriptor fd.  If
+    drop_cache is True, the downloaded data is written back and dropped from
+    the page cache as the download goes along.
     """
     class Progress(object):
         """
@@ -819,13 +1324,46 @@ def http_download_file(url, fd, show_progress, logger):
                 self.last_mb = current_mb
                 logger.debug("%dkB of %dkB" % (down_current/1024, down_total/1024))
 
+    class Writeback(object):
+        """
+        Internal class to keep track of the downloaded data that has not been
+        dropped from the page cache yet.
+        """
+        def __init__(self):
+            self.offset = os.lseek(fd, 0, os.SEEK_CUR)
+            self.pending = 0
+
+        def written(self, length):
+            """
+            Function that is called after length bytes were written to fd.
+            Every 8MB, the data is written back and dropped from the page
+            cache.
+            """
+            self.pending += length
+            if self.pending >= 8*1024*1024:
+                self.flush()
+
+        def flush(self):
+            """
+            Function to write back and drop all of the pending data.
+            """
+            if self.pending == 0:
+                return
+            writeback_page_cache(fd, self.offset, self.pending, True)
+            drop_page_cache(fd, self.offset, self.pending)
+            self.offset += self.pending
+            self.pending = 0
+
     def _data(buf):
         """
         Function that is called back from the pycurl perform() method to
         actually write data to disk.
         """
         write_bytes_to_fd(fd, buf)
+        if drop_cache:
+            writeback.written(len(buf))
 
+    writeback = Writeback()
     progress = Progress()
     c = pycurl.Curl()
     c.setopt(c.URL, url)
@@ -837,6 +1375,8 @@ def http_download_file(url, fd, show_progress, logger):
         c.setopt(c.PROGRESSFUNCTION, progress.progress)
     c.perform()
     c.close()
+    if drop_cache:
+        writeback.flush()
 
 def ftp_download_directory(server, username, password, basepath, destination):
     """
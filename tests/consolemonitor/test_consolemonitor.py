@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+import sys
+import os
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.ConsoleMonitor
+    import oz.Linux
+    import oz.RedHat
+    import oz.ozutil
+except ImportError:
+    print('Unable to import oz.  Is oz installed?')
+    sys.exit(1)
+
+# test oz.ConsoleMonitor.console_lines
+def test_console_lines_split():
+    lines, buf = oz.ConsoleMonitor.console_lines('', 'one\ntwo\nthr')
+    assert(lines == ['one', 'two'])
+    assert(buf == 'thr')
+    lines, buf = oz.ConsoleMonitor.console_lines(buf, 'ee\n')
+    assert(lines == ['three'])
+    assert(buf == '')
+
+def test_console_lines_blank():
+    lines, buf = oz.ConsoleMonitor.console_lines('', '\n  \n\r\nword\n')
+    assert(lines == ['word'])
+
+def test_console_lines_carriage_return():
+    # progress meters overwrite the line they are on
+    lines, buf = oz.ConsoleMonitor.console_lines('', ' 10%\r 50%\r100% done\r\n')
+    assert(lines == ['100% done'])
+
+def test_console_lines_escapes():
+    lines, buf = oz.ConsoleMonitor.console_lines('', '\x1b[1;37;44m\x1b[2JInstalling the base system\x1b[0m\x1b(B\n')
+    assert(lines == ['Installing the base system'])
+
+def test_console_lines_long():
+    data = 'x' * (oz.ConsoleMonitor.MAX_LINE_LENGTH * 2 + 10)
+    lines, buf = oz.ConsoleMonitor.console_lines('', data)
+    assert(lines == ['x' * oz.ConsoleMonitor.MAX_LINE_LENGTH] * 2)
+    assert(buf == 'x' * 10)
+
+# test oz.ConsoleMonitor.ConsoleMonitor pattern matching
+def console_monitor(tmpdir, stage_patterns, error_patterns):
+    console = oz.ConsoleMonitor.ConsoleMonitor(None, str(tmpdir.join('console.log')),
+                                               stage_patterns, error_patterns)
+    console._logfile = open(console.logpath, 'ab')
+    return console
+
+def test_console_monitor_log_and_stage(tmpdir):
+    console = console_monitor(tmpdir, oz.Linux.DI_STAGE_PATTERNS,
+                              oz.Linux.DI_ERROR_PATTERNS)
+    console._process(b'Installing the base sys')
+    assert(console.stage is None)
+    console._process(b'tem\nSelect and install software\n')
+    console.close()
+    assert(console.stage == 'software installation')
+    assert(not console.failed())
+    assert(open(console.logpath, 'rb').read() == b'Installing the base system\nSelect and install software\n')
+
+def test_console_monitor_di_errors(tmpdir):
+    for line in ['Failed to run preseeded command',
+                 'Execution of preseeded command "cp /cdrom/preseed/oz-customize.sh" failed with exit code 1.',
+                 oz.ozutil.INSTALL_SCRIPT_FAILED_MARKER,
+                 'Bad archive mirror']:
+        console = console_monitor(tmpdir, oz.Linux.DI_STAGE_PATTERNS,
+                                  oz.Linux.DI_ERROR_PATTERNS)
+        console._process((line + '\n').encode('utf-8'))
+        console.close()
+        assert(console.failed())
+
+def test_console_monitor_anaconda_errors(tmpdir):
+    for line in ["You have specified that the package 'foo' should be installed.  This package does not exist.",
+                 "The following problem occurred on line 12 of the kickstart file:",
+                 "An unknown error has occurred",
+                 oz.ozutil.INSTALL_SCRIPT_FAILED_MARKER]:
+        console = console_monitor(tmpdir, oz.RedHat.ANACONDA_STAGE_PATTERNS,
+                                  oz.RedHat.ANACONDA_ERROR_PATTERNS)
+        console._process((line + '\n').encode('utf-8'))
+        console.close()
+        assert(console.failed())
+
+def test_console_monitor_anaconda_harmless(tmpdir):
+    # things that show up on the console of installs that go fine
+    console = console_monitor(tmpdir, oz.RedHat.ANACONDA_STAGE_PATTERNS,
+                              oz.RedHat.ANACONDA_ERROR_PATTERNS)
+    console._process(b'Traceback (most recent call last):\n'
+                     b'No package foo available.\n'
+                     b'Unknown command: bar\n'
+                     b'package foo is not installed\n'
+                     b'Running post-installation scripts\n')
+    console.close()
+    assert(not console.failed())
+    assert(console.stage == 'post-installation scripts')
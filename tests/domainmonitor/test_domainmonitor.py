@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+import sys
+import os
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.DomainMonitor
+    import libvirt
+except ImportError:
+    print('Unable to import oz.  Is oz installed?')
+    sys.exit(1)
+
+class FakeLibvirtError(libvirt.libvirtError):
+    def __init__(self, code):
+        libvirt.libvirtError.__init__(self, "fake error %d" % (code))
+        self.code = code
+
+    def get_error_code(self):
+        return self.code
+
+class FakeDomain(object):
+    def __init__(self, uuid, active=True):
+        self.uuid = uuid
+        self.active = active
+        self.screenshot_error = None
+
+    def UUIDString(self):
+        return self.uuid
+
+    def name(self):
+        return 'dom-' + self.uuid
+
+    def isActive(self):
+        if self.active is None:
+            raise FakeLibvirtError(libvirt.VIR_ERR_NO_DOMAIN)
+        return self.active
+
+    def screenshot(self, stream, screen, flags):
+        if self.screenshot_error is not None:
+            raise FakeLibvirtError(self.screenshot_error)
+        stream.data = [b'screen of ' + self.uuid.encode('utf-8')]
+
+class FakeStream(object):
+    def __init__(self):
+        self.data = []
+
+    def recvAll(self, handler, opaque):
+        for buf in self.data:
+            handler(self, buf, opaque)
+
+    def finish(self):
+        pass
+
+class FakeConnection(object):
+    """
+    Stand-in for a libvirt connection, with a way to send lifecycle events
+    and to set the bulk statistics of the domains.
+    """
+    def __init__(self):
+        self.callbacks = {}
+        self.close_callback = None
+        self.stats = {}
+        self.stats_error = None
+        self.alive = True
+
+    def domainEventRegisterAny(self, dom, eventID, cb, opaque):
+        callback_id = len(self.callbacks)
+        self.callbacks[callback_id] = cb
+        return callback_id
+
+    def domainEventDeregisterAny(self, callback_id):
+        del self.callbacks[callback_id]
+
+    def registerCloseCallback(self, cb, opaque):
+        self.close_callback = cb
+
+    def isAlive(self):
+        return self.alive
+
+    def event(self, dom, event, detail=0):
+        for cb in list(self.callbacks.values()):
+            cb(self, dom, event, detail, None)
+
+    def domainListGetStats(self, doms, stats, flags):
+        if self.stats_error is not None:
+            raise FakeLibvirtError(self.stats_error)
+        return [(dom, self.stats[dom.UUIDString()]) for dom in doms
+                if dom.UUIDString() in self.stats]
+
+    def newStream(self, flags):
+        return FakeStream()
+
+class FakeOldConnection(FakeConnection):
+    """
+    A connection to a libvirt that cannot do bulk statistics.
+    """
+    def __getattribute__(self, name):
+        if name == 'domainListGetStats':
+            raise AttributeError(name)
+        return FakeConnection.__getattribute__(self, name)
+
+def activity(disk, net):
+    return {'block.count': 1, 'block.0.rd.reqs': disk, 'block.0.wr.reqs': 0,
+            'net.count': 1, 'net.0.rx.bytes': net, 'net.0.tx.bytes': 0}
+
+# test oz.DomainMonitor.DomainMonitor lifecycle events
+def test_lifecycle_stopped():
+    conn = FakeConnection()
+    monitor = oz.DomainMonitor.DomainMonitor(conn)
+    dom = FakeDomain('1')
+    watch = monitor.watch(dom)
+    other = monitor.watch(FakeDomain('2'))
+    assert(not watch.stopped())
+    assert(not watch.wait(0))
+
+    conn.event(dom, libvirt.VIR_DOMAIN_EVENT_STOPPED, 3)
+    assert(watch.wait(0))
+    assert(watch.stop_detail == 3)
+    assert(not other.stopped())
+
+def test_lifecycle_other_events():
+    conn = FakeConnection()
+    monitor = oz.DomainMonitor.DomainMonitor(conn)
+    dom = FakeDomain('1')
+    watch = monitor.watch(dom)
+    conn.event(dom, libvirt.VIR_DOMAIN_EVENT_STOPPED + 1)
+    assert(not watch.stopped())
+
+def test_watch_already_stopped():
+    monitor = oz.DomainMonitor.DomainMonitor(FakeConnection())
+    assert(monitor.watch(FakeDomain('1', active=False)).stopped())
+    assert(monitor.watch(FakeDomain('2', active=None)).stopped())
+
+def test_watch_close():
+    conn = FakeConnection()
+    monitor = oz.DomainMonitor.DomainMonitor(conn)
+    dom = FakeDomain('1')
+    one = monitor.watch(dom)
+    two = monitor.watch(dom)
+    one.close()
+    conn.event(dom, libvirt.VIR_DOMAIN_EVENT_STOPPED)
+    assert(not one.stopped())
+    assert(two.stopped())
+    two.close()
+    assert(monitor._watches == {})
+
+# test oz.DomainMonitor.DomainMonitor activity sampling
+def test_sample_activity():
+    conn = FakeConnection()
+    monitor = oz.DomainMonitor.DomainMonitor(conn)
+    conn.stats['1'] = activity(5, 100)
+    watch = monitor.watch(FakeDomain('1'), sample_activity=True)
+    try:
+        assert(watch.sampling)
+        assert(watch.next_sample(5) == (5, 100))
+        conn.stats['1'] = activity(7, 300)
+        assert(watch.next_sample(5) == (7, 300))
+    finally:
+        monitor.close()
+
+def test_sample_missing_domain():
+    conn = FakeConnection()
+    monitor = oz.DomainMonitor.DomainMonitor(conn)
+    watch = oz.DomainMonitor.DomainWatch(FakeDomain('1'), monitor)
+    watch.sampling = True
+    monitor._sample_stats([watch])
+    assert(watch.next_sample(0) is None)
+    assert(watch.sampling)
+
+def test_sample_no_bulk_stats():
+    monitor = oz.DomainMonitor.DomainMonitor(FakeOldConnection())
+    watch = monitor.watch(FakeDomain('1'), sample_activity=True)
+    assert(not watch.sampling)
+    assert(watch.next_sample(0) is None)
+
+def test_sample_bulk_stats_not_supported():
+    conn = FakeConnection()
+    conn.stats_error = libvirt.VIR_ERR_NO_SUPPORT
+    monitor = oz.DomainMonitor.DomainMonitor(conn)
+    watch = oz.DomainMonitor.DomainWatch(FakeDomain('1'), monitor)
+    watch.sampling = True
+    monitor._sample_stats([watch])
+    assert(not watch.sampling)
+    assert(not monitor._bulk_stats)
+
+def test_sample_stopped():
+    watch = oz.DomainMonitor.DomainWatch(FakeDomain('1'))
+    watch.sampling = True
+    watch._mark_stopped(None)
+    assert(watch.next_sample(5) is None)
+
+# test oz.DomainMonitor.DomainMonitor._hash_screen
+def test_hash_screen():
+    monitor = oz.DomainMonitor.DomainMonitor(FakeConnection())
+    watch = oz.DomainMonitor.DomainWatch(FakeDomain('1'), monitor)
+    watch.screen_interval = 10
+    assert(watch.screen_static_for() == 0)
+    monitor._hash_screen(watch)
+    assert(len(watch._screen_hashes) == 1)
+    assert(watch.screen_static_for() >= 0)
+
+def test_hash_screen_retries():
+    monitor = oz.DomainMonitor.DomainMonitor(FakeConnection())
+    dom = FakeDomain('1')
+    watch = oz.DomainMonitor.DomainWatch(dom, monitor)
+    watch.screen_interval = 10
+    dom.screenshot_error = libvirt.VIR_ERR_NO_SUPPORT
+    for i in range(oz.DomainMonitor._SCREEN_MAX_FAILURES - 1):
+        monitor._hash_screen(watch)
+    assert(watch.screen_interval == 10)
+    # a good screenshot resets the count
+    dom.screenshot_error = None
+    monitor._hash_screen(watch)
+    assert(watch._screen_failures == 0)
+    dom.screenshot_error = libvirt.VIR_ERR_NO_SUPPORT
+    for i in range(oz.DomainMonitor._SCREEN_MAX_FAILURES):
+        monitor._hash_screen(watch)
+    assert(watch.screen_interval == 0)
+    assert(watch.screen_static_for() == 0)
+
+def test_hash_screen_no_domain():
+    monitor = oz.DomainMonitor.DomainMonitor(FakeConnection())
+    dom = FakeDomain('1')
+    dom.screenshot_error = libvirt.VIR_ERR_NO_DOMAIN
+    watch = oz.DomainMonitor.DomainWatch(dom, monitor)
+    watch.screen_interval = 10
+    monitor._hash_screen(watch)
+    assert(watch.screen_interval == 0)
+
+# test oz.DomainMonitor.PollingDomainWatch
+def test_polling_watch():
+    dom = FakeDomain('1')
+    watch = oz.DomainMonitor.watch_domain(FakeConnection(), dom)
+    assert(isinstance(watch, oz.DomainMonitor.PollingDomainWatch))
+    assert(not watch.wait(0))
+    dom.active = False
+    assert(watch.wait(0))
+    watch.close()
+
+# test oz.DomainMonitor.get_monitor and open_connection
+def test_get_monitor_dropped_on_close(monkeypatch):
+    monkeypatch.setattr(oz.DomainMonitor, '_event_loop_thread', object())
+    monkeypatch.setattr(oz.DomainMonitor, '_monitors', {})
+    conn = FakeConnection()
+    monitor = oz.DomainMonitor.get_monitor(conn)
+    assert(oz.DomainMonitor.get_monitor(conn) is monitor)
+    dom = FakeDomain('1')
+    watch = oz.DomainMonitor.watch_domain(conn, dom)
+    assert(watch.monitor is monitor)
+
+    conn.close_callback(conn, 0, None)
+    assert(oz.DomainMonitor._monitors == {})
+    assert(conn.callbacks == {})
+    # the watch that was left over falls back to polling
+    assert(watch.polling)
+    dom.active = False
+    assert(watch.wait(0))
+
+def test_open_connection(monkeypatch):
+    monkeypatch.setattr(oz.DomainMonitor, '_event_loop_thread', object())
+    monkeypatch.setattr(oz.DomainMonitor, '_monitors', {})
+    monkeypatch.setattr(oz.DomainMonitor, '_connections', {})
+    monkeypatch.setattr(libvirt, 'open', lambda uri: FakeConnection(), raising=False)
+
+    conn = oz.DomainMonitor.open_connection('qemu:///system')
+    assert(oz.DomainMonitor.open_connection('qemu:///system') is conn)
+    assert(oz.DomainMonitor.open_connection('qemu:///session') is not conn)
+
+    # a dead connection is replaced, and its monitor dropped
+    oz.DomainMonitor.get_monitor(conn)
+    conn.alive = False
+    again = oz.DomainMonitor.open_connection('qemu:///system')
+    assert(again is not conn)
+    assert(conn not in oz.DomainMonitor._monitors)
+
+    # so is a closed one
+    oz.DomainMonitor.get_monitor(again)
+    again.close_callback(again, 0, None)
+    assert(oz.DomainMonitor.open_connection('qemu:///system') is not again)
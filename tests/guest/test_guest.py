@@ -11,7 +11,11 @@ except:
     from StringIO import StringIO
     BytesIO = StringIO
 import logging
+import lxml.etree
 import os
+import re
+import shutil
+import subprocess
 
 # Find oz library
 prefix = '.'
@@ -24,7 +28,10 @@ for i in range(0,3):
 
 try:
     import oz.TDL
+    import oz.Guest
     import oz.GuestFactory
+    import oz.RedHat
+    import libvirt
 except ImportError as e:
     print(e)
     print('Unable to import oz.  Is oz installed or in your PYTHONPATH?')
@@ -380,3 +387,708 @@ def test_geteltorito_bogus_bootp(tmpdir):
 
     with py.test.raises(Exception):
         guest._geteltorito(src, dst)
+
+# test oz.Linux.LinuxCDGuest warm state
+class FakeWarmDomain(object):
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+    def save(self, memfile):
+        open(memfile, 'w').write('memory')
+
+class FakeWarmConnection(object):
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.running = True
+        self.restored = None
+        self.restored_uuids = []
+
+    def lookupByUUIDString(self, uuid):
+        if uuid in self.restored_uuids:
+            return FakeWarmDomain(uuid)
+        if not self.running or uuid != self.uuid:
+            raise libvirt.libvirtError("no domain")
+        return FakeWarmDomain(uuid)
+
+    def restore(self, memfile):
+        self.running = True
+
+    def saveImageGetXMLDesc(self, memfile, flags):
+        return """<domain><name>saved</name><uuid>%s</uuid><devices><interface type='bridge'><mac address='52:54:00:00:00:01'/></interface><disk><source file='/saved'/><driver type='raw'/></disk></devices></domain>""" % (self.uuid)
+
+    def restoreFlags(self, memfile, dxml, flags):
+        uuid = lxml.etree.fromstring(dxml).findtext('uuid')
+        # libvirt refuses to restore a domain that is already running
+        if uuid in self.restored_uuids or (self.running and uuid == self.uuid):
+            raise libvirt.libvirtError("domain is already active")
+        self.restored = dxml
+        self.restored_uuids.append(uuid)
+
+def warm_guest(tmpdir):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s" % route))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    guest.jeos_filename = os.path.join(str(tmpdir), 'jeos.dsk')
+    open(guest.jeos_filename, 'w').write('jeos')
+    guest.warm_state_dir = guest.jeos_filename + ".warm"
+    guest.diskimage = os.path.join(str(tmpdir), 'tester.dsk')
+    open(guest.diskimage, 'w').write('customized')
+    guest.sshprivkey = os.path.join(str(tmpdir), 'id_rsa-icicle-gen')
+    open(guest.sshprivkey, 'w').write('key')
+    guest.guest_sshkey = guest.sshprivkey
+    guest.libvirt_conn = FakeWarmConnection(str(guest.uuid))
+    return guest
+
+def test_warm_state_missing(tmpdir):
+    guest = warm_guest(tmpdir)
+    assert(guest._warm_state_usable() is None)
+
+def test_warm_state_corrupt(tmpdir):
+    guest = warm_guest(tmpdir)
+    os.mkdir(guest.warm_state_dir)
+    open(os.path.join(guest.warm_state_dir, 'state.json'), 'w').write('{"jeos": [')
+    assert(guest._warm_state_usable() is None)
+
+def test_warm_state_incomplete(tmpdir):
+    guest = warm_guest(tmpdir)
+    st = os.stat(guest.jeos_filename)
+    os.mkdir(guest.warm_state_dir)
+    open(os.path.join(guest.warm_state_dir, 'state.json'), 'w').write('{"jeos": [%d, %d]}' % (st.st_size, int(st.st_mtime)))
+    assert(guest._warm_state_usable() is None)
+
+def test_warm_save(tmpdir):
+    guest = warm_guest(tmpdir)
+    guest.sshd_was_active = True
+    dom = guest._warm_save(FakeWarmDomain(str(guest.uuid)), '192.168.122.10')
+    assert(dom.uuid == str(guest.uuid))
+
+    meta = guest._warm_state_usable()
+    st = os.stat(guest.jeos_filename)
+    assert(meta['jeos'] == [st.st_size, int(st.st_mtime)])
+    assert(meta['uuid'] == str(guest.uuid))
+    assert(meta['macaddr'] == guest.macaddr)
+    assert(meta['guestaddr'] == '192.168.122.10')
+    assert(meta['setup']['sshd_was_active'] == True)
+    assert(open(os.path.join(guest.warm_state_dir, 'disk.raw')).read() == 'customized')
+    keyfile = os.path.join(guest.warm_state_dir, 'sshkey')
+    assert(open(keyfile).read() == 'key')
+    assert(os.stat(keyfile).st_mode & 0o777 == 0o600)
+
+def test_warm_state_stale_size(tmpdir):
+    guest = warm_guest(tmpdir)
+    guest._warm_save(FakeWarmDomain(str(guest.uuid)), '192.168.122.10')
+    st = os.stat(guest.jeos_filename)
+    open(guest.jeos_filename, 'w').write('a new jeos')
+    os.utime(guest.jeos_filename, (st.st_atime, st.st_mtime))
+    assert(guest._warm_state_usable() is None)
+
+def test_warm_state_stale_mtime(tmpdir):
+    guest = warm_guest(tmpdir)
+    guest._warm_save(FakeWarmDomain(str(guest.uuid)), '192.168.122.10')
+    st = os.stat(guest.jeos_filename)
+    os.utime(guest.jeos_filename, (st.st_atime, st.st_mtime - 10))
+    assert(guest._warm_state_usable() is None)
+
+def test_warm_restore(tmpdir):
+    saver = warm_guest(tmpdir)
+    saver.sshd_was_active = False
+    saver._warm_save(FakeWarmDomain(str(saver.uuid)), '192.168.122.10')
+
+    # a later build of the same JEOS
+    guest = warm_guest(tmpdir)
+    guest.libvirt_conn = saver.libvirt_conn
+    guest.libvirt_conn.running = False
+    open(guest.diskimage, 'w').write('jeos')
+    meta = guest._warm_state_usable()
+    dom = guest._warm_restore('<domain/>', meta)
+
+    # the guest keeps its own identity
+    assert(dom.uuid == str(guest.uuid))
+    assert(guest.uuid != saver.uuid)
+    # but it was set up to announce itself as the saving guest
+    assert(guest.announce_token == str(saver.uuid))
+    doc = lxml.etree.fromstring(guest.libvirt_conn.restored)
+    assert(doc.findtext('name') == 'tester')
+    assert(doc.findtext('uuid') == str(guest.uuid))
+    assert(doc.xpath('/domain/devices/interface/mac')[0].get('address') == guest.macaddr)
+    assert(guest.sshd_was_active == False)
+    assert(open(guest.diskimage).read() == 'customized')
+    # the saved key is used in place, the shared key is left alone
+    assert(guest.guest_sshkey == os.path.join(guest.warm_state_dir, 'sshkey'))
+    assert(open(guest.sshprivkey).read() == 'key')
+
+def test_warm_restore_twice(tmpdir):
+    saver = warm_guest(tmpdir)
+    saver._warm_save(FakeWarmDomain(str(saver.uuid)), '192.168.122.10')
+
+    # the saving guest is still running while two more builds restore it
+    uuids = []
+    macs = []
+    for i in range(2):
+        guest = warm_guest(tmpdir)
+        guest.libvirt_conn = saver.libvirt_conn
+        dom = guest._warm_restore('<domain/>', guest._warm_state_usable())
+        doc = lxml.etree.fromstring(guest.libvirt_conn.restored)
+        uuids.append(dom.uuid)
+        macs.append(doc.xpath('/domain/devices/interface/mac')[0].get('address'))
+    assert(len(set(uuids + [str(saver.uuid)])) == 3)
+    assert(len(set(macs)) == 2)
+
+# test oz.Guest.Guest hang detection
+class FakeScreenWatch(object):
+    def __init__(self, static_for):
+        self.static_for = static_for
+
+    def screen_static_for(self):
+        return self.static_for
+
+def screen_guest(screen, console=""):
+    tdl = oz.TDL.TDL(tdlxml)
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[screen]\n%s\n[console]\n%s\n" % (route, screen, console)))
+
+    return oz.GuestFactory.guest_factory(tdl, config, None)
+
+def test_screen_interval_zero():
+    with py.test.raises(oz.OzException.OzException):
+        screen_guest("hang_window = 60\ninterval = 0")
+
+def test_screen_interval_too_long():
+    with py.test.raises(oz.OzException.OzException):
+        screen_guest("hang_window = 60\ninterval = 60")
+
+def test_screen_console_redirect():
+    with py.test.raises(oz.OzException.OzException):
+        screen_guest("hang_window = 60", "redirect = yes")
+
+def test_screen_disabled_console_redirect():
+    guest = screen_guest("hang_window = 0\ninterval = 0", "redirect = yes")
+    assert(not guest._install_hung(FakeScreenWatch(1000), [(0, 0, 0), (100, 0, 0)]))
+
+def test_install_hung():
+    guest = screen_guest("hang_window = 60")
+    # 10 disk requests and 100KB of network traffic a minute
+    activity = [(0, 0, 0), (60, 10, 100000)]
+    assert(guest._install_hung(FakeScreenWatch(60), activity))
+    # the screen changed recently
+    assert(not guest._install_hung(FakeScreenWatch(30), activity))
+    # not sampled for the whole window yet
+    assert(not guest._install_hung(FakeScreenWatch(60), [(0, 0, 0), (30, 0, 0)]))
+
+def test_install_busy_on_static_screen():
+    guest = screen_guest("hang_window = 60")
+    assert(not guest._install_hung(FakeScreenWatch(60), [(0, 0, 0), (60, 6000, 0)]))
+    assert(not guest._install_hung(FakeScreenWatch(60), [(0, 0, 0), (60, 0, 60 * 1024 * 1024)]))
+
+# test oz.Guest.Guest scratch disk images
+class FakeEmptyConnection(object):
+    def lookupByName(self, name):
+        raise libvirt.libvirtError("no domain")
+
+    def lookupByUUID(self, uuid):
+        raise libvirt.libvirtError("no domain")
+
+def scratch_guest(tmpdir, output_disk):
+    tdl = oz.TDL.TDL(tdlxml.replace("</os>", "</os><disk><size>1</size></disk>"))
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s\n[scratch]\ndir=%s\nbudget=1024\ninstall_disk=yes\n" % (route, os.path.join(str(tmpdir), 'scratch'))))
+
+    guest = oz.GuestFactory.guest_factory(tdl, config, None, output_disk)
+    guest.libvirt_conn = FakeEmptyConnection()
+    return guest
+
+def test_scratch_diskimage_unique(tmpdir):
+    one = scratch_guest(tmpdir, os.path.join(str(tmpdir), 'one', 'tester.dsk'))
+    two = scratch_guest(tmpdir, os.path.join(str(tmpdir), 'two', 'tester.dsk'))
+    assert(os.path.dirname(one.install_diskimage) == os.path.join(str(tmpdir), 'scratch'))
+    assert(one.install_diskimage != one.diskimage)
+    assert(one.install_diskimage != two.install_diskimage)
+
+def test_scratch_diskimage_conflict(tmpdir):
+    guest = scratch_guest(tmpdir, os.path.join(str(tmpdir), 'tester.dsk'))
+    guest.check_for_guest_conflict()
+    open(guest.install_diskimage, 'w').write('')
+    with py.test.raises(oz.OzException.OzException):
+        guest.check_for_guest_conflict()
+
+def test_scratch_diskimage_discarded_for_jeos(tmpdir):
+    guest = scratch_guest(tmpdir, os.path.join(str(tmpdir), 'tester.dsk'))
+    guest.jeos_filename = os.path.join(str(tmpdir), 'jeos.dsk')
+    open(guest.jeos_filename, 'w').write('jeos')
+    # generate_diskimage() ran before the JEOS showed up
+    open(guest.install_diskimage, 'w').write('')
+    guest._do_install()
+    assert(not os.path.exists(guest.install_diskimage))
+    assert(open(guest.diskimage).read() == 'jeos')
+
+# test oz.Linux.LinuxCDGuest preseed customization
+preseed_tdlxml = """
+<template>
+  <name>tester</name>
+  <os>
+    <name>%s</name>
+    <version>%s</version>
+    <arch>x86_64</arch>
+    <install type='iso'>
+      <iso>file:///tmp/install.iso</iso>
+    </install>
+  </os>
+  <repositories>
+    <repository name='extras'>
+      <url>deb http://example.org/debian stable main</url>
+    </repository>
+  </repositories>
+  <packages>
+    <package name='vim'/>
+    <package name='curl'/>
+  </packages>
+  <files>
+    <file name='/etc/motd'>
+hello there
+    </file>
+  </files>
+  <commands>
+    <command name='cmd1'>
+echo "hello" > /tmp/foo
+    </command>
+  </commands>
+</template>
+"""
+
+def preseed_guest(distro, version):
+    tdl = oz.TDL.TDL(preseed_tdlxml % (distro, version))
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s" % route))
+
+    return oz.GuestFactory.guest_factory(tdl, config, None)
+
+def preseed_settings(path):
+    # the logical lines of a preseed file, with the continuations joined
+    settings = []
+    current = ""
+    for line in open(path):
+        current += line
+        if not line.rstrip("\n").endswith("\\"):
+            settings.append(current)
+            current = ""
+    return settings
+
+def preseed_values(settings, owner_question):
+    values = []
+    for setting in settings:
+        fields = setting.split(None, 3)
+        if len(fields) >= 3 and fields[0] + " " + fields[1] == owner_question:
+            values.append(fields[3].replace("\\\n", " ").strip() if len(fields) > 3 else "")
+    return values
+
+def check_preseed_customization(guest, auto, tmpdir):
+    preseed = os.path.join(str(tmpdir), os.path.basename(auto))
+    shutil.copyfile(auto, preseed)
+    orig = preseed_settings(preseed)
+
+    script = guest._preseed_add_customization(preseed, "/cdrom/preseed")
+    settings = preseed_settings(preseed)
+
+    # nothing of the original file is lost
+    for setting in orig:
+        fields = setting.split(None, 2)
+        if len(fields) == 3 and fields[1] in ["pkgsel/include", "preseed/late_command"]:
+            continue
+        assert(setting in settings)
+
+    includes = preseed_values(settings, "d-i pkgsel/include")
+    assert(len(includes) == 1)
+    assert(includes[0].split().count("vim") == 1)
+    assert(includes[0].split().count("curl") == 1)
+    for value in preseed_values(orig, "d-i pkgsel/include"):
+        assert(includes[0].startswith(value))
+
+    lates = preseed_values(settings, "d-i preseed/late_command")
+    assert(len(lates) == 1)
+    assert("in-target sh /tmp/oz-customize.sh" in lates[0])
+    assert(oz.ozutil.INSTALL_SCRIPT_FAILED_MARKER in lates[0])
+    for value in preseed_values(orig, "d-i preseed/late_command"):
+        assert(lates[0].startswith(value.rstrip("; ")))
+    subprocess.check_call(["sh", "-n", "-c", lates[0]])
+
+    repos = [s for s in settings if re.match(r"^d-i\s+apt-setup/local\d+/repository", s)]
+    assert(len(repos) == 1)
+    assert(repos[0].split(None, 3)[3].strip() == "http://example.org/debian stable main")
+    assert(preseed_values(settings, "d-i debian-installer/allow_unauthenticated") == ["true"])
+
+    assert(script == os.path.join(str(tmpdir), "oz-customize.sh"))
+    subprocess.check_call(["sh", "-n", script])
+
+def preseed_autos(distro):
+    autodir = os.path.join(os.path.dirname(oz.GuestFactory.__file__), 'auto')
+    return sorted([os.path.join(autodir, name) for name in os.listdir(autodir)
+                   if name.startswith(distro) and name.endswith('.auto')])
+
+def test_preseed_customization_debian(tmpdir):
+    guest = preseed_guest("Debian", "7")
+    autos = preseed_autos("Debian")
+    assert(autos)
+    for auto in autos:
+        check_preseed_customization(guest, auto, tmpdir)
+
+def test_preseed_customization_ubuntu(tmpdir):
+    guest = preseed_guest("Ubuntu", "14.04")
+    autos = preseed_autos("Ubuntu")
+    assert(autos)
+    for auto in autos:
+        check_preseed_customization(guest, auto, tmpdir)
+
+def test_preseed_customization_local_repository_number(tmpdir):
+    guest = preseed_guest("Debian", "7")
+    preseed = os.path.join(str(tmpdir), 'preseed.cfg')
+    open(preseed, 'w').write("d-i apt-setup/local0/repository string http://example.com/debian stable main\n")
+    guest._preseed_add_customization(preseed, "/")
+    settings = preseed_settings(preseed)
+    assert("d-i apt-setup/local1/repository string http://example.org/debian stable main\n" in settings)
+    assert(preseed_values(settings, "d-i preseed/late_command")[0].startswith("cp /oz-customize.sh "))
+
+# test oz.RedHat.RedHatLinuxCDYumGuest kickstart customization
+def kickstart_guest():
+    tdl = oz.TDL.TDL((preseed_tdlxml % ("Fedora", "20")).replace("deb http://example.org/debian stable main", "http://example.org/fedora/20/"))
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s" % route))
+
+    return oz.GuestFactory.guest_factory(tdl, config, None)
+
+def kickstart_post(lines):
+    # the %post section added last
+    start = max([i for i, line in enumerate(lines) if line.startswith("%post")])
+    end = len(lines)
+    if lines[-1] == "%end\n":
+        end -= 1
+    return lines[start], "".join(lines[start + 1:end])
+
+def check_kickstart_customization(guest, auto, tmpdir):
+    ks = os.path.join(str(tmpdir), os.path.basename(auto))
+    shutil.copyfile(auto, ks)
+    orig = open(ks).readlines()
+    has_end = "%end\n" in orig
+
+    guest._kickstart_add_customization(ks)
+    lines = open(ks).readlines()
+
+    # the repo command comes before the first section
+    repo = lines.index('repo --name="extras" --baseurl="http://example.org/fedora/20/"\n')
+    assert(repo < min([i for i, line in enumerate(lines) if line.startswith("%")]))
+
+    # the packages go right after the (first) existing %packages
+    packages = [i for i, line in enumerate(lines) if line.startswith("%packages")]
+    assert(len(packages) == 1)
+    assert(lines[packages[0] + 1:packages[0] + 3] == ["vim\n", "curl\n"])
+    assert(lines.count("vim\n") == 1)
+
+    postline, body = kickstart_post(lines)
+    if has_end:
+        assert(postline == "%post --erroronfail\n")
+        assert(lines[-1] == "%end\n")
+    else:
+        assert(postline == "%post\n")
+        assert("%end\n" not in lines)
+    assert(oz.ozutil.INSTALL_SCRIPT_FAILED_MARKER in body)
+    assert("/etc/yum.repos.d/extras.repo" in body)
+    subprocess.check_call(["sh", "-n", "-c", body])
+
+def kickstart_autos():
+    autodir = os.path.join(os.path.dirname(oz.GuestFactory.__file__), 'auto')
+    return sorted([os.path.join(autodir, name) for name in os.listdir(autodir)
+                   if re.match(r"^(Fedora|RHEL)\d.*\.auto$", name)])
+
+def test_kickstart_customization_shipped(tmpdir):
+    guest = kickstart_guest()
+    autos = kickstart_autos()
+    assert(autos)
+    for auto in autos:
+        check_kickstart_customization(guest, auto, tmpdir)
+
+def test_kickstart_customization_no_packages(tmpdir):
+    guest = kickstart_guest()
+    ks = os.path.join(str(tmpdir), 'ks.cfg')
+    open(ks, 'w').write("install\nrootpw ozrootpw\n")
+    guest._kickstart_add_customization(ks)
+    lines = open(ks).readlines()
+    assert(lines[0] == 'repo --name="extras" --baseurl="http://example.org/fedora/20/"\n')
+    assert(lines[1:3] == ["install\n", "rootpw ozrootpw\n"])
+    packages = lines.index("%packages\n")
+    assert(lines[packages + 1:packages + 3] == ["vim\n", "curl\n"])
+    assert("%post\n" in lines)
+    assert("%end\n" not in lines)
+
+def test_kickstart_customization_no_packages_end(tmpdir):
+    guest = kickstart_guest()
+    ks = os.path.join(str(tmpdir), 'ks.cfg')
+    open(ks, 'w').write("install\n%pre\ntrue\n%end\n")
+    guest._kickstart_add_customization(ks)
+    lines = open(ks).readlines()
+    packages = lines.index("%packages\n")
+    assert(lines[packages + 1:packages + 4] == ["vim\n", "curl\n", "%end\n"])
+    assert("%post --erroronfail\n" in lines)
+    assert(lines[-1] == "%end\n")
+
+def test_kickstart_can_customize_in_install(tmpdir):
+    guest = kickstart_guest()
+    guest.auto = os.path.join(str(tmpdir), 'ks.cfg')
+    open(guest.auto, 'w').write("install\n%packages\n@core\n%end\n")
+    assert(guest._can_customize_in_install())
+    # older anaconda: no %end, and so no %post --erroronfail
+    open(guest.auto, 'w').write("install\n%packages\n@core\n")
+    assert(not guest._can_customize_in_install())
+
+def test_kickstart_customization_in_yum_guests_only(tmpdir):
+    assert(not hasattr(oz.RedHat.RedHatLinuxCDGuest, '_kickstart_add_customization'))
+    assert(hasattr(oz.RedHat.RedHatLinuxCDYumGuest, '_kickstart_add_customization'))
+
+# test oz.Guest.Guest install URL checking
+def test_check_url_disabled():
+    tdl = oz.TDL.TDL(tdlxml.replace("http://download.fedoraproject.org", "http://localhost"))
+
+    config = configparser.SafeConfigParser()
+    config.readfp(BytesIO("[libvirt]\nuri=qemu:///session\nbridge_name=%s" % route))
+    with py.test.raises(oz.OzException.OzException):
+        oz.GuestFactory.guest_factory(tdl, config, None)
+
+    config.readfp(BytesIO("[install]\ncheck_url=no\n"))
+    guest = oz.GuestFactory.guest_factory(tdl, config, None)
+    assert(guest.url == tdl.url)
+
+# test oz.Guest.Guest._guestfs_handle_setup
+class FakeInspectHandle(object):
+    def inspect_os(self):
+        return []
+
+class FakeGuestfsManager(object):
+    def __init__(self):
+        self.handle = FakeInspectHandle()
+        self.released = []
+
+    def open(self, drives, description):
+        return self.handle, ['/dev/sda']
+
+    def release(self, g_handle):
+        self.released.append(g_handle)
+
+def test_guestfs_handle_setup_releases_on_error(tmpdir):
+    guest = scratch_guest(tmpdir, os.path.join(str(tmpdir), 'tester.dsk'))
+    guest.guestfs_manager = FakeGuestfsManager()
+    guest._running_domain_disks = lambda: ([], [])
+    libvirt_xml = "<domain><name>other</name><devices><disk><source file='%s'/></disk></devices></domain>" % (guest.diskimage)
+
+    with py.test.raises(oz.OzException.OzException):
+        guest._guestfs_handle_setup(libvirt_xml)
+    assert(guest.guestfs_manager.released == [guest.guestfs_manager.handle])
+
+# test oz.Guest.Guest.generate_overlay
+overlay_xml = """<domain type='kvm'>
+  <name>base</name>
+  <uuid>11111111-2222-3333-4444-555555555555</uuid>
+  <devices>
+    <interface type='bridge'>
+      <mac address='52:54:00:00:00:01'/>
+    </interface>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='raw'/>
+      <source file='%s'/>
+    </disk>
+  </devices>
+</domain>
+"""
+
+def overlay_guest(tmpdir):
+    guest = scratch_guest(tmpdir, os.path.join(str(tmpdir), 'overlay.qcow2'))
+    guest.generated = []
+    def _generate(**kwargs):
+        guest.generated.append(kwargs)
+    guest._internal_generate_diskimage = _generate
+    return guest
+
+def test_generate_overlay(tmpdir):
+    guest = overlay_guest(tmpdir)
+    base = os.path.join(str(tmpdir), 'base.dsk')
+
+    doc = lxml.etree.fromstring(guest.generate_overlay(overlay_xml % (base)))
+    assert(guest.generated == [{'force': True, 'image_filename': guest.diskimage,
+                                'backing_filename': base}])
+    assert(doc.xpath('/domain/name')[0].text == guest.tdl.name)
+    assert(doc.xpath('/domain/uuid')[0].text == str(guest.uuid))
+    assert(doc.xpath('/domain/devices/interface/mac')[0].get('address') == guest.macaddr)
+    assert(doc.xpath('/domain/devices/disk/source')[0].get('file') == guest.diskimage)
+    assert(doc.xpath('/domain/devices/disk/driver')[0].get('type') == 'qcow2')
+
+def test_generate_overlay_on_itself(tmpdir):
+    guest = overlay_guest(tmpdir)
+    with py.test.raises(oz.OzException.OzException):
+        guest.generate_overlay(overlay_xml % (guest.diskimage))
+    assert(guest.generated == [])
+
+def test_generate_overlay_no_disk(tmpdir):
+    guest = overlay_guest(tmpdir)
+    with py.test.raises(oz.OzException.OzException):
+        guest.generate_overlay("<domain><name>base</name><devices/></domain>")
+
+# test oz.Guest.Guest._internal_generate_diskimage from many threads
+class FakeLibvirtCodeError(libvirt.libvirtError):
+    def __init__(self, code):
+        libvirt.libvirtError.__init__(self, "fake error %d" % (code))
+        self.code = code
+
+    def get_error_code(self):
+        return self.code
+
+class FakeStoragePool(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def refresh(self, flags):
+        assert(self.conn.active == 1)
+
+    def storageVolLookupByName(self, name):
+        raise FakeLibvirtCodeError(libvirt.VIR_ERR_NO_STORAGE_VOL)
+
+    def createXML(self, xml, flags):
+        import time
+        time.sleep(0.02)
+        assert(self.conn.active == 1)
+        self.conn.volumes.append(lxml.etree.fromstring(xml).findtext('name'))
+
+    def destroy(self):
+        self.conn.active -= 1
+
+class FakePoolConnection(FakeEmptyConnection):
+    def __init__(self):
+        self.active = 0
+        self.volumes = []
+
+    def listDefinedStoragePools(self):
+        return []
+
+    def listStoragePools(self):
+        return []
+
+    def storagePoolCreateXML(self, xml, flags):
+        self.active += 1
+        return FakeStoragePool(self)
+
+def test_generate_diskimage_threads(tmpdir):
+    import threading
+    conn = FakePoolConnection()
+    guests = []
+    for i in range(4):
+        guest = scratch_guest(tmpdir, os.path.join(str(tmpdir), 'tester%d.dsk' % (i)))
+        guest.libvirt_conn = conn
+        guests.append(guest)
+
+    errors = []
+    def _generate(guest):
+        try:
+            guest._internal_generate_diskimage(force=True, image_filename=guest.diskimage)
+        except Exception as err:
+            errors.append(err)
+    threads = [threading.Thread(target=_generate, args=(g,)) for g in guests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert(errors == [])
+    assert(sorted(conn.volumes) == ['tester%d.dsk' % (i) for i in range(4)])
+    assert(conn.active == 0)
+
+# test oz.Guest.Guest listen ports
+def test_listen_ports_distinct(tmpdir, monkeypatch):
+    monkeypatch.setattr(oz.Guest, '_listen_ports', set())
+    ports = iter([2000, 2000, 2000, 2001])
+    monkeypatch.setattr(oz.Guest.random, 'randrange', lambda start, stop: next(ports))
+    one = scratch_guest(tmpdir, os.path.join(str(tmpdir), 'one.dsk'))
+    two = scratch_guest(tmpdir, os.path.join(str(tmpdir), 'two.dsk'))
+    assert(one.listen_port == 2000)
+    assert(two.listen_port == 2001)
+
+# test oz.Linux.LinuxCDGuest._layered_customize
+class FakeLayerDomain(object):
+    def __init__(self, calls, agent):
+        self.calls = calls
+        self.agent = agent
+
+    def snapshotCreateXML(self, xml, flags):
+        assert(flags & libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE)
+        if not self.agent:
+            raise libvirt.libvirtError("QEMU guest agent is not configured")
+        self.calls.append(('snapshot',))
+
+def layer_guest(tmpdir, monkeypatch, agent=False):
+    guest = warm_guest(tmpdir)
+    guest.layer_cache_dir = os.path.join(str(tmpdir), 'layers')
+    calls = []
+    guest.layer_calls = calls
+
+    def _generate(force, image_filename, backing_filename):
+        open(image_filename, 'w').write(backing_filename)
+    def _boot(xml, top):
+        calls.append(('boot',))
+        return FakeLayerDomain(calls, agent), '192.168.122.10'
+    def _step(name):
+        return lambda guestaddr: calls.append((name,))
+    def _convert(cmd, printfn=None):
+        open(cmd[-1], 'w').write('flattened')
+
+    guest._internal_generate_diskimage = _generate
+    guest._layer_boot = _boot
+    guest._customize_steps = lambda: [('command', 'cmd1', _step('cmd1')),
+                                      ('command', 'cmd2', _step('cmd2'))]
+    guest._finish_customize = _step('finish')
+    guest._collect_setup = lambda xml: calls.append(('setup',))
+    guest._collect_teardown = lambda xml: calls.append(('teardown',))
+    guest.guest_execute_command = lambda guestaddr, command, timeout=10: None
+    guest._shutdown_guest = lambda guestaddr, dom: calls.append(('shutdown',))
+    monkeypatch.setattr(oz.ozutil, 'subprocess_check_output', _convert)
+    return guest
+
+layer_xml = """<domain><name>tester</name><devices><disk><source file='/tmp/tester.dsk'/><driver type='raw'/><target dev='vda'/></disk></devices></domain>"""
+
+def test_layered_customize_shutdown_per_layer(tmpdir, monkeypatch):
+    guest = layer_guest(tmpdir, monkeypatch)
+    own_uuid = guest.uuid
+    guest._layered_customize(layer_xml, "mod_only")
+
+    # without a guest agent, every layer is taken from a guest that is shut down
+    assert(guest.layer_calls == [('setup',), ('boot',),
+                                 ('cmd1',), ('shutdown',), ('boot',),
+                                 ('cmd2',), ('shutdown',), ('boot',),
+                                 ('finish',), ('shutdown',),
+                                 ('teardown',)])
+    assert(guest.layer_quiesce is False)
+    assert(guest.uuid == own_uuid)
+    assert(open(guest.diskimage).read() == 'flattened')
+    assert(len([name for name in os.listdir(guest.layer_cache_dir) if name.endswith('.json')]) == 4)
+
+def test_layered_customize_quiesced(tmpdir, monkeypatch):
+    guest = layer_guest(tmpdir, monkeypatch, agent=True)
+    guest._layered_customize(layer_xml, "mod_only")
+    assert(guest.layer_calls == [('setup',), ('boot',),
+                                 ('cmd1',), ('snapshot',),
+                                 ('cmd2',), ('snapshot',),
+                                 ('finish',), ('snapshot',),
+                                 ('shutdown',), ('teardown',)])
+
+def test_layered_customize_all_cached(tmpdir, monkeypatch):
+    first = layer_guest(tmpdir, monkeypatch)
+    first._layered_customize(layer_xml, "mod_only")
+
+    guest = layer_guest(tmpdir, monkeypatch)
+    guest._layered_customize(layer_xml, "mod_only")
+    # nothing left to do in the guest, so it is not booted
+    assert(guest.layer_calls == [('teardown',)])
+    assert(guest.uuid != first.uuid)
+    assert(guest.announce_token == str(first.uuid))
+    assert(open(guest.diskimage).read() == 'flattened')
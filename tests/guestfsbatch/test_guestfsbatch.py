@@ -0,0 +1,223 @@
+#!/usr/bin/python
+
+import sys
+import os
+import re
+import shlex
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.GuestfsBatch
+except ImportError:
+    print('Unable to import oz.  Is oz installed?')
+    sys.exit(1)
+
+class FakeHandle(object):
+    """
+    Stand-in for a libguestfs handle that records the calls made on it.
+    """
+    def __init__(self, existing=()):
+        self.existing = set(existing)
+        self.calls = []
+        self.exists_calls = 0
+
+    def exists(self, path):
+        self.exists_calls += 1
+        return path in self.existing
+
+    def sh(self, script):
+        self.calls.append(('sh', script))
+        # answer the existence checks of the batch, if this is one
+        output = ""
+        for line in script.splitlines():
+            match = re.match(r"^\[ -e (.*) \] \|\| echo (\d+)$", line)
+            if match and shlex.split(match.group(1))[0] not in self.existing:
+                output += match.group(2) + "\n"
+        return output
+
+    def __getattr__(self, name):
+        def _call(*args):
+            self.calls.append((name,) + args)
+        return _call
+
+def setup_batch(g_handle, use_shell=True):
+    batch = oz.GuestfsBatch.GuestfsBatch(g_handle, use_shell)
+    batch.move_if_exists('/root/.ssh', '/root/.ssh.ozbackup')
+    batch.mkdir('/root/.ssh')
+    batch.write('/root/.ssh/authorized_keys', 'key\n')
+    batch.write('/root/reportip', 'script\n')
+    batch.chmod(0o755, '/root/reportip')
+    batch.ln_sf('/etc/init.d/sshd', '/etc/rc.d/rc3.d/S55sshd')
+    return batch
+
+# test oz.GuestfsBatch.GuestfsBatch.plan
+def test_plan_one_script_one_tar():
+    steps = setup_batch(FakeHandle()).plan()
+    assert([kind for kind, data in steps] == ['sh', 'tar'])
+    script = steps[0][1].splitlines()
+    assert(script[0] == 'set -e')
+    assert(script[1] == 'if [ -e /root/.ssh ]; then mv /root/.ssh /root/.ssh.ozbackup; fi')
+    assert(script[2] == 'mkdir /root/.ssh')
+    assert(script[3] == 'ln -sf /etc/init.d/sshd /etc/rc.d/rc3.d/S55sshd')
+    files = steps[1][1]
+    assert(list(files.keys()) == ['/root/.ssh/authorized_keys', '/root/reportip'])
+    assert(files['/root/reportip'] == ['script\n', 0o755])
+    assert(files['/root/.ssh/authorized_keys'][1] == 0o644)
+
+def test_plan_keeps_order_for_written_files():
+    batch = oz.GuestfsBatch.GuestfsBatch(FakeHandle())
+    batch.write('/etc/foo/bar', 'bar\n')
+    batch.move_if_exists('/etc/foo', '/etc/foo.ozbackup')
+    steps = batch.plan()
+    assert([kind for kind, data in steps] == ['tar', 'sh'])
+
+def test_plan_quotes_paths():
+    batch = oz.GuestfsBatch.GuestfsBatch(FakeHandle())
+    batch.remove_if_exists("/tmp/it's here")
+    steps = batch.plan()
+    assert(steps[0][1].splitlines()[1] == "if [ -e '/tmp/it'\"'\"'s here' ]; then rm -rf '/tmp/it'\"'\"'s here'; fi")
+
+def test_plan_empty():
+    assert(oz.GuestfsBatch.GuestfsBatch(FakeHandle()).plan() == [])
+
+# test oz.GuestfsBatch.GuestfsBatch.apply
+def test_apply_without_shell():
+    g_handle = FakeHandle(existing=['/root/.ssh'])
+    batch = setup_batch(g_handle, use_shell=False)
+    batch.remove_if_exists('/root/reportip-boot')
+    batch.apply()
+    assert(g_handle.calls == [('mv', '/root/.ssh', '/root/.ssh.ozbackup'),
+                              ('mkdir', '/root/.ssh'),
+                              ('write', '/root/.ssh/authorized_keys', 'key\n'),
+                              ('write', '/root/reportip', 'script\n'),
+                              ('chmod', 0o755, '/root/reportip'),
+                              ('ln_sf', '/etc/init.d/sshd', '/etc/rc.d/rc3.d/S55sshd')])
+    assert(batch.ops == [])
+
+def test_apply_with_shell():
+    g_handle = FakeHandle()
+    batch = setup_batch(g_handle)
+    batch.apply()
+    # one check of the paths the batch creates, then the changes
+    assert([call[0] for call in g_handle.calls] == ['sh', 'sh', 'tar_in'])
+    assert(g_handle.calls[2][2] == '/')
+    assert(batch.ops == [])
+
+def test_apply_checks_created_at_once():
+    g_handle = FakeHandle(existing=['/etc/file1'])
+    batch = oz.GuestfsBatch.GuestfsBatch(g_handle)
+    for i in range(50):
+        batch.write('/etc/file%d' % (i), 'content\n')
+    batch.write('/etc/file2', 'again\n')
+    assert(g_handle.calls == [])
+    batch.apply()
+    assert(g_handle.exists_calls == 0)
+    assert([call[0] for call in g_handle.calls] == ['sh', 'tar_in'])
+    assert(len(g_handle.calls[0][1].splitlines()) == 50)
+    assert(batch.created == set(['/etc/file%d' % (i) for i in range(50) if i != 1]))
+
+def test_reads_go_to_handle():
+    g_handle = FakeHandle(existing=['/usr/sbin/sshd'])
+    batch = oz.GuestfsBatch.GuestfsBatch(g_handle)
+    assert(batch.exists('/usr/sbin/sshd'))
+    batch.glob_expand('/var/lib/dhcp/*.leases')
+    assert(g_handle.calls == [('glob_expand', '/var/lib/dhcp/*.leases')])
+
+class FakeFilesystem(object):
+    """
+    Stand-in for a libguestfs handle with a tiny in-memory filesystem, whose
+    ln_sf fails when the directory of the link does not exist.
+    """
+    def __init__(self, files):
+        self.files = dict(files)
+
+    def exists(self, path):
+        return path in self.files
+
+    def write(self, path, content):
+        self.files[path] = content
+
+    def mv(self, src, dest):
+        self.files[dest] = self.files.pop(src)
+
+    def rm_rf(self, path):
+        self.files.pop(path, None)
+
+    def rm_f(self, path):
+        self.files.pop(path, None)
+
+    def ln_sf(self, target, linkname):
+        if linkname.rsplit('/', 1)[0] not in self.files:
+            raise RuntimeError("No such file or directory")
+        self.files[linkname] = '-> ' + target
+
+def undo_restore(undo, orig):
+    # what oz.Guest.Guest._guestfs_path_restore records on an undo batch
+    undo.remove_if_exists(orig)
+    undo.restore_backup(orig + '.ozbackup', orig)
+
+# test oz.GuestfsBatch.GuestfsBatch.undo_batch
+def test_undo_partially_applied():
+    g_handle = FakeFilesystem({'/etc/ssh/sshd_config': 'original'})
+    batch = oz.GuestfsBatch.GuestfsBatch(g_handle, use_shell=False)
+    batch.ln_sf('/lib/systemd/system/sshd.service',
+                '/etc/systemd/system/multi-user.target.wants/sshd.service')
+    batch.move_if_exists('/etc/ssh/sshd_config', '/etc/ssh/sshd_config.ozbackup')
+    batch.write('/etc/ssh/sshd_config', 'oz')
+    batch.write('/root/reportip', 'script')
+    with py.test.raises(RuntimeError):
+        batch.apply()
+
+    undo = batch.undo_batch()
+    undo_restore(undo, '/etc/ssh/sshd_config')
+    undo.rm('/etc/systemd/system/multi-user.target.wants/sshd.service')
+    undo.remove_if_exists('/root/reportip')
+    undo.apply()
+    assert(g_handle.files == {'/etc/ssh/sshd_config': 'original'})
+
+def test_undo_fully_applied():
+    g_handle = FakeFilesystem({'/etc/ssh/sshd_config': 'original',
+                               '/etc/cron.d': ''})
+    batch = oz.GuestfsBatch.GuestfsBatch(g_handle, use_shell=False)
+    batch.move_if_exists('/etc/ssh/sshd_config', '/etc/ssh/sshd_config.ozbackup')
+    batch.write('/etc/ssh/sshd_config', 'oz')
+    batch.write('/etc/cron.d/announce', 'cron')
+    batch.apply()
+
+    undo = batch.undo_batch()
+    undo_restore(undo, '/etc/ssh/sshd_config')
+    undo.remove_if_exists('/etc/cron.d/announce')
+    undo.apply()
+    assert(g_handle.files == {'/etc/ssh/sshd_config': 'original',
+                              '/etc/cron.d': ''})
+
+def test_undo_plan_leaves_unknown_files():
+    batch = oz.GuestfsBatch.GuestfsBatch(FakeHandle(existing=['/etc/selinux/config']))
+    batch.move_if_exists('/etc/selinux/config', '/etc/selinux/config.ozbackup')
+    batch.write('/etc/selinux/config', 'SELINUX=permissive\n')
+    batch.write('/root/reportip', 'script\n')
+
+    undo = batch.undo_batch()
+    assert(undo.created == set(['/root/reportip']))
+    undo_restore(undo, '/etc/selinux/config')
+    undo_restore(undo, '/root/reportip')
+    undo.rm('/etc/cron.d/announce')
+    script = undo.plan()[0][1].splitlines()
+    assert(script[1:] == ['if [ -e /etc/selinux/config.ozbackup ]; then rm -rf /etc/selinux/config; mv /etc/selinux/config.ozbackup /etc/selinux/config; fi',
+                          'if [ -e /root/reportip ]; then rm -rf /root/reportip; fi',
+                          'if [ -e /root/reportip.ozbackup ]; then rm -rf /root/reportip; mv /root/reportip.ozbackup /root/reportip; fi',
+                          'rm -f /etc/cron.d/announce'])
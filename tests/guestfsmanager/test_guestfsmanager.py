@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+import sys
+import os
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.GuestfsManager
+except ImportError:
+    print('Unable to import oz.  Is oz installed?')
+    sys.exit(1)
+
+class FakeHandle(object):
+    """
+    Stand-in for a guestfs.GuestFS handle, with a backend that may or may
+    not be able to hot-plug drives.
+    """
+    def __init__(self, hotplug):
+        self.hotplug = hotplug
+        self.launched = False
+        self.closed = False
+        self.drives = []
+        self.calls = []
+        self.vg_error = False
+
+    def get_backend(self):
+        return 'libvirt'
+
+    def launch(self):
+        self.launched = True
+
+    def add_drive_opts(self, path, format=None, readonly=0, label=None):
+        if not os.path.exists(path):
+            raise RuntimeError("%s: No such file or directory" % (path))
+        if self.launched and not self.hotplug:
+            raise RuntimeError("hot-plugging drives is not supported")
+        self.drives.append(label)
+
+    def list_disk_labels(self):
+        return dict([(label, '/dev/sd%s' % (chr(ord('a') + i))) for i, label in enumerate(self.drives)])
+
+    def list_devices(self):
+        return ['/dev/sd%s' % (chr(ord('a') + i)) for i in range(len(self.drives))]
+
+    def remove_drive(self, label):
+        self.calls.append(('remove_drive', label))
+        self.drives.remove(label)
+
+    def umount_all(self):
+        self.calls.append(('umount_all',))
+
+    def vg_activate_all(self, activate):
+        self.calls.append(('vg_activate_all', activate))
+        if self.vg_error:
+            raise RuntimeError("vgchange failed")
+
+    def close(self):
+        self.closed = True
+
+def fake_manager(hotplug):
+    manager = oz.GuestfsManager.GuestfsManager(None, True)
+    manager.handles = []
+    def _new_handle():
+        g_handle = FakeHandle(hotplug)
+        manager.handles.append(g_handle)
+        return g_handle
+    manager._new_handle = _new_handle
+    return manager
+
+# test oz.GuestfsManager.GuestfsManager.open
+def test_open_warm(tmpdir):
+    disk = str(tmpdir.join('disk.raw'))
+    open(disk, 'w').close()
+    manager = fake_manager(True)
+
+    g_handle, devices = manager.open([(disk, 'raw', True)], 'disk')
+    assert(devices == ['/dev/sda'])
+    manager.release(g_handle)
+    again, devices = manager.open([(disk, 'raw', True)], 'disk')
+    assert(again is g_handle)
+    assert(manager.hotplug)
+    assert(len(manager.handles) == 1)
+
+def test_open_missing_drive_keeps_hotplug(tmpdir):
+    disk = str(tmpdir.join('disk.raw'))
+    open(disk, 'w').close()
+    manager = fake_manager(True)
+    g_handle, devices = manager.open([(disk, 'raw', True)], 'disk')
+    manager.release(g_handle)
+
+    # the caller's mistake comes back to the caller...
+    with py.test.raises(RuntimeError):
+        manager.open([(str(tmpdir.join('missing.raw')), 'raw', True)], 'missing')
+    # ...and does not cost the warm appliance
+    assert(manager.hotplug)
+    assert(not g_handle.closed)
+    again, devices = manager.open([(disk, 'raw', True)], 'disk')
+    assert(again is g_handle)
+
+def test_open_no_hotplug(tmpdir):
+    disk = str(tmpdir.join('disk.raw'))
+    open(disk, 'w').close()
+    manager = fake_manager(False)
+
+    g_handle, devices = manager.open([(disk, 'raw', True)], 'disk')
+    assert(devices == ['/dev/sda'])
+    assert(manager.hotplug is False)
+    # the appliance that could not take the drive is gone
+    assert(manager.handles[0].closed)
+    assert(g_handle is manager.handles[1])
+    manager.release(g_handle)
+    assert(g_handle.closed)
+
+# test oz.GuestfsManager.GuestfsManager.release
+def test_release_deactivates_volume_groups(tmpdir):
+    disk = str(tmpdir.join('disk.raw'))
+    open(disk, 'w').close()
+    manager = fake_manager(True)
+
+    g_handle, devices = manager.open([(disk, 'raw', True)], 'disk')
+    label = g_handle.drives[0]
+    manager.release(g_handle)
+    assert(g_handle.calls == [('umount_all',), ('vg_activate_all', False),
+                              ('remove_drive', label)])
+    assert(not g_handle.closed)
+    assert(manager._idle == [g_handle])
+
+def test_release_vg_deactivate_fails(tmpdir):
+    disk = str(tmpdir.join('disk.raw'))
+    open(disk, 'w').close()
+    manager = fake_manager(True)
+
+    g_handle, devices = manager.open([(disk, 'raw', True)], 'disk')
+    g_handle.vg_error = True
+    manager.release(g_handle)
+    assert(('remove_drive', g_handle.drives[0]) not in g_handle.calls)
+    assert(g_handle.closed)
+    assert(manager._idle == [])
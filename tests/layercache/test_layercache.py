@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+import sys
+import os
+
+try:
+    import py.test
+except ImportError:
+    print('Unable to import py.test.  Is py.test installed?')
+    sys.exit(1)
+
+# Find oz
+prefix = '.'
+for i in range(0,3):
+    if os.path.isdir(os.path.join(prefix, 'oz')):
+        sys.path.insert(0, prefix)
+        break
+    else:
+        prefix = '../' + prefix
+
+try:
+    import oz.LayerCache
+except ImportError:
+    print('Unable to import oz.  Is oz installed?')
+    sys.exit(1)
+
+def publish_layer(cache, key):
+    filename = cache.new_file(key)
+    open(filename, 'w').close()
+    return cache.publish(key, {'file': filename})
+
+# test oz.LayerCache.LayerCache.chain
+def test_chain_prefix():
+    cache = oz.LayerCache.LayerCache('/nonexistent')
+    short = cache.chain('base', ['setup', 'file a'])
+    full = cache.chain('base', ['setup', 'file a', 'command b'])
+    assert(len(full) == 3)
+    assert(full[:2] == short)
+    assert(len(set(full)) == 3)
+
+def test_chain_depends_on_everything_before():
+    cache = oz.LayerCache.LayerCache('/nonexistent')
+    assert(cache.chain('base', ['a', 'b'])[1] != cache.chain('other', ['a', 'b'])[1])
+    assert(cache.chain('base', ['a', 'b'])[1] != cache.chain('base', ['c', 'b'])[1])
+    assert(cache.chain('base', ['a', 'b'])[1] != cache.chain('base', ['b', 'a'])[1])
+
+# test oz.LayerCache.LayerCache.deepest
+def test_deepest(tmpdir):
+    cache = oz.LayerCache.LayerCache(str(tmpdir))
+    hashes = cache.chain('base', ['setup', 'a', 'b'])
+    assert(cache.deepest(hashes) == 0)
+    assert(publish_layer(cache, hashes[0]))
+    assert(publish_layer(cache, hashes[2]))
+    assert(cache.deepest(hashes) == 1)
+    assert(publish_layer(cache, hashes[1]))
+    assert(cache.deepest(hashes) == 3)
+
+def test_deepest_missing_file(tmpdir):
+    cache = oz.LayerCache.LayerCache(str(tmpdir))
+    hashes = cache.chain('base', ['setup'])
+    assert(publish_layer(cache, hashes[0]))
+    os.unlink(cache.load(hashes[0])['file'])
+    assert(cache.load(hashes[0]) is None)
+    assert(cache.deepest(hashes) == 0)
+
+# test oz.LayerCache.LayerCache.publish
+def test_publish_once(tmpdir):
+    cache = oz.LayerCache.LayerCache(str(tmpdir))
+    key = cache.chain('base', ['setup'])[0]
+    assert(publish_layer(cache, key))
+    first = cache.load(key)['file']
+    assert(not publish_layer(cache, key))
+    assert(cache.load(key)['file'] == first)
+
+# test oz.LayerCache.LayerCache.new_file
+def test_new_file_unique(tmpdir):
+    cache = oz.LayerCache.LayerCache(str(tmpdir.join('layers')))
+    first = cache.new_file('abc')
+    assert(os.path.isdir(str(tmpdir.join('layers'))))
+    assert(os.path.basename(first).startswith('abc-'))
+    assert(first.endswith('.qcow2'))
+    assert(first != cache.new_file('abc'))
+
+# test oz.LayerCache.file_digest
+def test_file_digest(tmpdir):
+    path = tmpdir.join('content')
+    path.write('hello\n')
+    assert(oz.LayerCache.file_digest(str(path)) == '5891b5b522d5df086d0ff0b110fbd9d21bb4fc7163af34d08286a2e846f6be03')
@@ -2,6 +2,7 @@
 
 import sys
 import os
+import tarfile
 
 try:
     import py.test
@@ -55,6 +56,30 @@ def test_exe_exists_none():
     with py.test.raises(Exception):
         oz.ozutil.executable_exists(None)
 
+# test oz.ozutil.subprocess_check_output
+def test_subprocess_output():
+    stdout, stderr, retcode = oz.ozutil.subprocess_check_output(['sh', '-c', 'echo out; echo err >&2'])
+    assert(stdout == 'out\n')
+    assert(stderr == 'err\n')
+    assert(retcode == 0)
+
+def test_subprocess_fail():
+    with py.test.raises(oz.ozutil.SubprocessException):
+        oz.ozutil.subprocess_check_output(['false'])
+
+def test_subprocess_max_output():
+    printed = []
+    stdout, stderr, retcode = oz.ozutil.subprocess_check_output(['sh', '-c', 'seq 1 10000'],
+                                                                printfn=printed.append,
+                                                                max_output=10)
+    assert(stdout == '\n9999\n10000\n'[-10:])
+    assert(len(''.join(printed)) == 48894)
+
+def test_subprocess_background_child():
+    # the background sleep keeps the pipes open after the shell exits
+    stdout, stderr, retcode = oz.ozutil.subprocess_check_output(['sh', '-c', 'echo out; sleep 3 &'])
+    assert(stdout == 'out\n')
+
 # test oz.ozutil.copyfile_sparse
 def test_copy_sparse_none_src():
     with py.test.raises(Exception):
@@ -148,6 +173,44 @@ def test_copy_sparse_zero_blocks(tmpdir):
     dstname = os.path.join(str(tmpdir), 'dst')
     oz.ozutil.copyfile_sparse(srcname, dstname)
 
+def _write_sparse_src(srcname):
+    infd = open('/dev/urandom', 'r')
+    data1 = infd.read(32*1024)
+    data2 = infd.read(32*1024 + 100)
+    infd.close()
+
+    outfd = open(srcname, 'w')
+    outfd.write(data1)
+    outfd.write('\0'*32*1024*3)
+    outfd.write(data2)
+    outfd.close()
+
+    return data1 + '\0'*32*1024*3 + data2
+
+def test_copy_sparse_big_buffer_drop_cache(tmpdir):
+    srcname = os.path.join(str(tmpdir), 'src')
+    data = _write_sparse_src(srcname)
+    dstname = os.path.join(str(tmpdir), 'dst')
+    oz.ozutil.copyfile_sparse(srcname, dstname, 1024*1024, True)
+
+    assert open(dstname, 'r').read() == data
+
+def test_copy_sparse_small_buffer_drop_cache(tmpdir):
+    srcname = os.path.join(str(tmpdir), 'src')
+    data = _write_sparse_src(srcname)
+    dstname = os.path.join(str(tmpdir), 'dst')
+    oz.ozutil.copyfile_sparse(srcname, dstname, 4096, True)
+
+    assert open(dstname, 'r').read() == data
+
+def test_copy_sparse_direct(tmpdir):
+    srcname = os.path.join(str(tmpdir), 'src')
+    data = _write_sparse_src(srcname)
+    dstname = os.path.join(str(tmpdir), 'dst')
+    oz.ozutil.copyfile_sparse(srcname, dstname, 1024*1024, False, True)
+
+    assert open(dstname, 'r').read() == data
+
 def test_copy_sparse_src_not_exists(tmpdir):
     srcname = os.path.join(str(tmpdir), 'src')
     dstname = os.path.join(str(tmpdir), 'dst')
@@ -345,6 +408,30 @@ def test_write_cpio_exception(tmpdir):
     with py.test.raises(IOError):
         oz.ozutil.write_cpio({src: 'src'}, dst)
 
+# test oz.ozutil.write_tar
+def test_write_tar_none_input():
+    with py.test.raises(Exception):
+        oz.ozutil.write_tar(None, None)
+
+def test_write_tar_none_output():
+    with py.test.raises(Exception):
+        oz.ozutil.write_tar({}, None)
+
+def test_write_tar_multiple_files(tmpdir):
+    src1 = os.path.join(str(tmpdir), 'src1')
+    open(src1, 'w').write('src1')
+    os.chmod(src1, 0o600)
+    src2 = os.path.join(str(tmpdir), 'src2')
+    open(src2, 'w').write('src2')
+    dst = os.path.join(str(tmpdir), 'dst')
+    oz.ozutil.write_tar({src1: '/etc/src1', src2: '/root/dir/src2'}, dst)
+    tar = tarfile.open(dst)
+    info = tar.getmember('etc/src1')
+    assert(info.mode == 0o600)
+    assert(info.uid == 0)
+    assert(tar.extractfile('root/dir/src2').read() == 'src2')
+    tar.close()
+
 def test_md5sum_regular(tmpdir):
     src = os.path.join(str(tmpdir), 'md5sum')
     f = open(src, 'w')
@@ -446,3 +533,148 @@ def test_md5sum_regular_no_space(tmpdir):
     f.close()
 
     oz.ozutil.get_md5sum_from_file(src, 'Fedora-11-i386-DVD.iso')
+
+# test oz.ozutil.get_memory_available
+def test_memory_available(tmpdir):
+    meminfo = os.path.join(str(tmpdir), 'meminfo')
+    f = open(meminfo, 'w')
+    f.write('MemTotal:        8000000 kB\nMemFree:          100000 kB\nMemAvailable:    4000000 kB\n')
+    f.close()
+
+    assert oz.ozutil.get_memory_available(meminfo) == 4000000 * 1024
+
+def test_memory_available_old_kernel(tmpdir):
+    meminfo = os.path.join(str(tmpdir), 'meminfo')
+    f = open(meminfo, 'w')
+    f.write('MemTotal:        8000000 kB\nMemFree:          100000 kB\nBuffers:           20000 kB\nCached:           300000 kB\n')
+    f.close()
+
+    assert oz.ozutil.get_memory_available(meminfo) == 420000 * 1024
+
+# test oz.ozutil.scratch_space_available
+def test_scratch_space_available(tmpdir):
+    assert oz.ozutil.scratch_space_available(str(tmpdir), 1)
+
+def test_scratch_space_too_big(tmpdir):
+    assert not oz.ozutil.scratch_space_available(str(tmpdir), 2**62)
+
+# test oz.ozutil.parse_announce
+def test_parse_announce_whole():
+    assert oz.ozutil.parse_announce('', 'garbage!10.0.0.2,abcd!') == (['10.0.0.2,abcd'], '!')
+
+def test_parse_announce_split():
+    announcements, buf = oz.ozutil.parse_announce('', 'boot noise !10.0.')
+    assert announcements == []
+    announcements, buf = oz.ozutil.parse_announce(buf, '0.2,ab')
+    assert announcements == []
+    announcements, buf = oz.ozutil.parse_announce(buf, 'cd!')
+    assert announcements == ['10.0.0.2,abcd']
+
+def test_parse_announce_no_comma():
+    assert oz.ozutil.parse_announce('', '!foo!bar!') == ([], '!')
+
+def test_parse_announce_bounded():
+    announcements, buf = oz.ozutil.parse_announce('', '!' + 'x' * 1000)
+    assert announcements == []
+    assert buf == ''
+
+# test oz.ozutil.port_open
+def test_port_open():
+    import socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+    port = sock.getsockname()[1]
+    try:
+        assert oz.ozutil.port_open('127.0.0.1', port, 1)
+    finally:
+        sock.close()
+
+    assert not oz.ozutil.port_open('127.0.0.1', port, 1)
+
+# test oz.ozutil.generate_command_runner
+def test_command_runner():
+    runner = oz.ozutil.generate_command_runner(['echo one', 'printf two\nexit 3\n', 'echo three'])
+    stdout, stderr, retcode = oz.ozutil.subprocess_check_output(['sh', '-c', runner])
+    assert(oz.ozutil.parse_runner_output(stdout) == [(1, 0, 'one\n\n'), (2, 3, 'two\n')])
+
+# test oz.ozutil.generate_install_script
+def test_install_script(tmpdir):
+    target = str(tmpdir.join('sub', 'file'))
+    repo = str(tmpdir.join('repo'))
+    marker = str(tmpdir.join('marker'))
+    script = oz.ozutil.generate_install_script([(repo, 'repo\n'), (target, b'\x00\xffdata')],
+                                               ['cat %s > %s' % (target, marker)],
+                                               [repo])
+    oz.ozutil.subprocess_check_output(['sh', '-c', script])
+    assert(open(target, 'rb').read() == b'\x00\xffdata')
+    assert(open(marker, 'rb').read() == b'\x00\xffdata')
+    assert(not os.path.exists(repo))
+
+def test_install_script_stops_on_failure(tmpdir):
+    marker = str(tmpdir.join('marker'))
+    script = oz.ozutil.generate_install_script([], ['exit 3', 'touch %s' % (marker)])
+    with py.test.raises(oz.ozutil.SubprocessException):
+        oz.ozutil.subprocess_check_output(['sh', '-c', script])
+    assert(not os.path.exists(marker))
+
+# test oz.ozutil.parse_runner_output
+def test_parse_runner_output_unfinished():
+    output = '@@OZ-BEGIN 1@@\none\n@@OZ-END 1 0@@\n@@OZ-BEGIN 2@@\ntwo\n'
+    assert(oz.ozutil.parse_runner_output(output) == [(1, 0, 'one\n'), (2, None, 'two\n')])
+
+def test_parse_runner_output_empty():
+    assert(oz.ozutil.parse_runner_output('') == [])
+
+# test oz.ozutil.run_parallel
+def test_run_parallel():
+    def _square(x):
+        if x == 3:
+            raise Exception("three")
+        return x * x
+    results = sorted(oz.ozutil.run_parallel(_square, range(5), 2))
+    assert([(item, result) for item, result, err in results] == [(0, 0), (1, 1), (2, 4), (3, None), (4, 16)])
+    assert(str(results[3][2]) == "three")
+
+def test_run_parallel_bounded():
+    import threading
+    import time
+    lock = threading.Lock()
+    state = {'running': 0, 'most': 0}
+    def _work(x):
+        with lock:
+            state['running'] += 1
+            state['most'] = max(state['most'], state['running'])
+        time.sleep(0.05)
+        with lock:
+            state['running'] -= 1
+    assert(len(list(oz.ozutil.run_parallel(_work, range(8), 3))) == 8)
+    assert(state['most'] == 3)
+
+def test_run_parallel_no_workers():
+    with py.test.raises(Exception):
+        list(oz.ozutil.run_parallel(len, [], 0))
+
+# test oz.ozutil.read_variants
+def test_read_variants_directory(tmpdir):
+    for name in ['b.tdl', 'a.tdl', 'notes.txt']:
+        tmpdir.join(name).write('')
+    tmpdir.mkdir('c.d')
+    assert(oz.ozutil.read_variants(str(tmpdir)) == [str(tmpdir.join('a.tdl')),
+                                                    str(tmpdir.join('b.tdl'))])
+
+def test_read_variants_list(tmpdir):
+    listfile = tmpdir.mkdir('lists').join('variants')
+    listfile.write("# web servers\nweb.tdl\n\n  ../db/db.tdl  \n/abs/mail.tdl\n   # indented comment\n")
+    assert(oz.ozutil.read_variants(str(listfile)) == [str(tmpdir.join('lists', 'web.tdl')),
+                                                      os.path.join(str(tmpdir), 'lists', '../db/db.tdl'),
+                                                      '/abs/mail.tdl'])
+
+def test_read_variants_list_relative(tmpdir, monkeypatch):
+    tmpdir.join('variants').write("web.tdl\n")
+    monkeypatch.chdir(str(tmpdir))
+    assert(oz.ozutil.read_variants('variants') == ['web.tdl'])
+
+def test_read_variants_missing(tmpdir):
+    with py.test.raises(IOError):
+        oz.ozutil.read_variants(str(tmpdir.join('missing')))
@@ -90,6 +90,10 @@ tests = {
     "test-53-command-http-url.tdl": True,
     "test-54-files-file-url.tdl": True,
     "test-55-files-http-url.tdl": True,
+    "test-56-install-profile.tdl": True,
+    "test-57-bogus-install-profile.tdl": False,
+    "test-58-command-offline.tdl": True,
+    "test-59-bogus-command-offline.tdl": False,
 }
 
 # Validate oz handling of tdl file
@@ -179,3 +183,18 @@ def test_persisted(tdl='test-43-persisted-repos.tdl'):
             yield '%s_%s' % (test_name, repo.name), assert_persisted_value, repo.persisted, True
         else:
             yield '%s_%s' % (test_name, repo.name), assert_persisted_value, repo.persisted, False
+
+def test_offline_commands(tdl='test-58-command-offline.tdl'):
+    # locate full path for tdl file
+    tdl_prefix = ''
+    for tdl_prefix in ['tests/tdl/', 'tdl/', '']:
+        if os.path.isfile(tdl_prefix + tdl):
+            break
+    if not os.path.isfile(tdl_prefix + tdl):
+        raise Exception('Unable to locate TDL: %s' % tdl)
+    tdl_file = tdl_prefix + tdl
+    # Grab TDL object
+    tdl = validate_ozlib(tdl_file)
+    assert len(tdl.offline_commands) == 2
+    assert tdl.precommands[0] in tdl.offline_commands
+    assert tdl.commands[0] in tdl.offline_commands